@@ -0,0 +1,115 @@
+"""
+Route data model memory and construction benchmark.
+
+Builds the routes of every router three ways from the same cached shortest path
+trees and reports the time taken and the memory they hold:
+
+* legacy: a new per-instance-dict node object for every hop of every route
+* shared: ``Network.get_routes_all``, DataRoute objects over one slotted DataNode per node
+* tables: ``Network.route_table_for``, node ID arrays as the controller keeps them
+
+    python -m benchmarks.datamodel --sizes 100,500,1000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from benchmarks.routes import build_network
+from network.common.data import DataRoute
+from network.common.network import Network
+
+
+class LegacyDataNode:
+    """ The DataNode layout before slots and interning. """
+
+    def __init__(self, name: str, ip: str, port: int, public_key: str = ""):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.public_key = public_key
+
+
+def legacy_routes_all(network: Network) -> List[List[DataRoute]]:
+    """ One node object per hop, per source and per destination, as routes were built before. """
+
+    def node(name: str) -> LegacyDataNode:
+        data = network.graph.nodes[name]
+        return LegacyDataNode(name, data.get("ip"), data.get("port"), data.get("public_key"))
+
+    all_routes = []
+    for source in network.graph.nodes():
+        parents, _ = network.shortest_path_tree(source)
+        all_routes.append([
+            DataRoute(node(source), node(target),
+                      [node(hop) for hop in network.path_from_tree(parents, source, target)])
+            for target in network.graph.nodes() if target != source
+        ])
+    return all_routes
+
+
+def tables_all(network: Network) -> List:
+    return [network.route_table_for(source) for source in network.graph.nodes()]
+
+
+def measure(build: Callable[[], object]) -> Dict:
+    start = time.perf_counter()
+    built = build()
+    elapsed: float = time.perf_counter() - start
+    del built
+
+    tracemalloc.start()
+    built = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    return {"build_s": elapsed, "bytes": current}
+
+
+def run(size: int, legacy_limit: int, seed: int) -> Dict:
+    network = build_network(size, seed)
+    # Trees and directory entries are shared by every variant, build them outside the measurements
+    network.shortest_path_trees()
+    network.get_routes_for(next(iter(network.graph.nodes())))
+
+    routes: int = size * (size - 1)
+    result: Dict = {"nodes": size, "routes": routes}
+    variants = {"shared": network.get_routes_all, "tables": lambda: tables_all(network)}
+    if size <= legacy_limit:
+        variants = {"legacy": lambda: legacy_routes_all(network), **variants}
+    for name, build in variants.items():
+        measured = measure(build)
+        result[f"{name}_build_s"] = measured["build_s"]
+        result[f"{name}_bytes"] = measured["bytes"]
+        result[f"{name}_bytes_per_route"] = measured["bytes"] / routes
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,500,1000")
+    parser.add_argument("--legacy-limit", type=int, default=1000, help="largest size to build the legacy routes on")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_path", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        result = run(size, args.legacy_limit, args.seed)
+        results.append(result)
+        line = f"{size:>6} nodes |"
+        for name in ("legacy", "shared", "tables"):
+            if f"{name}_bytes" in result:
+                line += (f" {name} {result[f'{name}_bytes'] / 2 ** 20:>8.1f} MiB "
+                         f"{result[f'{name}_build_s']:>6.2f} s "
+                         f"({result[f'{name}_bytes_per_route']:>5.0f} B/route) |")
+        print(line)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
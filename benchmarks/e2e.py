@@ -0,0 +1,370 @@
+"""
+End-to-end benchmark: a Controller and N Routers on loopback, driven by Clients.
+
+Builds a topology (line, grid, random geometric or the 14-node US map), starts
+every router in this process and measures:
+
+* convergence: time from pushing the first routes until every router applied
+  its table, and after a single edge weight change
+* latency: text messages sent one at a time from a client on the source router
+  to a client on the farthest router, end to end and averaged over its hops
+  (end to end divided by the hop count, not a per router measurement)
+* throughput: a burst of text messages sent one call each, the same pipelined
+  through Client.send_stream, and streamed files, all delivered to one client
+  of the destination router among --idle-clients others
+* peak RSS of the process
+
+Results are printed and, with --json, written as JSON to compare runs.
+
+    python -m benchmarks.e2e --topology grid --size 16 --json grid.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import math
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from networkx import Graph, is_connected, random_geometric_graph
+
+from network.async_controller import AsyncController
+from network.async_router import AsyncRouter
+from network.client import Client
+from network.common.data import ROOT_DIR
+from network.common.links import LinkWeights
+from network.common.network import Network
+from network.common.security import KEY_RSA, KEY_TYPES
+from network.common.utils import WARNING, flush_logs, set_log_level
+from network.controller import Controller
+from network.router import Router
+
+Edges = List[Tuple[str, str, int]]
+
+# Identity the receiving client registers, every message of the benchmark is sent to it
+RECIPIENT = "bench receiver"
+
+US_EDGES: Edges = [
+    ("WA", "CA1", 2100), ("WA", "CA2", 3000), ("WA", "IL", 4800), ("CA1", "UT", 1500), ("CA1", "CA2", 1200),
+    ("CA2", "TX", 3600), ("UT", "MI", 3900), ("UT", "CO", 1200), ("CO", "NE", 1200), ("CO", "TX", 2400),
+    ("NE", "IL", 1500), ("NE", "GA", 2700), ("TX", "GA", 1200), ("TX", "DC", 3600), ("IL", "PA", 1500),
+    ("GA", "PA", 1500), ("PA", "NY", 600), ("PA", "NJ", 600), ("MI", "NY", 1200), ("MI", "NJ", 1500),
+    ("DC", "NY", 600), ("DC", "NJ", 300),
+]
+
+
+def line_topology(size: int, seed: int) -> Edges:
+    rng = random.Random(seed)
+    return [(f"R{index}", f"R{index + 1}", rng.randint(1, 100)) for index in range(size - 1)]
+
+
+def grid_topology(size: int, seed: int) -> Edges:
+    """ A square grid of about size routers. """
+    rng = random.Random(seed)
+    side: int = max(2, round(math.sqrt(size)))
+    edges: Edges = []
+    for x in range(side):
+        for y in range(side):
+            if x + 1 < side:
+                edges.append((f"R{x}_{y}", f"R{x + 1}_{y}", rng.randint(1, 100)))
+            if y + 1 < side:
+                edges.append((f"R{x}_{y}", f"R{x}_{y + 1}", rng.randint(1, 100)))
+    return edges
+
+
+def geometric_topology(size: int, seed: int) -> Edges:
+    """ Random geometric graph, the radius grown until it is connected. Weights are distances. """
+    radius: float = math.sqrt(2.0 / size)
+    graph: Graph = random_geometric_graph(size, radius, seed=seed)
+    while not is_connected(graph):
+        radius *= 1.2
+        graph = random_geometric_graph(size, radius, seed=seed)
+    positions = graph.nodes(data="pos")
+    return [
+        (f"R{u}", f"R{v}", int(math.dist(positions[u], positions[v]) * 1000) + 1)
+        for u, v in graph.edges()
+    ]
+
+
+def us_topology(size: int, seed: int) -> Edges:
+    return list(US_EDGES)
+
+
+TOPOLOGIES: Dict[str, Callable[[int, int], Edges]] = {
+    "line": line_topology,
+    "grid": grid_topology,
+    "geometric": geometric_topology,
+    "us": us_topology,
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def wait_until(condition: Callable[[], bool], timeout: float, interval: float = 0.005) -> bool:
+    deadline: float = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+
+def peak_rss() -> int:
+    """ Peak resident set size of this process in bytes. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Receiver:
+    """ A client on the destination router recording when each delivery arrives. """
+
+    def __init__(self, host: str, port: int):
+        self.arrivals: Dict[str, float] = {}
+        self.condition = threading.Condition()
+        self.client: Client = Client(host, port, on_message=self.arrived)
+        self.client.connect()
+        self.client.register(RECIPIENT).result(5)
+
+    def arrived(self, message: Dict) -> None:
+        with self.condition:
+            self.arrivals[message.get("message")] = time.perf_counter()
+            self.condition.notify_all()
+
+    def wait(self, messages: List[str], timeout: float) -> bool:
+        deadline: float = time.monotonic() + timeout
+        with self.condition:
+            while not all(message in self.arrivals for message in messages):
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.edges: Edges = TOPOLOGIES[args.topology](args.size, args.seed)
+        self.names: List[str] = sorted({node for u, v, _ in self.edges for node in (u, v)})
+        self.network: Network = Network(max_paths=args.max_paths)
+        controller_class = AsyncController if args.async_controller else Controller
+        self.controller: Controller = controller_class(
+            "localhost", args.port, self.network, incremental=True,
+            link_weights=LinkWeights() if args.link_weights else None
+        )
+        self.routers: Dict[str, Router] = {}
+        self.ports: Dict[str, int] = {name: args.port + 1 + index for index, name in enumerate(self.names)}
+        self.key_dir: str = tempfile.mkdtemp(prefix="bench-keys-")
+
+    def converged(self, names: List[str]) -> bool:
+        versions = self.controller.route_versions
+        return all(
+            name in versions and self.routers[name].routes_version == versions[name]
+            and len(self.routers[name].routes) == len(self.names) - 1
+            for name in names
+        )
+
+    def start(self) -> Dict:
+        router_class = AsyncRouter if self.args.async_router else Router
+        self.controller.start_server()
+        time.sleep(0.2)
+
+        start: float = time.perf_counter()
+        for name in self.names:
+            router = router_class("localhost", self.args.port, "localhost", self.ports[name], name,
+                                  key_type=self.args.key_type, key_dir=self.key_dir)
+            router.connect_to_controller()
+            router.start_server()
+            self.routers[name] = router
+        wait_until(lambda: len(self.controller.clients) == len(self.names), 60)
+        startup: float = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.controller.add_all_edges(self.edges)
+        converged: bool = wait_until(lambda: self.converged(self.names), self.args.timeout)
+        convergence: float = time.perf_counter() - start
+
+        # Change the weight of one edge and wait for the routers whose routes changed
+        u, v, w = self.edges[len(self.edges) // 2]
+        start = time.perf_counter()
+        affected = self.controller.add_edge(u, v, w * 10)
+        wait_until(lambda: self.converged(self.names), self.args.timeout)
+        reconvergence: float = time.perf_counter() - start
+
+        return {
+            "startup_s": startup,
+            "converged": converged,
+            "convergence_s": convergence,
+            "reconvergence_s": reconvergence,
+            "reconvergence_routers": len(affected),
+        }
+
+    def farthest_pair(self) -> Tuple[str, str, int]:
+        """ The first router and the destination its route reaches in the most hops. """
+        source: str = self.names[0]
+        routes = self.routers[source].routes
+        destination: str = max(routes, key=lambda name: len(routes[name].paths))
+        return source, destination, len(routes[destination].paths) - 1
+
+    def traffic(self) -> Dict:
+        source, destination, hops = self.farthest_pair()
+        sender: Client = Client("localhost", self.ports[source])
+        sender.connect()
+        receiver: Receiver = Receiver("localhost", self.ports[destination])
+        # Connected to the destination router too, deliveries must not reach them
+        idle: List[Client] = [Client("localhost", self.ports[destination]) for _ in range(self.args.idle_clients)]
+        for client in idle:
+            client.connect()
+            client.register(f"idle {id(client)}")
+        time.sleep(0.2)
+        result: Dict = {"source": source, "destination": destination, "hops": hops}
+
+        # Warm up connections and session keys
+        sender.send_message(destination, "warmup", recipient=RECIPIENT)
+        receiver.wait(["warmup"], self.args.timeout)
+
+        latencies: List[float] = []
+        for index in range(self.args.latency_samples):
+            message: str = f"latency {index}"
+            sent: float = time.perf_counter()
+            sender.send_message(destination, message, recipient=RECIPIENT)
+            if receiver.wait([message], self.args.timeout):
+                latencies.append(receiver.arrivals[message] - sent)
+        result["latency_p50_ms"] = percentile(latencies, 0.5) * 1000
+        result["latency_p99_ms"] = percentile(latencies, 0.99) * 1000
+        # Averaged over the hops, queueing at any one router is spread over all of them
+        result["latency_p50_over_hops_ms"] = result["latency_p50_ms"] / max(hops, 1)
+        result["latency_p99_over_hops_ms"] = result["latency_p99_ms"] / max(hops, 1)
+        result["latency_lost"] = self.args.latency_samples - len(latencies)
+
+        messages: List[str] = [f"burst {index}" for index in range(self.args.messages)]
+        start: float = time.perf_counter()
+        for message in messages:
+            sender.send_message(destination, message, recipient=RECIPIENT)
+        delivered: bool = receiver.wait(messages, self.args.timeout)
+        elapsed: float = max(receiver.arrivals.get(message, start) for message in messages) - start
+        result["messages"] = self.args.messages
+        result["messages_delivered"] = sum(message in receiver.arrivals for message in messages)
+        result["messages_per_s"] = result["messages_delivered"] / elapsed if elapsed > 0 else float("nan")
+        result["burst_complete"] = delivered
+
+        # Pipelined: batched writes, acks matched by the client reader while it keeps sending
+        messages = [f"ingest {index}" for index in range(self.args.ingest)]
+        start = time.perf_counter()
+        sender.send_stream((destination, message, RECIPIENT) for message in messages)
+        acked: bool = sender.wait_acks(self.args.timeout)
+        acked_elapsed: float = time.perf_counter() - start
+        delivered = receiver.wait(messages, self.args.timeout)
+        elapsed = max(receiver.arrivals.get(message, start) for message in messages) - start
+        result["ingest"] = self.args.ingest
+        result["ingest_acked_per_s"] = self.args.ingest / acked_elapsed if acked else float("nan")
+        result["ingest_delivered"] = sum(message in receiver.arrivals for message in messages)
+        result["ingest_per_s"] = result["ingest_delivered"] / elapsed if elapsed > 0 else float("nan")
+        result["ingest_complete"] = delivered
+
+        with tempfile.NamedTemporaryFile(prefix="bench-", suffix=".bin") as file:
+            file.write(os.urandom(self.args.file_size))
+            file.flush()
+            names: List[str] = [f"bench_{os.getpid()}_{index}.bin" for index in range(self.args.files)]
+            start = time.perf_counter()
+            for name in names:
+                sender.send_file(destination, file.name, name=name, recipient=RECIPIENT)
+            delivered = receiver.wait(names, self.args.timeout)
+            elapsed = time.perf_counter() - start
+        result["files"] = self.args.files
+        result["file_size"] = self.args.file_size
+        result["file_mb_per_s"] = self.args.files * self.args.file_size / elapsed / 2 ** 20 if delivered else 0.0
+        for name in names:
+            for path in glob.glob(os.path.join(ROOT_DIR, "received", destination, f"received_file_*_{name}")):
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+        sender.stop()
+        receiver.client.stop()
+        for client in idle:
+            client.stop()
+        return result
+
+    def stop(self) -> None:
+        self.controller.stop()
+        for router in self.routers.values():
+            router.stop()
+
+
+def run(args: argparse.Namespace) -> Dict:
+    bench = Bench(args)
+    result: Dict = {
+        "topology": args.topology,
+        "routers": len(bench.names),
+        "edges": len(bench.edges),
+        "router": "async" if args.async_router else "threaded",
+        "controller": "async" if args.async_controller else "threaded",
+        "key_type": args.key_type,
+        "max_paths": args.max_paths,
+    }
+    output = open(os.devnull, "w") if not args.verbose else None
+    if output:
+        set_log_level(WARNING)
+    try:
+        with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+            result.update(bench.start())
+            result.update(bench.traffic())
+    finally:
+        with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+            bench.stop()
+            flush_logs()
+        if output:
+            output.close()
+    result["peak_rss_bytes"] = peak_rss()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topology", choices=sorted(TOPOLOGIES), default="us")
+    parser.add_argument("--size", type=int, default=16, help="routers, ignored by the us topology")
+    parser.add_argument("--port", type=int, default=9500, help="controller port, routers use the next ones")
+    parser.add_argument("--messages", type=int, default=2000, help="text messages in the throughput burst")
+    parser.add_argument("--ingest", type=int, default=20000, help="text messages pipelined with send_stream")
+    parser.add_argument("--idle-clients", type=int, default=50, help="other clients of the destination router")
+    parser.add_argument("--latency-samples", type=int, default=200)
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--file-size", type=int, default=4 * 2 ** 20)
+    parser.add_argument("--key-type", choices=KEY_TYPES, default=KEY_RSA)
+    parser.add_argument("--max-paths", type=int, default=1, help="paths per destination, above one spreads flows")
+    parser.add_argument("--link-weights", action="store_true", help="weigh edges by the measured link costs")
+    parser.add_argument("--async-router", action="store_true", help="use AsyncRouter")
+    parser.add_argument("--async-controller", action="store_true", help="use AsyncController")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--verbose", action="store_true", help="keep the routers output")
+    parser.add_argument("--json", dest="json_path", help="write results to this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f"{result['topology']} {result['routers']} routers ({result['router']} routers, "
+          f"{result['controller']} controller) | "
+          f"convergence {result['convergence_s'] * 1000:.1f} ms, "
+          f"after an edge change {result['reconvergence_s'] * 1000:.1f} ms | "
+          f"{result['hops']} hops latency p50 {result['latency_p50_ms']:.2f} ms p99 {result['latency_p99_ms']:.2f} ms "
+          f"(/ hops {result['latency_p50_over_hops_ms']:.2f} / {result['latency_p99_over_hops_ms']:.2f} ms) | "
+          f"{result['messages_per_s']:.0f} msg/s, pipelined {result['ingest_per_s']:.0f} msg/s | "
+          f"{result['file_mb_per_s']:.1f} MiB/s files | "
+          f"peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Multipath routing aggregate throughput benchmark.
+
+Routes one unit of demand between every ordered pair of routers, either all of it
+on the shortest path or split over the paths of ``Network.route_table_for`` in
+proportion to their weights, as routers spread flows. With the same capacity on
+every link and direction, the largest demand every pair can send at once is
+limited by the most loaded link, so aggregate throughput is
+
+    pairs / max link load
+
+in units of link capacity. Also reports the mean link load, how many links carry
+traffic and the average cost of the traffic against the shortest paths.
+
+Runs on the 14-node US map and on the synthetic topologies of benchmarks.e2e.
+
+    python -m benchmarks.multipath --topologies us,grid,geometric --sizes 64,256 --max-paths 2,3,4
+"""
+import argparse
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from benchmarks.e2e import TOPOLOGIES
+from network.common.data import DataNode, RouteTable
+from network.common.network import Network
+
+
+def build_network(edges: List[Tuple[str, str, int]], max_paths: int) -> Network:
+    network = Network(max_paths=max_paths)
+    names = sorted({node for u, v, _ in edges for node in (u, v)})
+    for index, name in enumerate(names):
+        network.add_node(DataNode(name, "localhost", 10000 + index, "KEY"))
+    for u, v, w in edges:
+        network.add_edge(u, v, w)
+    return network
+
+
+def link_loads(network: Network) -> Tuple[Dict[Tuple[int, int], float], float, float]:
+    """ Load of every directed link, the total traffic cost and its cost on the shortest paths. """
+    weights: Dict[Tuple[int, int], int] = {}
+    for u, v, data in network.graph.edges(data=True):
+        u_id, v_id = network.directory.id_of(u), network.directory.id_of(v)
+        weights[u_id, v_id] = weights[v_id, u_id] = data["weight"]
+
+    loads: Dict[Tuple[int, int], float] = defaultdict(float)
+    cost = shortest_cost = 0.0
+    for source in network.graph.nodes():
+        table: RouteTable = network.route_table_for(source)
+        for destination in table.destinations:
+            paths = [(path, weight) for path, weight in table.paths(destination) if len(path) > 1]
+            if not paths:
+                continue
+            total: float = sum(weight for _, weight in paths)
+            for index, (path, weight) in enumerate(paths):
+                share: float = weight / total
+                path_cost: int = 0
+                for hop in range(len(path) - 1):
+                    loads[path[hop], path[hop + 1]] += share
+                    path_cost += weights[path[hop], path[hop + 1]]
+                cost += share * path_cost
+                if index == 0:
+                    shortest_cost += path_cost
+    return loads, cost, shortest_cost
+
+
+def run(edges: List[Tuple[str, str, int]], max_paths: int) -> Dict:
+    network: Network = build_network(edges, max_paths)
+    start = time.perf_counter()
+    loads, cost, shortest_cost = link_loads(network)
+    elapsed = time.perf_counter() - start
+    routers: int = network.graph.number_of_nodes()
+    pairs: int = routers * (routers - 1)
+    max_load: float = max(loads.values())
+    return {
+        "routers": routers,
+        "links": network.graph.number_of_edges(),
+        "max_paths": max_paths,
+        "aggregate_throughput": pairs / max_load,
+        "max_link_load": max_load,
+        "mean_link_load": sum(loads.values()) / (2 * network.graph.number_of_edges()),
+        "links_used": len(loads),
+        "stretch": cost / shortest_cost,
+        "tables_s": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topologies", default="us,grid,geometric")
+    parser.add_argument("--sizes", default="64,256", help="routers, ignored by the us topology")
+    parser.add_argument("--max-paths", default="2,3,4", help="multipath settings compared with a single path")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_path", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for topology in args.topologies.split(","):
+        sizes = [0] if topology == "us" else [int(size) for size in args.sizes.split(",")]
+        for size in sizes:
+            edges = TOPOLOGIES[topology](size, args.seed)
+            baseline = None
+            for max_paths in [1, *(int(paths) for paths in args.max_paths.split(","))]:
+                result = run(edges, max_paths)
+                result["topology"] = topology
+                baseline = baseline or result["aggregate_throughput"]
+                result["gain"] = result["aggregate_throughput"] / baseline
+                results.append(result)
+                print(f"{topology:>9} {result['routers']:>5} routers {result['links']:>5} links | "
+                      f"{max_paths} paths | throughput {result['aggregate_throughput']:>9.1f} "
+                      f"(x{result['gain']:.2f}) | max load {result['max_link_load']:>8.1f} "
+                      f"mean {result['mean_link_load']:>7.1f} | {result['links_used']:>5} links used | "
+                      f"stretch {result['stretch']:.3f} | tables {result['tables_s'] * 1000:>8.1f} ms")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
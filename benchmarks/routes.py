@@ -0,0 +1,115 @@
+"""
+Route generation benchmark on synthetic topologies.
+
+Compares the legacy per-target Dijkstra (one ``dijkstra_path`` per destination)
+with the single-source shortest path trees used by ``Network``, and times the
+incremental recomputation after a single edge weight change.
+
+    python -m benchmarks.routes --sizes 100,500,1000,2000,5000
+"""
+import argparse
+import json
+import random
+import time
+from typing import Dict, List
+
+from networkx import connected_watts_strogatz_graph, dijkstra_path
+
+from network.common.data import DataNode
+from network.common.network import Network
+
+
+def build_network(size: int, seed: int) -> Network:
+    rng = random.Random(seed)
+    graph = connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+
+    network = Network()
+    for index in graph.nodes():
+        network.add_node(DataNode(f"N{index}", "localhost", 10000 + index, "KEY"))
+    for u, v in graph.edges():
+        network.add_edge(f"N{u}", f"N{v}", rng.randint(1, 100))
+    return network
+
+
+def legacy_routes_for(network: Network, source: str) -> int:
+    """ The former get_routes_for: one Dijkstra per target. """
+    count = 0
+    for target in network.graph.nodes():
+        if target != source:
+            count += len(dijkstra_path(network.graph, source, target))
+    return count
+
+
+def run(size: int, samples: int, legacy_limit: int, seed: int) -> Dict:
+    network = build_network(size, seed)
+    sources: List[str] = random.Random(seed).sample(list(network.graph.nodes()), min(samples, size))
+    result: Dict = {"nodes": size, "edges": network.graph.number_of_edges(), "samples": len(sources)}
+
+    if size <= legacy_limit:
+        start = time.perf_counter()
+        for source in sources:
+            legacy_routes_for(network, source)
+        result["legacy_routes_for_s"] = (time.perf_counter() - start) / len(sources)
+
+    network.trees.clear()
+    start = time.perf_counter()
+    for source in sources:
+        network.get_routes_for(source)
+    result["routes_for_s"] = (time.perf_counter() - start) / len(sources)
+
+    network.trees.clear()
+    start = time.perf_counter()
+    network.shortest_path_trees()
+    result["all_trees_s"] = time.perf_counter() - start
+
+    # Trees are cached now, so this only measures building routes from them
+    start = time.perf_counter()
+    for source in sources:
+        network.get_routes_for(source)
+    result["routes_for_cached_s"] = (time.perf_counter() - start) / len(sources)
+
+    # Change one edge weight at a time and recompute only the affected trees
+    rng = random.Random(seed)
+    edges = list(network.graph.edges())
+    affected_total = 0
+    start = time.perf_counter()
+    for _ in range(samples):
+        u, v = rng.choice(edges)
+        affected = network.add_edge(u, v, rng.randint(1, 100))
+        affected_total += len(affected)
+        for source in affected:
+            network.shortest_path_tree(source)
+    result["incremental_update_s"] = (time.perf_counter() - start) / samples
+    result["incremental_affected"] = affected_total / samples
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,500,1000,2000,5000")
+    parser.add_argument("--samples", type=int, default=5, help="sources timed per size")
+    parser.add_argument("--legacy-limit", type=int, default=2000, help="largest size to time the legacy path on")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_path", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        result = run(size, args.samples, args.legacy_limit, args.seed)
+        results.append(result)
+        legacy = result.get("legacy_routes_for_s")
+        print(f"{size:>6} nodes | "
+              f"legacy routes_for {legacy * 1000 if legacy else float('nan'):>10.1f} ms | "
+              f"routes_for {result['routes_for_s'] * 1000:>8.1f} ms | "
+              f"cached {result['routes_for_cached_s'] * 1000:>8.1f} ms | "
+              f"all trees {result['all_trees_s']:>7.2f} s | "
+              f"edge change {result['incremental_update_s'] * 1000:>8.1f} ms "
+              f"({result['incremental_affected']:.0f} trees)")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+DataMessage wire format micro-benchmark.
+
+Compares bytes on the wire and encode/decode time (frame to DataMessage) of the
+JSON frames with the binary DataMessage encoding, for a five hop path of node
+IDs and several payload sizes. Also times one forwarding hop: decoding the whole
+message and encoding it again, against rewriting the binary routing header.
+
+    python -m benchmarks.wire --sizes 128,65536,1048576
+"""
+import argparse
+import json
+import os
+import time
+from typing import Callable, Dict, List
+
+from network.common.data import DataMessage, MessageFrame
+from network.common.framing import FrameDecoder, encode_forward, encode_message, WIRE_BINARY, WIRE_JSON
+
+
+def build_message(size: int, hops: int) -> DataMessage:
+    path: List[int] = list(range(1, hops + 1))
+    return DataMessage(
+        message=os.urandom(40),
+        path=path,
+        key="K" * 344,
+        is_file=True,
+        binary=os.urandom(size)
+    )
+
+
+def timed(function: Callable, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def decode(frame: bytes) -> DataMessage:
+    """ Frame to DataMessage, as a router receives it. """
+    message = FrameDecoder().feed(frame)[0]
+    return message.to_message() if isinstance(message, MessageFrame) else DataMessage.from_json(message)
+
+
+def forward_full(frame: bytes) -> bytes:
+    """ One hop decoding the body, dropping the current node and encoding it again. """
+    data_message: DataMessage = decode(frame)
+    data_message.path.pop(0)
+    return encode_message(data_message, WIRE_BINARY)
+
+
+def forward_header(frame: bytes) -> List:
+    """ One hop on the routing header only, the body is passed through. """
+    return encode_forward(FrameDecoder().feed(frame)[0])
+
+
+def run(size: int, hops: int) -> Dict:
+    data_message: DataMessage = build_message(size, hops)
+    repeat: int = max(5, min(2000, 50_000_000 // max(size, 1) // 10))
+    result: Dict = {"payload": size, "hops": hops}
+    for wire_format in (WIRE_JSON, WIRE_BINARY):
+        frame: bytes = encode_message(data_message, wire_format)
+        result[f"{wire_format}_bytes"] = len(frame)
+        result[f"{wire_format}_encode_us"] = timed(lambda: encode_message(data_message, wire_format), repeat) * 1e6
+        result[f"{wire_format}_decode_us"] = timed(lambda: decode(frame), repeat) * 1e6
+    result["forward_full_us"] = timed(lambda: forward_full(frame), repeat) * 1e6
+    result["forward_header_us"] = timed(lambda: forward_header(frame), repeat) * 1e6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="128,4096,65536,1048576")
+    parser.add_argument("--hops", type=int, default=5)
+    parser.add_argument("--json", dest="json_path", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        result = run(size, args.hops)
+        results.append(result)
+        print(f"{size:>8} B payload | "
+              f"json {result['json_bytes']:>9} B "
+              f"{result['json_encode_us']:>9.1f} / {result['json_decode_us']:>9.1f} us | "
+              f"binary {result['binary_bytes']:>9} B "
+              f"{result['binary_encode_us']:>9.1f} / {result['binary_decode_us']:>9.1f} us | "
+              f"hop {result['forward_full_us']:>9.1f} full / {result['forward_header_us']:>6.1f} header us")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import asyncio
+import itertools
+from typing import AsyncIterable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from network.client import AckCallback, MAX_BATCH_BYTES, MAX_BATCH_MESSAGES, MAX_IN_FLIGHT, Outgoing, ack_results, \
+    client_message, is_ack, registration
+from network.common.framing import BUFFER_SIZE, FrameDecoder, encode_frame
+
+Messages = Union[Iterable[Outgoing], AsyncIterable[Outgoing]]
+
+
+class AsyncClient:
+    """
+    Client for asyncio programs, on one long-lived connection to a router like Client.
+    Every coroutine runs on the loop that connected; acks resolve futures of that loop.
+    """
+
+    def __init__(self, router_host: str, router_port: int) -> None:
+        # Client network configuration
+        self.router_host: str = router_host
+        self.router_port: int = router_port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.read_task: Optional[asyncio.Task] = None
+
+        # Delivered messages, None once the connection is closed
+        self.inbox: asyncio.Queue = asyncio.Queue()
+
+        # Ids of the messages waiting for their ack and the futures it resolves
+        self.ids: Iterator[int] = itertools.count(1)
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.acked: asyncio.Event = asyncio.Event()
+        self.acked.set()
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.router_host, self.router_port)
+        self.read_task = asyncio.get_running_loop().create_task(self._read())
+
+    async def _read(self) -> None:
+        decoder: FrameDecoder = FrameDecoder()
+        try:
+            while True:
+                data: bytes = await self.reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if is_ack(frame):
+                        self.resolve(ack_results(frame))
+                    else:
+                        self.inbox.put_nowait(frame)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            # Messages still waiting for an ack are lost with the connection
+            self.resolve((message_id, False) for message_id in list(self.pending))
+            self.inbox.put_nowait(None)
+
+    def resolve(self, results: Iterable[Tuple[int, bool]]) -> None:
+        for message_id, queued in results:
+            future: Optional[asyncio.Future] = self.pending.pop(message_id, None)
+            if future is not None and not future.done():
+                future.set_result(queued)
+        if not self.pending:
+            self.acked.set()
+
+    def track(self) -> Tuple[int, asyncio.Future]:
+        """ A new message id and the future its ack resolves. """
+        message_id: int = next(self.ids)
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = future
+        self.acked.clear()
+        return message_id, future
+
+    async def send_message(self,
+                           destination: str,
+                           message: str,
+                           is_file: bool = False,
+                           binary: bytes = bytes(),
+                           flow: Optional[str] = None,
+                           recipient: Optional[str] = None) -> asyncio.Future:
+        """ Returns a future resolved with whether the router queued the message to its next hop. """
+        message_id, future = self.track()
+        await self._write([encode_frame(
+            client_message(message_id, destination, message, is_file, binary, flow, recipient)
+        )], [message_id])
+        return future
+
+    async def register(self, *recipients: str) -> asyncio.Future:
+        """ Receive the messages sent to recipients on this connection. The future resolves once the router has it. """
+        message_id, future = self.track()
+        await self._write([encode_frame(registration(message_id, recipients))], [message_id])
+        return future
+
+    async def unregister(self, *recipients: str) -> asyncio.Future:
+        """ Stop receiving for recipients, for all of them when none is given. """
+        message_id, future = self.track()
+        await self._write([encode_frame(registration(message_id, recipients, register=False))], [message_id])
+        return future
+
+    async def send_many(self, messages: Messages, flow: Optional[str] = None) -> List[asyncio.Future]:
+        """ Send messages, many per write. Returns the future of each. """
+        futures: List[asyncio.Future] = []
+        await self._bulk(messages, flow, lambda message_id, future: futures.append(future))
+        return futures
+
+    async def send_stream(self,
+                          messages: Messages,
+                          flow: Optional[str] = None,
+                          on_ack: Optional[AckCallback] = None,
+                          max_in_flight: int = MAX_IN_FLIGHT) -> int:
+        """
+        Send messages as an iterator, sync or async, yields them, many per write,
+        with at most max_in_flight of them unacknowledged. Returns the messages sent.
+        """
+        window: asyncio.Semaphore = asyncio.Semaphore(max_in_flight)
+
+        def tracked(message_id: int, future: asyncio.Future) -> None:
+            future.add_done_callback(lambda _: window.release())
+            if on_ack is not None:
+                future.add_done_callback(lambda done: on_ack(message_id, done.result()))
+
+        return await self._bulk(messages, flow, tracked, window)
+
+    async def _bulk(self,
+                    messages: Messages,
+                    flow: Optional[str],
+                    tracked: Callable[[int, asyncio.Future], None],
+                    window: Optional[asyncio.Semaphore] = None) -> int:
+        """ Encode messages and write them in batches. A message takes a slot of window until its ack. """
+        sent: int = 0
+        batch: List[bytes] = []
+        batch_ids: List[int] = []
+        size: int = 0
+        async for destination, message, *recipient in self._iterate(messages):
+            if window is not None and window.locked():
+                # Written before waiting, the acks that free the window may be for this batch
+                await self._write(batch, batch_ids)
+                batch, batch_ids, size = [], [], 0
+            if window is not None:
+                await window.acquire()
+            message_id, future = self.track()
+            tracked(message_id, future)
+            frame: bytes = encode_frame(client_message(
+                message_id, destination, message, flow=flow, recipient=recipient[0] if recipient else None
+            ))
+            batch.append(frame)
+            batch_ids.append(message_id)
+            size += len(frame)
+            sent += 1
+            if len(batch) >= MAX_BATCH_MESSAGES or size >= MAX_BATCH_BYTES:
+                await self._write(batch, batch_ids)
+                batch, batch_ids, size = [], [], 0
+        await self._write(batch, batch_ids)
+        return sent
+
+    @staticmethod
+    async def _iterate(messages: Messages):
+        if isinstance(messages, AsyncIterable):
+            async for item in messages:
+                yield item
+        else:
+            for item in messages:
+                yield item
+
+    async def _write(self, frames: List[bytes], ids: Iterable[int] = ()) -> None:
+        """ Write frames at once. When that fails, the messages they carry resolve as not queued. """
+        if frames:
+            try:
+                self.writer.writelines(frames)
+                await self.writer.drain()
+            except Exception:
+                self.resolve((message_id, False) for message_id in ids)
+                raise
+
+    async def wait_acks(self, timeout: Optional[float] = None) -> bool:
+        """ Wait until every message sent so far was acknowledged. False on timeout. """
+        try:
+            await asyncio.wait_for(self.acked.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def receive_message(self, timeout: Optional[float] = None) -> Optional[Dict]:
+        """ Next message delivered to this client, None on timeout or once the connection is closed. """
+        try:
+            return await asyncio.wait_for(self.inbox.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            await asyncio.gather(self.read_task, return_exceptions=True)
@@ -0,0 +1,158 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from network.common.data import DataNode
+from network.common.event_loop import BACKLOG, EventLoopThread
+from network.common.framing import encode_frame, read_frame, Message
+from network.common.network import Network
+from network.common.utils import debug_log, debug_exception, debug_warning
+from network.controller import Controller, AUTH_MAX_FRAME_SIZE
+
+# Seconds a new connection has to send its authentication DataNode
+HANDSHAKE_TIMEOUT = 5.0
+# Bytes waiting to be written to a router before it is considered stalled and disconnected
+MAX_ROUTER_BUFFER = 16 * 1024 * 1024
+
+
+class AsyncController(Controller, EventLoopThread):
+    """
+    Controller serving every router connection from one asyncio event loop.
+    Handshakes run concurrently with a timeout, so a silent router cannot stall the others.
+    Route computation and state changes run in a single worker thread, in arrival order.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 network: Network,
+                 incremental: bool = False,
+                 handshake_timeout: float = HANDSHAKE_TIMEOUT,
+                 max_router_buffer: int = MAX_ROUTER_BUFFER,
+                 **options
+                 ) -> None:
+        super().__init__(host, port, network, incremental, **options)
+        self.handshake_timeout: float = handshake_timeout
+        self.max_router_buffer: int = max_router_buffer
+
+        self.start_loop(ThreadPoolExecutor(max_workers=1, thread_name_prefix="controller-routes"))
+
+    def start_server(self) -> None:
+        try:
+            self.run(self._start_server()).result()
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            "Controller start error: %s", ex)
+
+    async def _start_server(self) -> None:
+        self.server = await asyncio.start_server(
+            self._handle_connection,
+            self.host,
+            self.port,
+            backlog=BACKLOG
+        )
+        self.spawn(self._check_heartbeats())
+        debug_log(self.NAME,
+                  "Controller started.")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address = writer.get_extra_info("peername")
+        node: Optional[DataNode] = None
+        try:
+            try:
+                data_auth: Optional[Message] = await asyncio.wait_for(
+                    read_frame(reader, AUTH_MAX_FRAME_SIZE, self.metrics), self.handshake_timeout
+                )
+            except asyncio.TimeoutError:
+                debug_warning(self.NAME,
+                              "Authentication timed out for %s", address)
+                return
+            except Exception as ex:
+                debug_warning(self.NAME,
+                              "Authentication failed for %s: %s", address, ex)
+                return
+
+            if data_auth is None:
+                return
+            if isinstance(data_auth, dict) and data_auth.get("type") == "stats":
+                # Snapshot in the worker, the router stats are written there
+                writer.write(encode_frame(await self.in_executor(self.stats_reply)))
+                return
+            node = self.auth_node(data_auth)
+            if node is None:
+                debug_warning(self.NAME,
+                              "Invalid authentication from %s", address)
+                return
+
+            await self.in_executor(self._register, node, writer)
+            debug_log(self.NAME,
+                      "Connection established with %s", address)
+
+            while self.running.is_set():
+                message_json: Optional[Dict] = await read_frame(reader, metrics=self.metrics)
+                if message_json is None:
+                    break
+                # Any frame keeps the router alive, recorded here without waiting for the worker
+                self.heard_from(node, message_json)
+                if message_json.get("type") != "ping" or "links" in message_json:
+                    self.in_background(self.process_message, message_json, node)
+        except Exception as ex:
+            if self.running.is_set():
+                debug_exception(self.NAME,
+                                "Error handling client %s: %s", node.name if node else address, ex)
+        finally:
+            if node is not None:
+                await self.in_executor(self.close_client, writer, node)
+            writer.close()
+
+    def _register(self, node: DataNode, writer: asyncio.StreamWriter) -> None:
+        with self.lock:
+            self.clients[node] = writer
+            self.liveness.add(node.name)
+        self.add_node(node)
+        self.send_heartbeat_config(node)
+
+    def send_to(self, node: DataNode, message: Dict) -> None:
+        writer: asyncio.StreamWriter = self.clients[node]
+        frame: bytes = encode_frame(message)
+        self.metrics.add("bytes_out", len(frame))
+        self.loop.call_soon_threadsafe(self._write, node, writer, frame)
+
+    def close_connection(self, writer: asyncio.StreamWriter) -> None:
+        """ Called by close_client in the worker, transports are only closed on the loop. """
+        self.loop.call_soon_threadsafe(writer.close)
+
+    def _write(self, node: DataNode, writer: asyncio.StreamWriter, frame: bytes) -> None:
+        """ Written without waiting for the router, which is disconnected once too far behind. """
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() >= self.max_router_buffer:
+            # Closing would wait for the buffer to drain, aborting ends its handler, which removes the router
+            debug_warning(self.NAME,
+                          "%s stopped reading, disconnected", node.name)
+            self.metrics.add("routers_stalled")
+            writer.transport.abort()
+            return
+        writer.write(frame)
+
+    async def _check_heartbeats(self) -> None:
+        while self.running.is_set():
+            await asyncio.sleep(self.heartbeat_wait())
+            for node in self.liveness.expired():
+                debug_warning(self.NAME,
+                              "Router %s is considered disconnected.", node)
+                self.metrics.add("routers_timed_out")
+                self.in_background(self.remove_client_by_name, node)
+
+    def stop(self) -> None:
+        self.running.clear()
+        self.stop_loop()
+
+        debug_warning(self.NAME,
+                      "Controller Server Stopped.")
+
+    async def _stop(self) -> None:
+        with self.lock:
+            for writer in self.clients.values():
+                writer.close()
+            self.clients.clear()
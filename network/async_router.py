@@ -0,0 +1,485 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from network.common.data import DataMessage, DataNode, MessageFrame
+from network.common.delivery import MAX_DELIVERY_BYTES
+from network.common.event_loop import BACKLOG, EventLoopThread
+from network.common.framing import FrameDecoder, Frame, Message, encode_frame, frame_size, read_frame, WIRE_JSON
+from network.common.links import quick_ack, tcp_rtt
+from network.common.outbound import FrameQueue, merge_stats, message_size, priority_of
+from network.common.pool import BACKOFF_INITIAL, BACKOFF_MAX, CONNECT_TIMEOUT, ConnectionPool
+from network.common.utils import debug_log, debug_trace, debug_warning, debug_exception
+from network.router import Router, BUFFER_SIZE
+
+
+class NextHop:
+    """ The queue of one next hop and the events its writer task and the readers wait on. Loop thread only. """
+
+    def __init__(self, address: Tuple[str, int], name: str, max_frames: int, max_bytes: int):
+        self.address: Tuple[str, int] = address
+        self.name: str = name
+        self.frames: FrameQueue = FrameQueue(max_frames, max_bytes)
+        # Set when frames wait to be written, and while the queue has room
+        self.ready: asyncio.Event = asyncio.Event()
+        self.room: asyncio.Event = asyncio.Event()
+        self.room.set()
+        # Set when the next hop is no longer used, the writer stops once the queue is empty
+        self.closing: bool = False
+        # Seconds the writer waits before connecting again after a failed attempt, 0 while connected
+        self.delay: float = 0.0
+
+
+class AsyncRouter(Router, EventLoopThread):
+    """
+    Router running every connection on one asyncio event loop instead of a thread per connection.
+    Keeps the public surface of Router; decryption and encryption run in an executor.
+    """
+
+    def __init__(self,
+                 controller_host: str,
+                 controller_port: int,
+                 local_host: str,
+                 local_port: int,
+                 name: str = "NONE",
+                 max_workers: Optional[int] = None,
+                 **options
+                 ) -> None:
+        super().__init__(controller_host, controller_port, local_host, local_port, name, **options)
+
+        self.start_loop(ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{self.name}-crypto"))
+
+        # Stream writers for the controller, connected clients and next hops
+        self.controller_writer: Optional[asyncio.StreamWriter] = None
+        self.client_writers: Dict[Tuple[str, int], asyncio.StreamWriter] = {}
+        self.peer_writers: Dict[Tuple[str, int], asyncio.StreamWriter] = {}
+        self.next_hop_writers: Dict[Tuple[str, int], asyncio.StreamWriter] = {}
+        self.next_hop_formats: Dict[Tuple[str, int], str] = {}
+        # Round trip of the hello frame per next hop, the RTT when the kernel does not expose its own
+        self.next_hop_rtts: Dict[Tuple[str, int], float] = {}
+
+        # Bounded queue and writer task per next hop, readers pause while any of them is full
+        self.hop_queues: Dict[Tuple[str, int], NextHop] = {}
+        self.full_hop_queues: Set[Tuple[str, int]] = set()
+        self.send_slots: asyncio.Event = asyncio.Event()
+        self.send_slots.set()
+
+        # Set by heartbeat configs from the controller, on the loop
+        self.heartbeat_wakeup: asyncio.Event = asyncio.Event()
+
+    def setup_transport(self) -> None:
+        """ Next hops and clients are written by tasks of the loop, see _write_next_hop and _deliver_local. """
+        self.connect_timeout: float = CONNECT_TIMEOUT
+        self.backoff_initial: float = BACKOFF_INITIAL
+        self.backoff_max: float = BACKOFF_MAX
+        # Bytes a client may leave unread before its deliveries are dropped
+        self.max_delivery_bytes: int = MAX_DELIVERY_BYTES
+
+    # Controller connection
+
+    def connect_to_controller(self) -> None:
+        try:
+            self.run(self._connect_to_controller()).result()
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            "Failed to connect to controller: %s", ex)
+
+    async def _connect_to_controller(self) -> None:
+        reader, writer = await asyncio.open_connection(self.controller_host, self.controller_port)
+        self.controller_writer = writer
+        debug_log(self.NAME,
+                  "Connected to the controller %s", (self.controller_host, self.controller_port))
+
+        # Auth the router once its key pair is ready, without blocking the loop on key generation
+        await asyncio.wrap_future(self.keys)
+        message_auth: DataNode = self.data_node()
+        writer.write(encode_frame(message_auth.__dict__()))
+        await writer.drain()
+
+        self.spawn(self._routes_checker(reader))
+        self.spawn(self._send_heartbeat())
+
+    def send_controller(self, message: Dict) -> None:
+        frame: bytes = encode_frame(message)
+        self.loop.call_soon_threadsafe(self._write_controller, frame)
+
+    def _write_controller(self, frame: bytes) -> None:
+        if self.controller_writer is not None and not self.controller_writer.is_closing():
+            self.controller_writer.write(frame)
+            self.last_controller_send = time.monotonic()
+
+    async def _send_heartbeat(self) -> None:
+        while self.running.is_set():
+            wait: float = self.heartbeat_due()
+            if not wait:
+                try:
+                    self._write_controller(encode_frame(self.heartbeat()))
+                    await self.controller_writer.drain()
+                except Exception as ex:
+                    debug_exception(self.NAME, "Error sending heartbeat: %s", ex)
+                wait = self.heartbeat_interval
+            try:
+                await asyncio.wait_for(self.heartbeat_wakeup.wait(), wait)
+                self.heartbeat_wakeup.clear()
+            except asyncio.TimeoutError:
+                pass
+
+    async def _routes_checker(self, reader: asyncio.StreamReader) -> None:
+        decoder: FrameDecoder = FrameDecoder(metrics=self.metrics, prefix="controller_")
+        try:
+            while self.running.is_set():
+                data: bytes = await reader.read(BUFFER_SIZE)
+                if not data:
+                    debug_warning(self.NAME,
+                                  "Connection closed by the controller")
+                    break
+                for routes_json in decoder.feed(data):
+                    if not isinstance(routes_json, dict):
+                        # The controller only sends JSON, anything else must not end the updates
+                        debug_warning(self.NAME,
+                                      "Unexpected frame from the controller ignored: %s", type(routes_json).__name__)
+                        continue
+                    if routes_json.get("type") == "heartbeat":
+                        self.apply_heartbeat_config(routes_json)
+                        self.heartbeat_wakeup.set()
+                        continue
+                    try:
+                        # Parsing and persisting the table stays off the loop, updates apply in order
+                        await self.in_executor(self.apply_routes, routes_json)
+                    except Exception as ex:
+                        debug_warning(self.NAME,
+                                      "Received invalid route update.\nError: %s", ex)
+        except Exception as ex:
+            if self.running.is_set():
+                debug_exception(self.NAME,
+                                "Error processing received routes: %s", ex)
+
+    # Router server
+
+    def start_server(self) -> None:
+        try:
+            self.run(self._start_server()).result()
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            "Router Server start error: %s", ex)
+
+    async def _start_server(self) -> None:
+        self.server = await asyncio.start_server(
+            self._handle_connection,
+            self.local_host,
+            self.local_port,
+            backlog=BACKLOG
+        )
+        debug_log(self.NAME,
+                  "Router Server started.")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address: Tuple[str, int] = writer.get_extra_info("peername")[:2]
+        self.client_writers[address] = writer
+        debug_log(self.NAME,
+                  "Accepted connection from %s", address)
+
+        decoder: FrameDecoder = FrameDecoder(metrics=self.metrics)
+        try:
+            while self.running.is_set():
+                data: bytes = await reader.read(BUFFER_SIZE)
+                if not data:
+                    debug_log(self.NAME,
+                              "Connection closed by %s", address)
+                    break
+                # Messages that need crypto are handed to the executor together, in order with the others
+                pending: List[Message] = []
+                for message_json in decoder.feed(data):
+                    if isinstance(message_json, dict) and message_json.get("type") == "hello":
+                        self.peer_writers[address] = self.client_writers.pop(address, writer)
+                        writer.write(encode_frame(self.hello(message_json.get("formats"))))
+                        quick_ack(writer.get_extra_info("socket"))
+                    elif isinstance(message_json, dict) and message_json.get("type") == "stats":
+                        writer.write(encode_frame({"type": "stats", "name": self.name, "stats": self.stats()}))
+                    elif isinstance(message_json, dict) and message_json.get("type") in ("register", "unregister"):
+                        ack: Optional[Dict] = self.register_client(address, message_json)
+                        if ack is not None:
+                            writer.write(encode_frame(ack))
+                    elif self.is_transit(message_json):
+                        await self._process_pending(pending, writer)
+                        self.process_message(message_json)
+                        # Bound the memory held by forwarded frames when next hops are slower than this reader
+                        await self.send_slots.wait()
+                    else:
+                        pending.append(message_json)
+                await self._process_pending(pending, writer)
+        except Exception as ex:
+            if self.running.is_set():
+                debug_exception(self.NAME,
+                                "Error Reading Messages: %s", ex)
+        finally:
+            self.client_writers.pop(address, None)
+            self.peer_writers.pop(address, None)
+            with self.lock:
+                self.recipients.unregister(address)
+            writer.close()
+            debug_warning(self.NAME,
+                          "Connection closed with %s", address)
+
+    async def _process_pending(self, pending: List[Message], writer: asyncio.StreamWriter) -> None:
+        if not pending:
+            return
+        messages: List[Message] = pending[:]
+        pending.clear()
+        ack: Optional[Dict] = await self.in_executor(self.process_messages, messages)
+        if ack is not None and not writer.is_closing():
+            writer.write(encode_frame(ack))
+        await self.send_slots.wait()
+
+    # Outbound traffic
+
+    def send_message_client(self, data_message: Union[DataMessage, MessageFrame], next_node: DataNode) -> bool:
+        address: Tuple[str, int] = (next_node.ip, next_node.port)
+        size: int = message_size(data_message)
+        priority: int = priority_of(data_message, size)
+        if threading.get_ident() == self.loop_thread.ident:
+            # Forwarded by a reader, which pauses on its own while a queue is full
+            self._queue_send(address, next_node.name, data_message, size, priority)
+            return True
+        hop: Optional[NextHop] = self.hop_queues.get(address)
+        if hop is None or not hop.frames.full():
+            # Read without the loop, a queue may go a few frames over its bounds
+            self.loop.call_soon_threadsafe(self._queue_send, address, next_node.name, data_message, size, priority)
+            return True
+        try:
+            queued: bool = self.run(self._put_send(address, next_node.name, data_message, size, priority)).result(
+                self.put_timeout + 1
+            )
+        except Exception:
+            queued = False
+        if not queued:
+            debug_warning(self.NAME,
+                          "Send queue to %s is full, message dropped", next_node.name)
+        return queued
+
+    def _next_hop(self, address: Tuple[str, int], name: str) -> NextHop:
+        hop: Optional[NextHop] = self.hop_queues.get(address)
+        if hop is None:
+            hop = self.hop_queues[address] = NextHop(address, name, self.max_queued_frames, self.max_queued_bytes)
+            self.spawn(self._write_next_hop(hop))
+        return hop
+
+    def _queue_send(self,
+                    address: Tuple[str, int],
+                    name: str,
+                    data_message: Union[DataMessage, MessageFrame],
+                    size: int,
+                    priority: int
+                    ) -> None:
+        hop: NextHop = self._next_hop(address, name)
+        hop.frames.push(data_message, size, priority)
+        hop.ready.set()
+        if hop.frames.full():
+            hop.room.clear()
+            self.full_hop_queues.add(address)
+            self.send_slots.clear()
+
+    async def _put_send(self,
+                        address: Tuple[str, int],
+                        name: str,
+                        data_message: Union[DataMessage, MessageFrame],
+                        size: int,
+                        priority: int
+                        ) -> bool:
+        """ Queue a message from another thread, waiting up to put_timeout for room in a full queue. """
+        hop: NextHop = self._next_hop(address, name)
+        if hop.frames.full():
+            self.metrics.add("queue_full_waits")
+            try:
+                await asyncio.wait_for(hop.room.wait(), self.put_timeout)
+            except asyncio.TimeoutError:
+                hop.frames.dropped += 1
+                self.drop("queue_full")
+                return False
+        self._queue_send(address, name, data_message, size, priority)
+        return True
+
+    def _room_made(self, hop: NextHop) -> None:
+        if hop.frames.full():
+            return
+        hop.room.set()
+        self.full_hop_queues.discard(hop.address)
+        if not self.full_hop_queues:
+            self.send_slots.set()
+
+    async def _next_hop_writer(self, address: Tuple[str, int]) -> asyncio.StreamWriter:
+        writer: Optional[asyncio.StreamWriter] = self.next_hop_writers.get(address)
+        if writer is not None and not writer.is_closing():
+            return writer
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.connect_timeout)
+        writer.write(encode_frame(self.hello()))
+        start: float = time.perf_counter()
+        try:
+            reply = await asyncio.wait_for(read_frame(reader), self.connect_timeout)
+        except asyncio.TimeoutError:
+            reply = None
+        self.next_hop_rtts[address] = time.perf_counter() - start
+        wire_format: str = reply.get("format", WIRE_JSON) if isinstance(reply, dict) else WIRE_JSON
+        self.next_hop_formats[address] = wire_format
+        self.next_hop_writers[address] = writer
+        return writer
+
+    async def _write_next_hop(self, hop: NextHop) -> None:
+        """ The only writer of a next hop: connects, then sends its queue in batches of one writelines each. """
+        while self.running.is_set():
+            if not hop.frames:
+                if hop.closing:
+                    break
+                hop.ready.clear()
+                await hop.ready.wait()
+                continue
+            try:
+                writer: asyncio.StreamWriter = await self._next_hop_writer(hop.address)
+            except Exception as ex:
+                await self._back_off(hop, ex)
+                continue
+            hop.delay = 0.0
+            batch: List[Union[DataMessage, MessageFrame]] = hop.frames.pop_batch()
+            self._room_made(hop)
+            try:
+                wire_format: str = self.next_hop_formats.get(hop.address, WIRE_JSON)
+                buffers: List = []
+                for data_message in batch:
+                    frame: Frame = self.encode(data_message, wire_format)
+                    buffers.extend(ConnectionPool.buffers(frame))
+                writer.writelines(buffers)
+                sent: int = frame_size(buffers)
+                start: float = time.perf_counter()
+                await writer.drain()
+                seconds: float = time.perf_counter() - start
+                self.metrics.add("bytes_out", sent)
+                self.metrics.observe("send_seconds", seconds)
+                self.metrics.observe("send_batch_frames", len(batch))
+                self.links.observe_send(hop.name, hop.address, sent, seconds)
+                debug_trace(self.NAME,
+                            "%d messages SENT to %s: %d bytes", len(batch), hop.name, sent)
+            except Exception as ex:
+                failed: Optional[asyncio.StreamWriter] = self.next_hop_writers.pop(hop.address, None)
+                if failed is not None:
+                    failed.close()
+                hop.frames.dropped += len(batch)
+                self.metrics.add("messages_dropped", len(batch))
+                self.metrics.add("dropped_send_failed", len(batch))
+                debug_exception(self.NAME,
+                                "Failed to send %d messages to %s: %s", len(batch), hop.name, ex)
+        if hop.address not in self.hop_queues:
+            writer = self.next_hop_writers.pop(hop.address, None)
+            if writer is not None:
+                writer.close()
+            self.next_hop_formats.pop(hop.address, None)
+            self.next_hop_rtts.pop(hop.address, None)
+
+    async def _back_off(self, hop: NextHop, ex: Exception) -> None:
+        """
+        Keep the queue of a next hop that cannot be reached and wait longer before each new attempt.
+        A full queue drops its oldest batch at each attempt, so readers are not paused for good.
+        """
+        self.metrics.add("connect_failures")
+        lost: int = 0
+        if hop.closing:
+            # No longer used, nothing would retry
+            lost = hop.frames.clear()
+            self.metrics.add("dropped_unreachable", lost)
+        elif hop.frames.full():
+            lost = len(hop.frames.pop_batch())
+            hop.frames.dropped += lost
+            self._room_made(hop)
+            self.metrics.add("dropped_queue_full", lost)
+        if lost:
+            self.metrics.add("messages_dropped", lost)
+            debug_warning(self.NAME,
+                          "Dropped %d messages to %s, unreachable: %s", lost, hop.name, ex)
+            if hop.closing:
+                return
+        hop.delay = min(self.backoff_max, hop.delay * 2 if hop.delay else self.backoff_initial)
+        debug_trace(self.NAME,
+                    "Cannot reach %s, retrying in %.2f s: %s", hop.name, hop.delay, ex)
+        await asyncio.sleep(hop.delay)
+
+    def retain_next_hops(self, next_hops: Set[Tuple[str, int]]) -> None:
+        self.loop.call_soon_threadsafe(self._retain_next_hops, next_hops)
+
+    def _retain_next_hops(self, next_hops: Set[Tuple[str, int]]) -> None:
+        """ Next hops no longer in use close their connection once their queue is sent. """
+        for address in [address for address in self.hop_queues if address not in next_hops]:
+            hop: NextHop = self.hop_queues.pop(address)
+            hop.closing = True
+            hop.ready.set()
+            self.full_hop_queues.discard(address)
+        if not self.full_hop_queues:
+            self.send_slots.set()
+        self.links.retain(next_hops)
+
+    def link_rtt(self, address: Tuple[str, int]) -> Optional[float]:
+        """ Loop thread only, heartbeats are built on the loop. """
+        writer: Optional[asyncio.StreamWriter] = self.next_hop_writers.get(address)
+        if writer is None:
+            return None
+        rtt: Optional[float] = tcp_rtt(writer.get_extra_info("socket"))
+        return self.next_hop_rtts.get(address) if rtt is None else rtt
+
+    def deliver_local(self, message: str, recipient: str = "") -> None:
+        message_to_client = {'message': message}
+        if recipient:
+            message_to_client['recipient'] = recipient
+        self.loop.call_soon_threadsafe(self._deliver_local, encode_frame(message_to_client), recipient)
+
+    def _deliver_local(self, frame: bytes, recipient: str) -> None:
+        """ Written to the clients of recipient without waiting for them, dropped for those too far behind. """
+        with self.lock:
+            targets: List[Tuple[str, int]] = self.recipients.targets(recipient, self.client_writers)
+        writers: List[asyncio.StreamWriter] = [
+            writer for writer in map(self.client_writers.get, targets) if writer is not None and not writer.is_closing()
+        ]
+        if not writers:
+            debug_warning(self.NAME,
+                          "No client receives for %r, message dropped", recipient)
+            self.drop("unroutable_local")
+            return
+        for writer in writers:
+            if writer.transport.get_write_buffer_size() >= self.max_delivery_bytes:
+                self.drop("client_queue_full")
+                continue
+            writer.write(frame)
+            self.metrics.add("local_deliveries")
+
+    def transport_stats(self) -> Dict:
+        return {
+            "clients": len(self.client_writers),
+            "peers": len(self.peer_writers),
+            "next_hops": len(self.next_hop_writers),
+            "queues": merge_stats({hop.name: hop.frames.stats() for hop in list(self.hop_queues.values())}),
+        }
+
+    # Shutdown
+
+    def stop(self) -> None:
+        self.running.clear()
+        self.stop_loop()
+
+        debug_warning(self.NAME,
+                      "Router Server Stopped.")
+
+    async def _stop(self) -> None:
+        writers = [
+            *self.client_writers.values(),
+            *self.peer_writers.values(),
+            *self.next_hop_writers.values()
+        ]
+        if self.controller_writer is not None:
+            writers.append(self.controller_writer)
+        for writer in writers:
+            writer.close()
+        self.client_writers.clear()
+        self.peer_writers.clear()
+        self.next_hop_writers.clear()
+        self.hop_queues.clear()
+        self.file_receiver.close()
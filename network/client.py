@@ -1,58 +1,305 @@
 import base64
+import itertools
+import os
+import queue
 import socket
-import json
+import threading
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from network.common.data import DataMessage
+from network.common.framing import BUFFER_SIZE, encode_frame, read_frames, recv_frame, send_frame
+from network.common.transfer import CHUNK_SIZE, iter_chunks
+
+# Messages and bytes encoded into one write by the bulk sends
+MAX_BATCH_MESSAGES = 256
+MAX_BATCH_BYTES = 1024 * 1024
+# Messages send_stream keeps unacknowledged before it waits for the router
+MAX_IN_FLIGHT = 8192
+
+# Called with the id of a message and whether the router queued it to its next hop
+AckCallback = Callable[[int, bool], None]
+# A message of the bulk sends: (destination, message) or (destination, message, recipient)
+Outgoing = Union[Tuple[str, str], Tuple[str, str, str]]
+
+
+def query_stats(host: str, port: int, timeout: float = 5.0) -> Optional[Dict]:
+    """ Ask a router or the controller for its counters and histograms over a connection of its own. """
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        send_frame(sock, {"type": "stats"})
+        return recv_frame(sock)
+
+
+def client_message(message_id: int,
+                   destination: str,
+                   message: str,
+                   is_file: bool = False,
+                   binary: bytes = bytes(),
+                   flow: Optional[str] = None,
+                   recipient: Optional[str] = None) -> Dict:
+    """ A message for the router to route, acknowledged under message_id. """
+    client_message = {
+        'id': message_id,
+        'destination': destination,
+        'message': message,
+        'is_file': is_file,
+        'binary': base64.b64encode(binary).decode('utf-8') if is_file else ""
+    }
+    if flow is not None:
+        client_message['flow'] = flow
+    if recipient is not None:
+        client_message['recipient'] = recipient
+    return client_message
+
+
+def registration(message_id: int, recipients: Iterable[str], register: bool = True) -> Dict:
+    """ Ask the router to deliver the messages for recipients to this connection, or to stop. """
+    return {'type': "register" if register else "unregister", 'id': message_id, 'recipients': list(recipients)}
+
+
+def ack_results(ack: Dict) -> Iterator[Tuple[int, bool]]:
+    """ Each id of an ack frame and whether its message was queued to its next hop. """
+    for message_id in ack.get('ids', ()):
+        yield message_id, True
+    for message_id in ack.get('failed', ()):
+        yield message_id, False
+
+
+def is_ack(frame) -> bool:
+    return isinstance(frame, dict) and frame.get('type') == "ack"
 
 
 class Client:
+    """
+    One long-lived framed connection to a router. Every message carries an id the router acknowledges
+    once it has queued the message to its next hop, or failed to; a reader thread matches the acks and
+    keeps the delivered messages, so sends never wait for the router and can be pipelined.
+    """
+
     def __init__(self,
                  router_host: str,
-                 router_port: int
+                 router_port: int,
+                 on_message: Optional[Callable[[Dict], None]] = None
                  ) -> None:
         # Client network configuration
         self.router_host: str = router_host
         self.router_port: int = router_port
         self.client: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # Delivered messages are passed to on_message from the reader thread, or kept for receive_message
+        self.on_message: Optional[Callable[[Dict], None]] = on_message
+        self.inbox: queue.Queue = queue.Queue()
+        self.reader: Optional[threading.Thread] = None
+
+        # Ids of the messages waiting for their ack and the futures it resolves
+        self.ids: Iterator[int] = itertools.count(1)
+        self.pending: Dict[int, Future] = {}
+        self.acked = threading.Condition()
+        # Whole batches are written at once, whatever thread sends them
+        self.write_lock = threading.Lock()
+
     def connect(self) -> None:
         try:
             self.client.connect((self.router_host, self.router_port))
+            self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.reader = threading.Thread(target=self.read, daemon=True)
+            self.reader.start()
             print(f"Connected to the Router {self.router_host}:{self.router_port}")
         except Exception as ex:
             print(f"Failed to connect to the router: {ex}")
             if self.client:
                 self.client.close()
 
-    def send_message(self, destination: str, message: str, is_file: bool = False, binary: bytes = bytes()) -> None:
+    def read(self) -> None:
         try:
-            if is_file:
-                binary_data_encoded = base64.b64encode(binary).decode('utf-8')
-            else:
-                binary_data_encoded = ""
-
-            client_message = {
-                'destination': destination,
-                'message': message,
-                'is_file': is_file,
-                'binary': binary_data_encoded
-            }
-
-            json_data = json.dumps(client_message)
-            self.client.sendall(json_data.encode('utf-8'))
+            for frame in read_frames(self.client, BUFFER_SIZE):
+                if is_ack(frame):
+                    self.resolve(ack_results(frame))
+                elif self.on_message is not None:
+                    self.on_message(frame)
+                else:
+                    self.inbox.put(frame)
+        except OSError:
+            pass
+        finally:
+            # Messages still waiting for an ack are lost with the connection
+            self.resolve((message_id, False) for message_id in list(self.pending))
+            self.inbox.put(None)
+
+    def resolve(self, results: Iterable[Tuple[int, bool]]) -> None:
+        resolved: List[Tuple[Future, bool]] = []
+        with self.acked:
+            for message_id, queued in results:
+                future: Optional[Future] = self.pending.pop(message_id, None)
+                if future is not None:
+                    resolved.append((future, queued))
+            if not self.pending:
+                self.acked.notify_all()
+        for future, queued in resolved:
+            future.set_result(queued)
+
+    def track(self) -> Tuple[int, Future]:
+        """ A new message id and the future its ack resolves. """
+        message_id: int = next(self.ids)
+        future: Future = Future()
+        with self.acked:
+            self.pending[message_id] = future
+        return message_id, future
+
+    def write(self, frames: List[bytes], ids: Iterable[int] = ()) -> None:
+        """ Write frames at once. When that fails, the messages they carry resolve as not queued. """
+        try:
+            with self.write_lock:
+                self.client.sendall(b"".join(frames))
+        except Exception:
+            self.resolve((message_id, False) for message_id in ids)
+            raise
+
+    def send_message(self,
+                     destination: str,
+                     message: str,
+                     is_file: bool = False,
+                     binary: bytes = bytes(),
+                     flow: Optional[str] = None,
+                     recipient: Optional[str] = None) -> Optional[Future]:
+        """
+        Messages with the same flow stay on one path when the router spreads traffic over several.
+        The destination router delivers the message to the clients registered as recipient.
+        Returns a future resolved with whether the router queued the message to its next hop.
+        """
+        try:
+            message_id, future = self.track()
+            self.write([encode_frame(
+                client_message(message_id, destination, message, is_file, binary, flow, recipient)
+            )], [message_id])
             print(f"Message sent to {destination} -> {message}")
+            return future
         except Exception as ex:
             print(f"Failed to send message: {ex}")
 
-    def receive_message(self):
+    def register(self, *recipients: str) -> Future:
+        """ Receive the messages sent to recipients on this connection. The future resolves once the router has it. """
+        message_id, future = self.track()
+        self.write([encode_frame(registration(message_id, recipients))], [message_id])
+        return future
+
+    def unregister(self, *recipients: str) -> Future:
+        """ Stop receiving for recipients, for all of them when none is given. """
+        message_id, future = self.track()
+        self.write([encode_frame(registration(message_id, recipients, register=False))], [message_id])
+        return future
+
+    def send_many(self, messages: Iterable[Outgoing], flow: Optional[str] = None) -> List[Future]:
+        """ Send messages, many per write. Returns the future of each, as send_message does. """
+        return [future for _, future in self.bulk(messages, flow)]
+
+    def send_stream(self,
+                    messages: Iterable[Outgoing],
+                    flow: Optional[str] = None,
+                    on_ack: Optional[AckCallback] = None,
+                    max_in_flight: int = MAX_IN_FLIGHT) -> int:
+        """
+        Send messages as an iterator yields them, many per write, with at most
+        max_in_flight of them unacknowledged. on_ack is called from the reader thread. Returns the messages sent.
+        """
+        window = threading.Semaphore(max_in_flight)
+        sent: int = 0
+        for message_id, future in self.bulk(messages, flow, window):
+            if on_ack is not None:
+                future.add_done_callback(lambda done, message_id=message_id: on_ack(message_id, done.result()))
+            sent += 1
+        return sent
+
+    def bulk(self,
+             messages: Iterable[Outgoing],
+             flow: Optional[str] = None,
+             window: Optional[threading.Semaphore] = None) -> Iterator[Tuple[int, Future]]:
+        """
+        Encode messages and write them in batches, yielding the id and future of each as it is encoded.
+        A message takes a slot of window until its ack, the pending batch is written before waiting for one.
+        """
+        batch: List[bytes] = []
+        batch_ids: List[int] = []
+        size: int = 0
+        for destination, message, *recipient in messages:
+            if window is not None:
+                if not window.acquire(blocking=False):
+                    if batch:
+                        self.write(batch, batch_ids)
+                        batch, batch_ids, size = [], [], 0
+                    window.acquire()
+            message_id, future = self.track()
+            if window is not None:
+                future.add_done_callback(lambda _: window.release())
+            frame: bytes = encode_frame(client_message(
+                message_id, destination, message, flow=flow, recipient=recipient[0] if recipient else None
+            ))
+            batch.append(frame)
+            batch_ids.append(message_id)
+            size += len(frame)
+            yield message_id, future
+            if len(batch) >= MAX_BATCH_MESSAGES or size >= MAX_BATCH_BYTES:
+                self.write(batch, batch_ids)
+                batch, batch_ids, size = [], [], 0
+        if batch:
+            self.write(batch, batch_ids)
+
+    def wait_acks(self, timeout: Optional[float] = None) -> bool:
+        """ Wait until every message sent so far was acknowledged. False on timeout. """
+        with self.acked:
+            return self.acked.wait_for(lambda: not self.pending, timeout)
+
+    def send_file(self,
+                  destination: str,
+                  file_path: str,
+                  name: str = None,
+                  chunk_size: int = CHUNK_SIZE,
+                  recipient: Optional[str] = None) -> None:
+        """ Stream a file to the router chunk by chunk, so it is never held in memory whole. """
+        try:
+            transfer_id = uuid.uuid4().hex
+            name = name or os.path.basename(file_path)
+            with open(file_path, 'rb') as file:
+                for offset, chunk, final in iter_chunks(file, chunk_size):
+                    client_message = {
+                        'destination': destination,
+                        'message': name,
+                        'is_file': True,
+                        'binary': base64.b64encode(chunk).decode('utf-8'),
+                        'transfer_id': transfer_id,
+                        'offset': offset,
+                        'final': final
+                    }
+                    if recipient is not None:
+                        client_message['recipient'] = recipient
+                    self.write([encode_frame(client_message)])
+            print(f"File sent to {destination} -> {name}")
+        except Exception as ex:
+            print(f"Failed to send file: {ex}")
+
+    def receive_message(self, timeout: Optional[float] = None) -> Optional[Dict]:
+        """ Next message delivered to this client, None on timeout or once the connection is closed. """
         try:
-            data = self.client.recv(1024).decode('utf-8')
-            data_loaded = json.loads(data)
+            data_loaded = self.inbox.get(timeout=timeout)
             print(data_loaded)
+            return data_loaded
+        except queue.Empty:
+            return None
         except Exception as e:
             print(f"Failed to receive message: {e}")
 
+    def stats(self) -> Optional[Dict]:
+        """ Stats of the router, queried apart so the reply does not mix with delivered messages. """
+        try:
+            return query_stats(self.router_host, self.router_port)
+        except Exception as ex:
+            print(f"Failed to query stats: {ex}")
+
     def stop(self):
         if self.client:
+            try:
+                self.client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.client.close()
             print("Client Stopped.")
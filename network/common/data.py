@@ -1,8 +1,11 @@
-import json
+import base64
 import os
-from typing import List, Dict
+import struct
+import zlib
+from array import array
+from bisect import bisect_left
+from typing import List, Dict, Iterator, Optional, Tuple, Union
 
-from network.common.utils import debug_warning
 
 ROOT_DIR: str = (
     os.path.dirname(
@@ -14,19 +17,29 @@ ROOT_DIR: str = (
 
 
 class DataNode:
-    def __init__(self, name: str, ip: str, port: int, public_key: str = ""):
+    __slots__ = ("name", "ip", "port", "public_key", "node_id")
+
+    def __init__(self, name: str, ip: str, port: int, public_key: str = "", node_id: Optional[int] = None):
         self.name: str = name
         self.ip: str = ip
         self.port: int = port
         self.public_key: str = public_key
+        # Small integer the controller assigns, routes and messages refer to nodes by it
+        self.node_id: Optional[int] = node_id
 
     def __dict__(self):
-        return {
+        data = {
             "name": self.name,
             "ip": self.ip,
             "port": self.port,
             "public_key": self.public_key,
         }
+        if self.node_id is not None:
+            data["id"] = self.node_id
+        return data
+
+    def same_as(self, other: "DataNode") -> bool:
+        return (self.name, self.ip, self.port, self.public_key) == (other.name, other.ip, other.port, other.public_key)
 
     @classmethod
     def from_json(cls, data: dict):
@@ -34,55 +47,243 @@ class DataNode:
             name=data["name"],
             ip=data["ip"],
             port=data["port"],
-            public_key=data.get("public_key", "")
+            public_key=data.get("public_key", ""),
+            node_id=data.get("id")
         )
 
 
+def _intern_node(data: Dict, nodes: Dict[str, DataNode]) -> DataNode:
+    """ The DataNode already parsed for this name, so each node is held once however many routes use it. """
+    node: Optional[DataNode] = nodes.get(data["name"])
+    if node is None:
+        node = DataNode.from_json(data)
+        nodes[node.name] = node
+    return node
+
+
+class NodeDirectory:
+    """
+    Node ID -> DataNode. Versioned so the controller ships each node once and afterwards only what changed.
+    IDs are never reused for another name.
+    """
+    __slots__ = ("version", "nodes", "ids", "updated", "removed")
+    TYPE = "directory"
+
+    def __init__(self):
+        self.version: int = 0
+        self.nodes: Dict[int, DataNode] = {}
+        self.ids: Dict[str, int] = {}
+        # Node ID -> directory version in which it was last added, changed or removed
+        self.updated: Dict[int, int] = {}
+        self.removed: Dict[int, int] = {}
+
+    def get(self, node_id: int) -> Optional[DataNode]:
+        return self.nodes.get(node_id)
+
+    def id_of(self, name: str) -> Optional[int]:
+        return self.ids.get(name)
+
+    def add(self, node: DataNode) -> DataNode:
+        """ Register or update a node, returning the shared entry that carries its ID. """
+        node_id: Optional[int] = self.ids.get(node.name)
+        if node_id is None:
+            node_id = len(self.ids) + 1
+            self.ids[node.name] = node_id
+
+        current: Optional[DataNode] = self.nodes.get(node_id)
+        if current is not None and current.same_as(node):
+            return current
+
+        self.version += 1
+        entry: DataNode = DataNode(node.name, node.ip, node.port, node.public_key, node_id)
+        self.nodes[node_id] = entry
+        self.updated[node_id] = self.version
+        self.removed.pop(node_id, None)
+        return entry
+
+    def remove(self, name: str) -> None:
+        node_id: Optional[int] = self.ids.get(name)
+        if node_id is None or node_id not in self.nodes:
+            return
+        self.version += 1
+        del self.nodes[node_id]
+        del self.updated[node_id]
+        self.removed[node_id] = self.version
+
+    def changes_since(self, version: int) -> Dict:
+        """ Nodes changed or removed after version, or the whole directory when version is unknown. """
+        full: bool = version <= 0 or version > self.version
+        return {
+            "type": self.TYPE,
+            "version": self.version,
+            "base_version": 0 if full else version,
+            "nodes": [node.__dict__() for node_id, node in self.nodes.items()
+                      if full or self.updated[node_id] > version],
+            "removed": [] if full else [node_id for node_id, removed in self.removed.items() if removed > version]
+        }
+
+    def apply(self, json_data: Dict) -> Optional[List[int]]:
+        """
+        Apply changes pushed by the controller, replacing the maps at once so readers never see them half done.
+        Changes carry the current entries, so they also apply over any newer version than their base.
+        Returns the IDs of entries that existed and changed, None when versions are missing in between.
+        """
+        base_version: int = json_data["base_version"]
+        if base_version > self.version:
+            return None
+
+        nodes: Dict[int, DataNode] = dict(self.nodes) if base_version else {}
+        changed: List[int] = []
+        for node_id in json_data.get("removed", []):
+            if nodes.pop(node_id, None) is not None:
+                changed.append(node_id)
+        for data in json_data.get("nodes", []):
+            node: DataNode = DataNode.from_json(data)
+            current: Optional[DataNode] = self.nodes.get(node.node_id)
+            if current is not None and not current.same_as(node):
+                changed.append(node.node_id)
+            nodes[node.node_id] = node
+        if not base_version:
+            changed.extend(node_id for node_id in self.nodes if node_id not in nodes)
+
+        self.nodes = nodes
+        self.ids = {node.name: node_id for node_id, node in nodes.items()}
+        self.version = json_data["version"]
+        return changed
+
+    @classmethod
+    def is_directory(cls, json_data: Dict) -> bool:
+        return json_data.get("type") == cls.TYPE
+
+
 class DataRoute:
-    def __init__(self, source: DataNode, destination: DataNode, paths: List[DataNode]):
+    __slots__ = ("source", "destination", "paths", "alternates", "weights", "credits")
+
+    def __init__(self,
+                 source: DataNode,
+                 destination: DataNode,
+                 paths: List[DataNode],
+                 alternates: List[List[DataNode]] = None,
+                 weights: List[float] = None):
         self.source: DataNode = source
         self.destination: DataNode = destination
+        # The shortest path, from the source to the destination
         self.paths: List[DataNode] = paths
+        # Other loop-free paths and the share of traffic of every path, the shortest first
+        self.alternates: List[List[DataNode]] = alternates or []
+        self.weights: List[float] = weights or []
+        # Smooth weighted round-robin state, one credit per path
+        self.credits: List[float] = [0.0] * len(self.weights)
 
     def __dict__(self):
-        return {
+        data = {
             "source": self.source.__dict__(),
             "destination": self.destination.__dict__(),
             "path": [node.__dict__() for node in self.paths]
         }
+        if self.alternates:
+            data["alternates"] = [[node.__dict__() for node in path] for path in self.alternates]
+            data["weights"] = self.weights
+        return data
+
+    def all_paths(self) -> List[List[DataNode]]:
+        return [self.paths, *self.alternates]
+
+    def choose(self, flow: Optional[str] = None) -> List[DataNode]:
+        """
+        Path for one message. Messages of a flow hash to the same path, others take turns
+        by weighted round-robin, so traffic spreads over the paths in proportion to their weights.
+        """
+        if not self.alternates:
+            return self.paths
+        paths: List[List[DataNode]] = self.all_paths()
+        if flow is not None:
+            point: float = zlib.crc32(flow.encode('utf-8')) / 2 ** 32 * sum(self.weights)
+            for path, weight in zip(paths, self.weights):
+                point -= weight
+                if point < 0:
+                    return path
+            return paths[-1]
+
+        # Races between threads only skew the turns, every path keeps its credit bounded
+        credits: List[float] = self.credits
+        best: int = 0
+        for index, weight in enumerate(self.weights):
+            credits[index] += weight
+            if credits[index] > credits[best]:
+                best = index
+        credits[best] -= sum(self.weights)
+        return paths[best]
 
     @classmethod
-    def from_json(cls, json_data: Dict):
-        source: DataNode = DataNode.from_json(json_data['source'])
-        destination: DataNode = DataNode.from_json(json_data['destination'])
-        paths: List[DataNode] = [DataNode.from_json(data) for data in json_data['path']]
+    def from_ids(cls, json_data: Dict, directory: NodeDirectory, source: DataNode):
+        return cls(
+            source=source,
+            destination=directory.nodes[json_data['destination']],
+            paths=[directory.nodes[node_id] for node_id in json_data['path']],
+            alternates=[[directory.nodes[node_id] for node_id in path] for path in json_data.get('alternates', [])],
+            weights=json_data.get('weights')
+        )
+
+    @classmethod
+    def from_json(cls, json_data: Dict, nodes: Dict[str, DataNode] = None):
+        """ nodes interns the DataNode of each name, so routes parsed together share them. """
+        if nodes is None:
+            nodes = {}
+        source: DataNode = _intern_node(json_data['source'], nodes)
+        destination: DataNode = _intern_node(json_data['destination'], nodes)
+        paths: List[DataNode] = [_intern_node(data, nodes) for data in json_data['path']]
         return cls(
             source=source,
             destination=destination,
-            paths=paths
+            paths=paths,
+            alternates=[[_intern_node(data, nodes) for data in path] for path in json_data.get('alternates', [])],
+            weights=json_data.get('weights')
         )
 
 
 class NodeRoutes:
-    def __init__(self, node: DataNode, routes: List[DataRoute]):
+    __slots__ = ("node", "routes", "version")
+
+    def __init__(self, node: DataNode, routes: List[DataRoute], version: int = 0):
         self.node: DataNode = node
         self.routes: List[DataRoute] = routes
+        self.version: int = version
 
     def __dict__(self):
         return {
             "node": self.node.__dict__(),
+            "version": self.version,
             "routes": [route.__dict__() for route in self.routes]
         }
 
     @classmethod
     def from_json(cls, json_data: Dict):
-        node: DataNode = DataNode.from_json(json_data['node'])
-        routes: List[DataRoute] = [DataRoute.from_json(data) for data in json_data['routes']]
+        nodes: Dict[str, DataNode] = {}
+        node: DataNode = _intern_node(json_data['node'], nodes)
+        routes: List[DataRoute] = [DataRoute.from_json(data, nodes) for data in json_data['routes']]
         return cls(
             node=node,
-            routes=routes
+            routes=routes,
+            version=json_data.get('version', 0)
         )
 
+    @classmethod
+    def from_compact(cls, json_data: Dict, directory: NodeDirectory, node: DataNode):
+        return cls(
+            node=node,
+            routes=[DataRoute.from_ids(data, directory, node) for data in json_data['routes']],
+            version=json_data.get('version', 0)
+        )
+
+    @staticmethod
+    def is_compact(json_data: Dict) -> bool:
+        return json_data.get("compact", False)
+
+    def index(self) -> Dict[str, DataRoute]:
+        """ Map every destination name to its route for constant time lookups. """
+        return {route.destination.name: route for route in self.routes}
+
     @classmethod
     def default(cls):
         default_node: DataNode = DataNode("Default", "None", 0, "None")
@@ -93,76 +294,394 @@ class NodeRoutes:
         )
 
 
+class RoutesDelta:
+    """ Destinations added, changed or removed between two versions of a router's table. """
+    __slots__ = ("base_version", "version", "routes", "removed", "removed_ids")
+    TYPE = "routes_delta"
+
+    def __init__(self,
+                 base_version: int,
+                 version: int,
+                 routes: List[DataRoute],
+                 removed: List[str],
+                 removed_ids: List[int] = None):
+        self.base_version: int = base_version
+        self.version: int = version
+        self.routes: List[DataRoute] = routes
+        self.removed: List[str] = removed
+        # Compact deltas name removed destinations by node ID
+        self.removed_ids: List[int] = removed_ids or []
+
+    def __dict__(self):
+        return {
+            "type": self.TYPE,
+            "base_version": self.base_version,
+            "version": self.version,
+            "routes": [route.__dict__() for route in self.routes],
+            "removed": self.removed
+        }
+
+    def is_empty(self) -> bool:
+        return not self.routes and not self.removed and not self.removed_ids
+
+    def apply(self, base: Dict[str, DataRoute]) -> Dict[str, DataRoute]:
+        """ Build the new index without touching base, which may still be in use. """
+        routes: Dict[str, DataRoute] = dict(base)
+        for name in self.removed:
+            routes.pop(name, None)
+        if self.removed_ids:
+            removed_ids = set(self.removed_ids)
+            routes = {name: route for name, route in routes.items() if route.destination.node_id not in removed_ids}
+        for route in self.routes:
+            routes[route.destination.name] = route
+        return routes
+
+    @staticmethod
+    def _route_key(route: DataRoute):
+        # Node addresses and keys travel in the directory, a route only changes with its hops
+        return tuple(node.name for node in route.paths)
+
+    @classmethod
+    def between(cls, base_version: int, base: Dict[str, DataRoute], routes: NodeRoutes):
+        changed: List[DataRoute] = [
+            route for route in routes.routes
+            if route.destination.name not in base
+            or cls._route_key(base[route.destination.name]) != cls._route_key(route)
+        ]
+        current = {route.destination.name for route in routes.routes}
+        removed: List[str] = [name for name in base if name not in current]
+        return cls(
+            base_version=base_version,
+            version=routes.version,
+            routes=changed,
+            removed=removed
+        )
+
+    @classmethod
+    def is_delta(cls, json_data: Dict) -> bool:
+        return json_data.get("type") == cls.TYPE
+
+    @classmethod
+    def from_json(cls, json_data: Dict):
+        nodes: Dict[str, DataNode] = {}
+        return cls(
+            base_version=json_data['base_version'],
+            version=json_data['version'],
+            routes=[DataRoute.from_json(data, nodes) for data in json_data.get('routes', [])],
+            removed=json_data.get('removed', [])
+        )
+
+    @classmethod
+    def from_compact(cls, json_data: Dict, directory: NodeDirectory, node: DataNode):
+        return cls(
+            base_version=json_data['base_version'],
+            version=json_data['version'],
+            routes=[DataRoute.from_ids(data, directory, node) for data in json_data.get('routes', [])],
+            removed=json_data.get('removed', []),
+            removed_ids=json_data.get('removed_ids', [])
+        )
+
+
+class RouteTable:
+    """
+    A router's routes as flat arrays of node IDs: destinations sorted, the paths to destinations[i] are
+    the paths first[i] to first[i + 1], path j has the hops hops[offsets[j]:offsets[j + 1]] and carries
+    weights[j] of the traffic. The first path of a destination is its shortest, the others are alternates.
+    Lets the controller keep every table it sent without route objects.
+    """
+    __slots__ = ("destinations", "first", "offsets", "hops", "weights", "version")
+
+    def __init__(self, destinations: array, first: array, offsets: array, hops: array, weights: array,
+                 version: int = 0):
+        self.destinations: array = destinations
+        self.first: array = first
+        self.offsets: array = offsets
+        self.hops: array = hops
+        self.weights: array = weights
+        self.version: int = version
+
+    @classmethod
+    def from_paths(cls, paths: Dict[int, List[int]], version: int = 0):
+        return cls.from_multipaths({destination: [(path, 1.0)] for destination, path in paths.items()}, version)
+
+    @classmethod
+    def from_multipaths(cls, paths: Dict[int, List[Tuple[List[int], float]]], version: int = 0):
+        """ paths holds the (hops, weight) of every path to a destination, the shortest first. """
+        destinations: array = array("I", sorted(paths))
+        first: array = array("I", [0])
+        offsets: array = array("I", [0])
+        hops: array = array("I")
+        weights: array = array("d")
+        for destination in destinations:
+            for path, weight in paths[destination]:
+                hops.extend(path)
+                offsets.append(len(hops))
+                weights.append(weight)
+            first.append(len(weights))
+        return cls(destinations, first, offsets, hops, weights, version)
+
+    def __len__(self) -> int:
+        return len(self.destinations)
+
+    def _index(self, destination: int) -> Optional[int]:
+        index: int = bisect_left(self.destinations, destination)
+        if index == len(self.destinations) or self.destinations[index] != destination:
+            return None
+        return index
+
+    def _path(self, path_index: int) -> array:
+        return self.hops[self.offsets[path_index]:self.offsets[path_index + 1]]
+
+    def _paths(self, index: int) -> List[Tuple[array, float]]:
+        return [(self._path(path), self.weights[path]) for path in range(self.first[index], self.first[index + 1])]
+
+    def path(self, destination: int) -> Optional[array]:
+        """ The shortest path to destination. """
+        index: Optional[int] = self._index(destination)
+        return None if index is None else self._path(self.first[index])
+
+    def paths(self, destination: int) -> List[Tuple[array, float]]:
+        """ Every path to destination with its weight, the shortest first. """
+        index: Optional[int] = self._index(destination)
+        return [] if index is None else self._paths(index)
+
+    def items(self) -> Iterator[Tuple[int, array]]:
+        for index, destination in enumerate(self.destinations):
+            yield destination, self._path(self.first[index])
+
+    def nbytes(self) -> int:
+        return sum(len(values) * values.itemsize
+                   for values in (self.destinations, self.first, self.offsets, self.hops, self.weights))
+
+    def _entry(self, index: int) -> Dict:
+        paths: List[Tuple[array, float]] = self._paths(index)
+        entry: Dict = {"destination": self.destinations[index], "path": list(paths[0][0])}
+        if len(paths) > 1:
+            entry["alternates"] = [list(path) for path, _ in paths[1:]]
+            entry["weights"] = [round(weight, 3) for _, weight in paths]
+        return entry
+
+    def compact(self, node_id: int) -> Dict:
+        """ The full table in the compact NodeRoutes form. """
+        return {
+            "node": node_id,
+            "version": self.version,
+            "compact": True,
+            "routes": [self._entry(index) for index in range(len(self.destinations))]
+        }
+
+    def delta_since(self, base: "RouteTable") -> Dict:
+        """ The compact RoutesDelta from base to this table. """
+        return {
+            "type": RoutesDelta.TYPE,
+            "base_version": base.version,
+            "version": self.version,
+            "compact": True,
+            "routes": [self._entry(index) for index, destination in enumerate(self.destinations)
+                       if base.paths(destination) != self._paths(index)],
+            "removed": [],
+            "removed_ids": [destination for destination in base.destinations if self._index(destination) is None]
+        }
+
+
 class DataMessage:
-    def __init__(self, message: str, path: List[DataNode], key: str = "", is_file: bool = False, binary: str = ""):
-        self.message: str = message
-        self.path: List[DataNode] = path
+    __slots__ = ("message", "path", "key", "is_file", "binary", "transfer_id", "offset", "final", "recipient")
+    # Binary encoding: fixed header, transfer id, recipient, key, path node IDs, then the raw ciphertexts
+    # version, flags, hop, path nodes, key, transfer id, recipient, message and binary lengths, chunk offset
+    BINARY_HEADER = struct.Struct("!BBHHHHHIIQ")
+    BINARY_NODE_ID = struct.Struct("!I")
+    # Hop is the index in the path of the node the message is at, routers forward by rewriting it
+    BINARY_HOP = struct.Struct("!H")
+    BINARY_HOP_OFFSET = 2
+    BINARY_VERSION = 4
+    FLAG_FILE = 1
+    FLAG_FINAL = 2
+    # Data the ciphertexts are bound to: file flag and recipient length, the recipient, then for chunks
+    # their offset, final flag and transfer id
+    ASSOCIATED = struct.Struct("!?H")
+    CHUNK_ASSOCIATED = struct.Struct("!Q?")
+
+    def __init__(self,
+                 message: bytes,
+                 path: List[int],
+                 key: str = "",
+                 is_file: bool = False,
+                 binary: bytes = b"",
+                 transfer_id: str = "",
+                 offset: int = 0,
+                 final: bool = False,
+                 recipient: str = ""):
+        # Ciphertexts (nonce + AES-GCM output) are kept raw, JSON encodes them as base64
+        self.message: bytes = message
+        # Directory IDs of the nodes left to visit, the current node first
+        self.path: List[int] = path
         self.key: str = key
         self.is_file: bool = is_file
-        self.binary: str = binary
+        self.binary: bytes = binary
+        # Streamed files: one message per chunk, written at offset, final on the last chunk
+        self.transfer_id: str = transfer_id
+        self.offset: int = offset
+        self.final: bool = final
+        # Client identity the destination router delivers to, its unregistered clients when empty.
+        # Authenticated with the ciphertexts, see associated_data
+        self.recipient: str = recipient
 
     def __dict__(self):
-        return {
-            "message": self.message,
-            "path": [path.__dict__() for path in self.path],
+        data = {
+            "message": base64.b64encode(self.message).decode('ascii'),
+            "path": list(self.path),
             "key": self.key,
             "is_file": self.is_file,
-            "binary": self.binary
+            "binary": base64.b64encode(self.binary).decode('ascii')
         }
+        if self.transfer_id:
+            data["transfer_id"] = self.transfer_id
+            data["offset"] = self.offset
+            data["final"] = self.final
+        if self.recipient:
+            data["recipient"] = self.recipient
+        return data
 
-    def is_current_node(self, node: str) -> bool:
-        return self.path and self.path[0].name == node
+    def is_current_node(self, node_id: int) -> bool:
+        return bool(self.path) and self.path[0] == node_id
 
-    def is_destine(self, node: str) -> bool:
-        return self.path and self.path[-1].name == node
+    def is_destine(self, node_id: int) -> bool:
+        return bool(self.path) and self.path[-1] == node_id
+
+    def is_chunk(self) -> bool:
+        return bool(self.transfer_id)
+
+    def associated_data(self) -> bytes:
+        """
+        The header fields travel in clear for the routers, the ciphertexts are bound to them as AES-GCM
+        associated data so the destination detects a message redirected to another recipient, or a chunk
+        moved, retargeted or cut short on the way.
+        """
+        recipient: bytes = self.recipient.encode('utf-8')
+        data: bytes = self.ASSOCIATED.pack(self.is_file, len(recipient)) + recipient
+        if self.transfer_id:
+            data += self.CHUNK_ASSOCIATED.pack(self.offset, self.final) + self.transfer_id.encode('ascii')
+        return data
 
     @classmethod
     def is_message(cls, message: Dict) -> bool:
-        try:
-            DataMessage.from_json(message)
-            return True
-        except Exception:
-            return False
+        """ Whether a JSON frame is a routed message rather than a client request, without decoding it. """
+        return isinstance(message.get('path'), list) and isinstance(message.get('message'), str)
 
     @classmethod
     def from_json(cls, json_data: Dict):
-        message: str = json_data['message']
-        path: List[DataNode] = [DataNode.from_json(data) for data in json_data['path']]
+        message: bytes = base64.b64decode(json_data['message'])
+        path: List[int] = [int(node_id) for node_id in json_data['path']]
         key: str = json_data.get('key', '')
         is_file: bool = json_data.get('is_file', False)
-        binary: str = json_data.get('binary', "")
+        binary: bytes = base64.b64decode(json_data.get('binary', ""))
         return cls(
             message=message,
             path=path,
             key=key,
             is_file=is_file,
-            binary=binary
+            binary=binary,
+            transfer_id=json_data.get('transfer_id', ""),
+            offset=json_data.get('offset', 0),
+            final=json_data.get('final', False),
+            recipient=json_data.get('recipient', "")
+        )
+
+    def to_bytes(self) -> bytes:
+        key: bytes = self.key.encode('ascii')
+        transfer_id: bytes = self.transfer_id.encode('ascii')
+        recipient: bytes = self.recipient.encode('utf-8')
+        flags: int = (self.FLAG_FILE if self.is_file else 0) | (self.FLAG_FINAL if self.final else 0)
+        parts: List[bytes] = [
+            self.BINARY_HEADER.pack(
+                self.BINARY_VERSION, flags, 0, len(self.path), len(key), len(transfer_id), len(recipient),
+                len(self.message), len(self.binary), self.offset
+            ),
+            transfer_id,
+            recipient,
+            key,
+            struct.pack(f"!{len(self.path)}I", *self.path)
+        ]
+        parts.append(self.message)
+        parts.append(self.binary)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        view: memoryview = memoryview(data)
+        version, flags, hop, path_count, key_length, transfer_length, recipient_length, message_length, \
+            binary_length, offset = cls.BINARY_HEADER.unpack_from(view)
+        if version != cls.BINARY_VERSION:
+            raise ValueError(f"Unsupported DataMessage encoding version {version}")
+        position: int = cls.BINARY_HEADER.size
+
+        transfer_id: str = str(view[position:position + transfer_length], 'ascii')
+        position += transfer_length
+        recipient: str = str(view[position:position + recipient_length], 'utf-8')
+        position += recipient_length
+        key: str = str(view[position:position + key_length], 'ascii')
+        position += key_length
+
+        path: List[int] = list(struct.unpack_from(f"!{path_count}I", view, position))[hop:]
+        position += path_count * cls.BINARY_NODE_ID.size
+
+        message: bytes = bytes(view[position:position + message_length])
+        position += message_length
+        binary: bytes = bytes(view[position:position + binary_length])
+        return cls(
+            message=message,
+            path=path,
+            key=key,
+            is_file=bool(flags & cls.FLAG_FILE),
+            binary=binary,
+            transfer_id=transfer_id,
+            offset=offset,
+            final=bool(flags & cls.FLAG_FINAL),
+            recipient=recipient
         )
 
 
-def store_route(name: str, routes: NodeRoutes):
-    filename: str = f"routes_{name}.json"
-    file_path: str = os.path.join(ROOT_DIR, "routes", filename)
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "w") as f:
-        json.dump(routes.__dict__(), f, indent=4)
+class MessageFrame:
+    """
+    A binary DataMessage as received, with only its routing header parsed.
+    Routers on the path forward it by rewriting the hop in a copy of the header and passing
+    the rest through as a memoryview; only the destination decodes the body, with to_message.
+    """
+    __slots__ = ("payload", "flags", "hop", "path")
+
+    def __init__(self, payload: Union[bytes, memoryview]):
+        self.payload: memoryview = memoryview(payload)
+        version, flags, hop, path_count, key_length, transfer_length, recipient_length = \
+            DataMessage.BINARY_HEADER.unpack_from(self.payload)[:7]
+        if version != DataMessage.BINARY_VERSION:
+            raise ValueError(f"Unsupported DataMessage encoding version {version}")
+        position: int = DataMessage.BINARY_HEADER.size + transfer_length + recipient_length + key_length
+        self.flags: int = flags
+        self.hop: int = hop
+        # Every node of the route, including the ones already visited
+        self.path: Tuple[int, ...] = struct.unpack_from(f"!{path_count}I", self.payload, position)
+
+    def __len__(self) -> int:
+        return len(self.payload)
+
+    @property
+    def is_file(self) -> bool:
+        return bool(self.flags & DataMessage.FLAG_FILE)
 
+    def is_current_node(self, node_id: int) -> bool:
+        return self.hop < len(self.path) and self.path[self.hop] == node_id
 
-def read_route_for(name: str, destination: str):
-    filename: str = f"routes_{name}.json"
-    file_path: str = os.path.join(ROOT_DIR, "routes", filename)
+    def is_destine(self, node_id: int) -> bool:
+        return self.hop < len(self.path) and self.path[-1] == node_id
 
-    # Check if the file exists
-    if not os.path.exists(file_path):
-        debug_warning(f"DATA.PY for node: {name}",
-                      f"Route file not found for {name}")
-        return None
+    def next_hop(self) -> Optional[int]:
+        return self.path[self.hop + 1] if self.hop + 1 < len(self.path) else None
 
-    # Read and parse the JSON file
-    with open(file_path, "r") as f:
-        data = json.load(f)
-        node_routes: NodeRoutes = NodeRoutes.from_json(data)
+    def forwarded(self) -> List:
+        """ The payload for the next hop: a rewritten header and the untouched rest of this one. """
+        header: bytearray = bytearray(self.payload[:DataMessage.BINARY_HEADER.size])
+        DataMessage.BINARY_HOP.pack_into(header, DataMessage.BINARY_HOP_OFFSET, self.hop + 1)
+        return [bytes(header), self.payload[DataMessage.BINARY_HEADER.size:]]
 
-    # Find the specific route to the given destination
-    route: DataRoute = next((route for route in node_routes.routes if route.destination.name == destination), None)
-    return route
+    def to_message(self) -> DataMessage:
+        return DataMessage.from_bytes(self.payload)
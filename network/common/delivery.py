@@ -0,0 +1,173 @@
+"""
+Delivery of the messages that reach their destination router to its clients.
+
+A client registers the recipients it receives for on its connection, and the
+router keeps an index from each recipient to those connections, so a message is
+only written to the connections of its recipient. Messages without a recipient
+go to the connections that registered none, as every client received them before
+identities existed. Each connection has a bounded queue and a writer thread, so a
+slow client delays neither the reader that decrypted the message nor the other
+clients; deliveries to a connection whose queue is full are dropped.
+"""
+import socket
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from network.common.links import Address
+from network.common.metrics import Metrics
+from network.common.outbound import FrameQueue, PRIORITY_CONTROL, merge_stats
+from network.common.utils import debug_exception
+
+# Frames and bytes waiting for one client before its deliveries are dropped
+MAX_DELIVERY_FRAMES = 4096
+MAX_DELIVERY_BYTES = 16 * 1024 * 1024
+
+Writer = Callable[[socket.socket, Address, bytes], None]
+
+
+class RecipientIndex:
+    """ Recipients registered by the client connections of a router. Not thread safe, its owner serializes access. """
+
+    def __init__(self):
+        self.connections: Dict[str, Set[Address]] = {}
+        self.registered: Dict[Address, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def register(self, address: Address, recipients: Iterable[str]) -> Set[str]:
+        """ Add recipients to a connection, returns every recipient it has. """
+        names: Set[str] = self.registered.setdefault(address, set())
+        for recipient in recipients:
+            names.add(recipient)
+            self.connections.setdefault(recipient, set()).add(address)
+        return names
+
+    def unregister(self, address: Address, recipients: Optional[Iterable[str]] = None) -> Set[str]:
+        """ Remove recipients from a connection, all of them when None. Returns those it keeps. """
+        names: Set[str] = self.registered.get(address, set())
+        for recipient in list(names) if recipients is None else recipients:
+            names.discard(recipient)
+            addresses: Set[Address] = self.connections.get(recipient, set())
+            addresses.discard(address)
+            if not addresses:
+                self.connections.pop(recipient, None)
+        if not names:
+            self.registered.pop(address, None)
+        return names
+
+    def targets(self, recipient: str, clients: Iterable[Address]) -> List[Address]:
+        """ Connections a message for recipient goes to, among the client connections open. """
+        if recipient:
+            return list(self.connections.get(recipient, ()))
+        return [address for address in clients if address not in self.registered]
+
+
+class ClientQueue:
+    """ Deliveries waiting for one client connection and the thread writing them. """
+
+    def __init__(self, address: Address, sock: socket.socket, max_frames: int, max_bytes: int):
+        self.address: Address = address
+        self.sock: socket.socket = sock
+        self.frames: FrameQueue = FrameQueue(max_frames, max_bytes)
+        self.condition = threading.Condition()
+        self.closing: bool = False
+        self.thread: Optional[threading.Thread] = None
+
+
+class Deliveries:
+    """ A bounded queue and a writer thread per client connection, started on its first delivery. """
+
+    NAME = "Delivery"
+
+    def __init__(self,
+                 write: Writer,
+                 metrics: Optional[Metrics] = None,
+                 max_frames: int = MAX_DELIVERY_FRAMES,
+                 max_bytes: int = MAX_DELIVERY_BYTES
+                 ) -> None:
+        # Writes whole frames to a client, serialized with the other writers of its connection
+        self.write: Writer = write
+        self.metrics: Optional[Metrics] = metrics
+        self.max_frames: int = max_frames
+        self.max_bytes: int = max_bytes
+
+        self.queues: Dict[Address, ClientQueue] = {}
+        self.lock = threading.Lock()
+        self.running: bool = True
+
+    def put(self, address: Address, sock: socket.socket, frame: bytes) -> bool:
+        """ Queue a frame for a client, False when its queue is full and the frame was dropped. """
+        if not self.running:
+            return False
+        with self.lock:
+            queue: Optional[ClientQueue] = self.queues.get(address)
+            if queue is None:
+                queue = self.queues[address] = ClientQueue(address, sock, self.max_frames, self.max_bytes)
+                queue.thread = threading.Thread(target=self.deliver, args=(queue,), name=f"deliver-{address[1]}",
+                                                daemon=True)
+                queue.thread.start()
+        with queue.condition:
+            if queue.frames.full() or queue.closing:
+                queue.frames.dropped += 1
+                self.count("messages_dropped", "dropped_client_queue_full")
+                return False
+            queue.frames.push(frame, len(frame), PRIORITY_CONTROL)
+            queue.condition.notify()
+        return True
+
+    def deliver(self, queue: ClientQueue) -> None:
+        while True:
+            with queue.condition:
+                while not queue.frames and self.running and not queue.closing:
+                    queue.condition.wait()
+                if not self.running or queue.closing:
+                    return
+                batch: List[bytes] = queue.frames.pop_batch()
+            try:
+                self.write(queue.sock, queue.address, b"".join(batch))
+            except OSError as ex:
+                # The reader of the connection notices it closed and removes the queue
+                with queue.condition:
+                    queue.frames.dropped += len(batch)
+                    lost: int = len(batch) + queue.frames.clear()
+                self.count("messages_dropped", "dropped_client_gone", value=lost)
+                debug_exception(self.NAME,
+                                "Failed to deliver %d messages to %s: %s", lost, queue.address, ex)
+                return
+            self.count("local_deliveries", value=len(batch))
+
+    def count(self, *names: str, value: int = 1) -> None:
+        if self.metrics is not None:
+            for name in names:
+                self.metrics.add(name, value)
+
+    def remove(self, address: Address) -> None:
+        with self.lock:
+            queue: Optional[ClientQueue] = self.queues.pop(address, None)
+        if queue is not None:
+            with queue.condition:
+                queue.closing = True
+                queue.frames.clear()
+                queue.condition.notify_all()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            queues: List[ClientQueue] = list(self.queues.values())
+        per_client: Dict[str, Dict[str, float]] = {}
+        for queue in queues:
+            with queue.condition:
+                per_client[f"{queue.address[0]}:{queue.address[1]}"] = queue.frames.stats()
+        stats: Dict = merge_stats(per_client)
+        stats["clients"] = stats.pop("next_hops")
+        return stats
+
+    def close(self) -> None:
+        self.running = False
+        with self.lock:
+            queues: List[ClientQueue] = list(self.queues.values())
+            self.queues.clear()
+        for queue in queues:
+            with queue.condition:
+                queue.frames.clear()
+                queue.condition.notify_all()
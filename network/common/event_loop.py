@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from concurrent.futures import Executor
+from typing import Optional, Set
+
+from network.common.utils import debug_exception
+
+# Pending connections the listening socket queues before they are accepted
+BACKLOG = 4096
+# Seconds stop waits for the loop to close its connections and finish its thread
+STOP_TIMEOUT = 5.0
+# Seconds connection handlers get to end on their closed connections before they are cancelled
+HANDLER_TIMEOUT = 1.0
+
+
+class EventLoopThread:
+    """
+    An asyncio event loop in its own thread, so the public methods of a server can be called from any thread.
+    Blocking work goes to executor. Subclasses set server once listening and close their connections in _stop.
+    """
+    NAME = "EventLoop"
+
+    def start_loop(self, executor: Executor) -> None:
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.executor: Executor = executor
+        self.tasks: Set[asyncio.Task] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def run(self, coroutine):
+        """ Schedule a coroutine on the loop from any thread. """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def spawn(self, coroutine) -> asyncio.Task:
+        """ Start a task on the loop and keep a reference until it finishes. Loop thread only. """
+        task: asyncio.Task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def in_executor(self, function, *args) -> asyncio.Future:
+        """ Run a blocking function in the executor. Loop thread only. """
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    def in_background(self, function, *args) -> asyncio.Future:
+        """ in_executor for work nobody awaits, its exceptions are logged instead of lost. Loop thread only. """
+        future: asyncio.Future = self.in_executor(function, *args)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _log_failure(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            debug_exception(self.NAME,
+                            "Background work failed: %r", future.exception())
+
+    def stop_loop(self) -> None:
+        """ Close everything the loop serves, then stop it and the executor. From any thread but the loop's. """
+        try:
+            self.run(self._shutdown()).result(timeout=STOP_TIMEOUT)
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            "Error stopping the event loop: %s", ex)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join(timeout=STOP_TIMEOUT)
+        if not self.loop_thread.is_alive():
+            self.loop.close()
+        self.executor.shutdown(wait=False)
+
+    async def _shutdown(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        await self._stop()
+        # Every task ends before the loop stops, none is left pending. Connection handlers end as their
+        # connections close, cancelling them makes asyncio.streams log the cancellation as an error
+        for task in list(self.tasks):
+            task.cancel()
+        tasks: Set[asyncio.Task] = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=HANDLER_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    async def _stop(self) -> None:
+        pass
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import socket
+import struct
+import time
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from network.common.data import DataMessage, MessageFrame
+from network.common.metrics import Metrics
+
+# Every frame starts with the payload length and the payload kind
+HEADER = struct.Struct("!IB")
+KIND_JSON = 0
+KIND_MESSAGE = 1
+
+# Encodings of DataMessage a connection can agree on with its hello frames
+WIRE_JSON = "json"
+WIRE_BINARY = "binary"
+WIRE_FORMATS = (WIRE_BINARY, WIRE_JSON)
+
+Message = Union[Dict, DataMessage, MessageFrame]
+# A frame to send, whole or as the buffers it is made of
+Frame = Union[bytes, List]
+
+BUFFER_SIZE = 1024 * 1024
+MAX_FRAME_SIZE = 1024 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+class SendError(OSError):
+    """ A send that failed after its first written bytes were handed to the kernel. """
+
+    def __init__(self, error: OSError, written: int):
+        super().__init__(error.errno, str(error))
+        self.written: int = written
+
+
+def encode_frame(message: Dict) -> bytes:
+    payload: bytes = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(payload), KIND_JSON) + payload
+
+
+def encode_message(data_message: DataMessage, wire_format: str = WIRE_JSON) -> bytes:
+    """ Frame a DataMessage in the encoding negotiated for the connection. """
+    if wire_format == WIRE_BINARY:
+        payload: bytes = data_message.to_bytes()
+        return HEADER.pack(len(payload), KIND_MESSAGE) + payload
+    return encode_frame(data_message.__dict__())
+
+
+def encode_forward(frame: MessageFrame) -> List:
+    """ Frame a received binary message for its next hop without copying its body. """
+    header, body = frame.forwarded()
+    return [HEADER.pack(len(header) + len(body), KIND_MESSAGE) + header, body]
+
+
+def frame_size(frame: Frame) -> int:
+    return len(frame) if isinstance(frame, bytes) else sum(len(part) for part in frame)
+
+
+def send_buffers(sock: socket.socket, frame: Frame) -> None:
+    """
+    Send a frame given as buffers with scatter/gather writes, without joining them first.
+    Raises SendError with the bytes written before the failure.
+    """
+    parts: List = [frame] if isinstance(frame, bytes) else frame
+    buffers: List[memoryview] = [memoryview(part).cast("B") for part in parts]
+    written: int = 0
+    while buffers:
+        try:
+            sent: int = sock.sendmsg(buffers)
+        except OSError as ex:
+            raise SendError(ex, written) from ex
+        written += sent
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def negotiate(offered, supported=WIRE_FORMATS) -> str:
+    """ First of the formats offered by the peer that this side supports, JSON when none is. """
+    return next((wire_format for wire_format in offered or () if wire_format in supported), WIRE_JSON)
+
+
+def decode_payload(kind: int, payload: Union[bytes, memoryview]) -> Message:
+    if kind == KIND_JSON:
+        return json.loads(bytes(payload))
+    if kind == KIND_MESSAGE:
+        # Parsed up to the routing header, the router decides whether the body needs decoding
+        return MessageFrame(payload)
+    raise FrameError(f"Unknown frame kind {kind}")
+
+
+class FrameDecoder:
+    """ Accumulates received bytes and decodes each frame once, when all of it has arrived. """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE, metrics: Optional[Metrics] = None, prefix: str = ""):
+        self.buffer: bytearray = bytearray()
+        self.max_frame_size: int = max_frame_size
+        # Bytes received and decode time are recorded under prefix when metrics are given
+        self.metrics: Optional[Metrics] = metrics
+        self.prefix: str = prefix
+
+    def feed(self, data: bytes) -> List[Message]:
+        if self.metrics is not None:
+            self.metrics.add(f"{self.prefix}bytes_in", len(data))
+
+        # Frames wholly inside data are sliced from it without a copy, only a partial frame is buffered
+        if not self.buffer:
+            view: memoryview = memoryview(data)
+            messages, consumed = self.decode(view, copy=False)
+            if consumed < len(data):
+                self.buffer += view[consumed:]
+            return messages
+
+        self.buffer += data
+        with memoryview(self.buffer) as view:
+            messages, consumed = self.decode(view, copy=True)
+        # Drop the consumed frames once per chunk instead of once per frame
+        if consumed:
+            del self.buffer[:consumed]
+        return messages
+
+    def decode(self, view: memoryview, copy: bool) -> Tuple[List[Message], int]:
+        """ Decode the whole frames at the start of view, copying their payloads when view is reused. """
+        messages: List[Message] = []
+        offset: int = 0
+        while len(view) - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(view, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds the limit of {self.max_frame_size}")
+            end: int = offset + HEADER.size + length
+            if len(view) < end:
+                break
+            payload = view[offset + HEADER.size:end]
+            if copy:
+                payload = bytes(payload)
+            if self.metrics is None:
+                messages.append(decode_payload(kind, payload))
+            else:
+                start: float = time.perf_counter()
+                messages.append(decode_payload(kind, payload))
+                self.metrics.observe(f"{self.prefix}decode_seconds", time.perf_counter() - start)
+            offset = end
+        return messages, offset
+
+
+def send_frame(sock: socket.socket, message: Dict) -> None:
+    sock.sendall(encode_frame(message))
+
+
+def recv_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    """ Read exactly size bytes, None when the connection closes first. """
+    buffer: bytearray = bytearray(size)
+    view: memoryview = memoryview(buffer)
+    received: int = 0
+    while received < size:
+        count: int = sock.recv_into(view[received:], size - received)
+        if not count:
+            return None
+        received += count
+    return bytes(buffer)
+
+
+def recv_frame(sock: socket.socket, max_frame_size: int = MAX_FRAME_SIZE) -> Optional[Message]:
+    """ Block until one whole frame arrives. Only for sockets not read through a FrameDecoder. """
+    header: Optional[bytes] = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    length, kind = HEADER.unpack(header)
+    if length > max_frame_size:
+        raise FrameError(f"Frame of {length} bytes exceeds the limit of {max_frame_size}")
+    payload: Optional[bytes] = recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return decode_payload(kind, payload)
+
+
+async def read_frame(reader: asyncio.StreamReader,
+                     max_frame_size: int = MAX_FRAME_SIZE,
+                     metrics: Optional[Metrics] = None,
+                     prefix: str = ""
+                     ) -> Optional[Message]:
+    """ Await one whole frame from a stream, None when the connection closes first. """
+    try:
+        header: bytes = await reader.readexactly(HEADER.size)
+        length, kind = HEADER.unpack(header)
+        if length > max_frame_size:
+            raise FrameError(f"Frame of {length} bytes exceeds the limit of {max_frame_size}")
+        payload: bytes = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    if metrics is None:
+        return decode_payload(kind, payload)
+
+    metrics.add(f"{prefix}bytes_in", HEADER.size + length)
+    start: float = time.perf_counter()
+    message: Message = decode_payload(kind, payload)
+    metrics.observe(f"{prefix}decode_seconds", time.perf_counter() - start)
+    return message
+
+
+def read_frames(sock: socket.socket,
+                buffer_size: int = BUFFER_SIZE,
+                metrics: Optional[Metrics] = None,
+                prefix: str = ""
+                ) -> Iterator[Message]:
+    """ Yield every message received on sock until the peer closes the connection. """
+    decoder: FrameDecoder = FrameDecoder(metrics=metrics, prefix=prefix)
+    while True:
+        data: bytes = sock.recv(buffer_size)
+        if not data:
+            return
+        yield from decoder.feed(data)
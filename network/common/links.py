@@ -0,0 +1,210 @@
+"""
+Measured link weights.
+
+Routers time the frames they send to each next hop and read the round trip time
+the kernel keeps for its connection, smoothing both per neighbor, and report them
+to the controller with their pings. The controller turns a report into a link
+cost, the time to deliver REFERENCE_BYTES over the link, and scales the configured
+weight of the edge by how that cost compares with the median of the measured
+links. Weights move only part of the way per report and are only written to the
+graph when they change by more than the hysteresis, so routes do not flap.
+"""
+import socket
+import struct
+from statistics import median
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from networkx import Graph
+
+Address = Tuple[str, int]
+Edge = Tuple[str, str]
+
+# Weight of a new sample in the smoothed estimates of a router
+LINK_SMOOTHING = 0.3
+# Frames smaller than this are not timed for throughput, sending them is mostly call overhead
+MIN_THROUGHPUT_BYTES = 64 * 1024
+# Link cost: its round trip time plus the time to send a message of this size
+REFERENCE_BYTES = 64 * 1024
+# Added to every link cost, so sub-millisecond jitter of nearby links does not move weights
+COST_FLOOR = 0.001
+# Fraction of the way to the measured weight an edge moves per report
+WEIGHT_DAMPING = 0.5
+# Relative change of an edge weight that is written to the graph and recomputes routes
+WEIGHT_HYSTERESIS = 0.2
+# Edges measured before weights follow them, the median of fewer links is no reference
+MIN_MEASURED_EDGES = 3
+# Bounds of the measured weight of an edge relative to its configured weight
+MAX_WEIGHT_FACTOR = 4.0
+
+TCP_INFO: Optional[int] = getattr(socket, "TCP_INFO", None)
+TCP_QUICKACK: Optional[int] = getattr(socket, "TCP_QUICKACK", None)
+# Offset of tcpi_rtt (microseconds) in struct tcp_info, after eight one byte fields and fifteen u32
+TCP_INFO_RTT = 68
+
+
+def tcp_rtt(sock) -> Optional[float]:
+    """ Smoothed round trip time in seconds the kernel measured from the ACKs of the data sent on sock. Linux only. """
+    if TCP_INFO is None or sock is None:
+        return None
+    try:
+        info: bytes = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_RTT + 4)
+    except OSError:
+        return None
+    if len(info) < TCP_INFO_RTT + 4:
+        return None
+    rtt, = struct.unpack_from("I", info, TCP_INFO_RTT)
+    return rtt / 1e6 if rtt else None
+
+
+def quick_ack(sock) -> None:
+    """
+    Acknowledge data from a peer right away. Answering its hello makes the kernel expect an exchange
+    and delay ACKs to piggyback them on replies that never come, which inflates the RTT the peer measures.
+    """
+    if TCP_QUICKACK is None or sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+    except OSError:
+        pass
+
+
+def smooth(current: Optional[float], sample: float, alpha: float) -> float:
+    return sample if current is None else current + alpha * (sample - current)
+
+
+class LinkEstimate:
+    """ Smoothed measurements of the link to one neighbor and the frames sent on it since the last report. """
+    __slots__ = ("address", "rtt", "throughput", "frames")
+
+    def __init__(self, address: Address):
+        self.address: Address = address
+        self.rtt: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.frames: int = 0
+
+
+class LinkMonitor:
+    """
+    RTT and throughput to each next hop of a router, from the frames it forwards.
+    Recording a send only updates floats of its link, so senders do not take a lock.
+    """
+
+    def __init__(self, smoothing: float = LINK_SMOOTHING):
+        self.smoothing: float = smoothing
+        self.links: Dict[str, LinkEstimate] = {}
+
+    def observe_send(self, name: str, address: Address, size: int, seconds: float) -> None:
+        link: Optional[LinkEstimate] = self.links.get(name)
+        if link is None or link.address != address:
+            link = self.links[name] = LinkEstimate(address)
+        link.frames += 1
+        if size >= MIN_THROUGHPUT_BYTES and seconds > 0:
+            link.throughput = smooth(link.throughput, size / seconds, self.smoothing)
+
+    def report(self, rtt_of: Callable[[Address], Optional[float]]) -> Dict[str, Dict[str, float]]:
+        """ Estimates of the links that carried frames since the last report, keyed by neighbor. """
+        report: Dict[str, Dict[str, float]] = {}
+        for name, link in list(self.links.items()):
+            if not link.frames:
+                continue
+            link.frames = 0
+            rtt: Optional[float] = rtt_of(link.address)
+            if rtt is not None:
+                link.rtt = smooth(link.rtt, rtt, self.smoothing)
+            entry: Dict[str, float] = {}
+            if link.rtt is not None:
+                entry["rtt"] = round(link.rtt, 6)
+            if link.throughput is not None:
+                entry["throughput"] = round(link.throughput)
+            if entry:
+                report[name] = entry
+        return report
+
+    def retain(self, addresses: Iterable[Address]) -> None:
+        keep = set(addresses)
+        for name in [name for name, link in self.links.items() if link.address not in keep]:
+            self.links.pop(name, None)
+
+
+class LinkWeights:
+    """ Edge weights of the controller graph following the link costs its routers report. """
+
+    def __init__(self,
+                 damping: float = WEIGHT_DAMPING,
+                 hysteresis: float = WEIGHT_HYSTERESIS,
+                 max_factor: float = MAX_WEIGHT_FACTOR,
+                 reference_bytes: int = REFERENCE_BYTES,
+                 cost_floor: float = COST_FLOOR
+                 ) -> None:
+        self.damping: float = damping
+        self.hysteresis: float = hysteresis
+        self.max_factor: float = max_factor
+        self.reference_bytes: int = reference_bytes
+        self.cost_floor: float = cost_floor
+
+        # Weight each edge was configured with, the measured weight is a factor of it
+        self.base: Dict[Edge, int] = {}
+        # Damped measured weight over the configured weight
+        self.factors: Dict[Edge, float] = {}
+        # (reporter, neighbor) -> cost in seconds, and the mean of both directions per edge
+        self.costs: Dict[Edge, float] = {}
+        self.edge_costs: Dict[Edge, float] = {}
+
+    @staticmethod
+    def edge(u: str, v: str) -> Edge:
+        return (u, v) if u <= v else (v, u)
+
+    def configure(self, u: str, v: str, w: int) -> None:
+        """ A weight set by hand replaces the configured weight and discards the measurements. """
+        self.forget(u, v)
+        self.base[self.edge(u, v)] = w
+
+    def forget(self, u: str, v: str) -> None:
+        edge: Edge = self.edge(u, v)
+        self.base.pop(edge, None)
+        self.factors.pop(edge, None)
+        self.edge_costs.pop(edge, None)
+        self.costs.pop((u, v), None)
+        self.costs.pop((v, u), None)
+
+    def forget_node(self, name: str) -> None:
+        for u, v in [edge for edge in self.base if name in edge]:
+            self.forget(u, v)
+        for u, v in [link for link in self.costs if name in link]:
+            self.forget(u, v)
+
+    def cost(self, link: Dict[str, float]) -> Optional[float]:
+        rtt: Optional[float] = link.get("rtt")
+        throughput: Optional[float] = link.get("throughput")
+        if rtt is None and not throughput:
+            return None
+        return self.cost_floor + (rtt or 0.0) + (self.reference_bytes / throughput if throughput else 0.0)
+
+    def update(self, reporter: str, links: Dict[str, Dict[str, float]], graph: Graph) -> Dict[Edge, int]:
+        """ Record a router report, returns the edges whose weight moved past the hysteresis and their new weight. """
+        measured: Dict[Edge, float] = {}
+        for neighbor, link in links.items():
+            cost: Optional[float] = self.cost(link)
+            if cost is None or not graph.has_edge(reporter, neighbor):
+                continue
+            self.costs[reporter, neighbor] = cost
+            reverse: Optional[float] = self.costs.get((neighbor, reporter))
+            edge: Edge = self.edge(reporter, neighbor)
+            measured[edge] = self.edge_costs[edge] = cost if reverse is None else (cost + reverse) / 2
+
+        changes: Dict[Edge, int] = {}
+        if not measured or len(self.edge_costs) < MIN_MEASURED_EDGES:
+            return changes
+        reference: float = median(self.edge_costs.values())
+        for edge, cost in measured.items():
+            current: int = graph.edges[edge]["weight"]
+            base: int = self.base.setdefault(edge, current)
+            target: float = min(self.max_factor, max(1 / self.max_factor, cost / reference)) if reference else 1.0
+            factor: float = self.factors.get(edge, 1.0)
+            factor += self.damping * (target - factor)
+            self.factors[edge] = factor
+            weight: int = max(1, round(base * factor))
+            if abs(weight - current) > current * self.hysteresis:
+                changes[edge] = weight
+        return changes
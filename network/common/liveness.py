@@ -0,0 +1,117 @@
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+# Seconds between router heartbeats while the controller has few routers
+HEARTBEAT_INTERVAL = 5.0
+# Heartbeat intervals without traffic before a router is considered disconnected
+MISSED_HEARTBEATS = 2
+# Heartbeats per second the controller accepts, the interval grows with the routers to stay under it
+MAX_HEARTBEAT_RATE = 500.0
+# Relative change of the interval that is announced to the routers again
+INTERVAL_HYSTERESIS = 0.25
+
+
+class LivenessTracker:
+    """
+    Last time each router was heard from, with a heap ordered by deadline so finding
+    the expired routers only touches those whose deadline has passed.
+
+    Refreshing a router only stores its time, the heap keeps one entry per router that
+    is moved forward when it is popped before its real deadline.
+    """
+
+    def __init__(self,
+                 interval: float = HEARTBEAT_INTERVAL,
+                 missed: int = MISSED_HEARTBEATS,
+                 max_rate: float = MAX_HEARTBEAT_RATE
+                 ) -> None:
+        self.base_interval: float = interval
+        self.missed: int = missed
+        self.max_rate: float = max_rate
+
+        self.last_seen: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        # Routers with an entry in the heap, a router removed and added again keeps its entry
+        self.scheduled: Set[str] = set()
+        # Interval announced to the routers, deadlines are computed from it
+        self.interval: float = interval
+        # After a shorter interval is announced, routers may still be waiting out the previous one
+        self.grace_until: float = 0.0
+        self.lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.last_seen
+
+    def __len__(self) -> int:
+        return len(self.last_seen)
+
+    @property
+    def timeout(self) -> float:
+        return self.interval * self.missed
+
+    def adaptive_interval(self) -> float:
+        """ Interval keeping the heartbeats of every tracked router under max_rate per second. """
+        return max(self.base_interval, len(self.last_seen) / self.max_rate)
+
+    def add(self, name: str, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if name not in self.scheduled:
+                heapq.heappush(self.heap, (now + self.timeout, name))
+                self.scheduled.add(name)
+            self.last_seen[name] = now
+
+    def touch(self, name: str, now: Optional[float] = None) -> Optional[float]:
+        """ Record traffic from a tracked router, returns when it was heard from before. """
+        previous: Optional[float] = self.last_seen.get(name)
+        if previous is not None:
+            self.last_seen[name] = time.monotonic() if now is None else now
+        return previous
+
+    def remove(self, name: str) -> None:
+        # Its heap entry is dropped when popped
+        with self.lock:
+            self.last_seen.pop(name, None)
+
+    def set_interval(self, interval: float) -> None:
+        with self.lock:
+            if interval < self.interval:
+                self.grace_until = time.monotonic() + self.timeout
+            self.interval = interval
+
+    def interval_changed(self) -> bool:
+        """ Switch to the adaptive interval when it moved past the hysteresis from the current one. """
+        interval: float = self.adaptive_interval()
+        if abs(interval - self.interval) <= self.interval * INTERVAL_HYSTERESIS:
+            return False
+        self.set_interval(interval)
+        return True
+
+    def next_deadline(self) -> Optional[float]:
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def expired(self, now: Optional[float] = None) -> List[str]:
+        """ Routers not heard from within the timeout, they stop being tracked. """
+        now = time.monotonic() if now is None else now
+        expired: List[str] = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, name = heapq.heappop(self.heap)
+                seen: Optional[float] = self.last_seen.get(name)
+                if seen is None:
+                    self.scheduled.discard(name)
+                    continue
+                deadline: float = max(seen + self.timeout, self.grace_until)
+                if deadline <= now:
+                    del self.last_seen[name]
+                    self.scheduled.discard(name)
+                    expired.append(name)
+                else:
+                    heapq.heappush(self.heap, (deadline, name))
+        return expired
+
+    def config(self) -> Dict:
+        return {"type": "heartbeat", "interval": self.interval, "timeout": self.timeout}
@@ -1,21 +1,61 @@
-from typing import List
-from networkx import Graph, dijkstra_path, NetworkXNoPath
+from typing import List, Dict, Optional, Tuple, Set
+from networkx import Graph, NodeNotFound, dijkstra_predecessor_and_distance
 
-from network.common.data import DataRoute, DataNode, NodeRoutes
+from network.common.data import DataRoute, DataNode, NodeRoutes, NodeDirectory, RouteTable
+
+
+# Alternate paths may cost at most this many times the shortest one
+MAX_STRETCH = 1.5
 
 
 class Network:
 
-    def __init__(self):
-        """" Initialize the network Graph """
+    def __init__(self, max_paths: int = 1, max_stretch: float = MAX_STRETCH):
+        """"
+        Initialize the network Graph. With max_paths above one, routes also carry up to
+        max_paths - 1 loop-free alternate paths costing at most max_stretch times the shortest.
+        """
         self.graph: Graph = Graph()
+        self.max_paths: int = max_paths
+        self.max_stretch: float = max_stretch
+        # Shortest path trees per source: (predecessor of each reachable node, distance to it)
+        self.trees: Dict[str, Tuple[Dict[str, str], Dict[str, int]]] = {}
+        # Node IDs that routes and messages use in place of full nodes
+        self.directory: NodeDirectory = NodeDirectory()
 
-    def add_edge(self, u: str, v: str, w: int) -> None:
-        """ Add an edge to the graph with a specified weight if the nodes and weight are valid. """
-        if isinstance(w, int) and w > 0:
-            self.graph.add_edge(u, v, weight=w)
-        else:
+    def add_edge(self, u: str, v: str, w: int) -> Set[str]:
+        """
+        Add an edge to the graph with a specified weight if the nodes and weight are valid.
+        Returns the sources whose routes may have changed.
+        """
+        if not (isinstance(w, int) and w > 0):
             print(f"Invalid weight {w}; must be a positive integer.")
+            return set()
+
+        if self.graph.has_edge(u, v) and self.graph.edges[u, v]["weight"] == w:
+            return set()
+
+        affected: Set[str] = {
+            source for source, (parents, distances) in self.trees.items()
+            if self._edge_in_tree(parents, u, v) or self._edge_shortens(distances, u, v, w)
+        }
+        self.graph.add_edge(u, v, weight=w)
+        self._invalidate(affected)
+        return self._with_alternates(affected, {u, v}) | self._uncached_sources()
+
+    def remove_edge(self, u: str, v: str) -> Set[str]:
+        """ Remove an edge from the graph. Returns the sources whose routes may have changed. """
+        if not self.graph.has_edge(u, v):
+            print(f"Edge {u} - {v} not found in the graph.")
+            return set()
+
+        affected: Set[str] = {
+            source for source, (parents, _) in self.trees.items()
+            if self._edge_in_tree(parents, u, v)
+        }
+        self.graph.remove_edge(u, v)
+        self._invalidate(affected)
+        return self._with_alternates(affected, {u, v}) | self._uncached_sources()
 
     def add_node(self, node: DataNode) -> None:
         """" Add nodes to the graph """
@@ -25,44 +65,139 @@ class Network:
             port=node.port,
             public_key=node.public_key
         )
+        self.directory.add(node)
+        # A node without edges does not change any other tree
+        self.trees.pop(node.name, None)
 
-    def remove_node(self, node: DataNode) -> None:
-        """Remove a node from the graph if it exists."""
-        if node.name in self.graph:
-            self.graph.remove_node(node.name)
-        else:
+    def remove_node(self, node: DataNode) -> Set[str]:
+        """
+        Remove a node from the graph if it exists.
+        Returns the sources whose trees routed through it and had to be recomputed.
+        """
+        if node.name not in self.graph:
             print(f"Node {node} not found in the graph.")
+            return set()
+
+        # Any child of the node in a tree has to be one of its neighbors
+        neighbors: List[str] = list(self.graph.neighbors(node.name))
+        affected: Set[str] = set()
+        for source, (parents, distances) in self.trees.items():
+            if source == node.name or any(parents.get(neighbor) == node.name for neighbor in neighbors):
+                affected.add(source)
+            else:
+                # The node is a leaf of this tree, prune it in place
+                parents.pop(node.name, None)
+                distances.pop(node.name, None)
+
+        self.graph.remove_node(node.name)
+        self.directory.remove(node.name)
+        self._invalidate(affected)
+        affected = self._with_alternates(affected, set(neighbors)) | self._uncached_sources()
+        affected.discard(node.name)
+        return affected
+
+    @staticmethod
+    def _edge_in_tree(parents: Dict[str, str], u: str, v: str) -> bool:
+        return parents.get(u) == v or parents.get(v) == u
+
+    @staticmethod
+    def _edge_shortens(distances: Dict[str, int], u: str, v: str, w: int) -> bool:
+        """ Whether an edge of weight w gives a shorter way to u or v than the current tree. """
+        infinite = float("inf")
+        du = distances.get(u, infinite)
+        dv = distances.get(v, infinite)
+        return du + w < dv or dv + w < du
+
+    def _invalidate(self, sources: Set[str]) -> None:
+        for source in sources:
+            self.trees.pop(source, None)
+
+    def _with_alternates(self, affected: Set[str], endpoints: Set[str]) -> Set[str]:
+        """
+        Alternates leave through a neighbor along its tree, so with multipath the neighbors of every
+        source whose tree changed, and the endpoints of the changed edges, may have new routes too.
+        """
+        if self.max_paths <= 1:
+            return affected
+        sources: Set[str] = set(affected)
+        for source in affected | endpoints:
+            if source in self.graph:
+                sources.add(source)
+                sources.update(self.graph.neighbors(source))
+        return sources
+
+    def _uncached_sources(self) -> Set[str]:
+        """ Sources without a tree yet, their routes are unknown so they count as changed. """
+        return {node for node in self.graph.nodes() if node not in self.trees}
 
     def get_all_nodes(self) -> List[str]:
         return self.graph.nodes()
 
+    def shortest_path_tree(self, source: str) -> Tuple[Dict[str, str], Dict[str, int]]:
+        """ Run a single Dijkstra from source and keep its predecessor tree, reusing it until the graph changes. """
+        tree = self.trees.get(source)
+        if tree is None:
+            predecessors, distances = dijkstra_predecessor_and_distance(self.graph, source)
+            # Keep the first predecessor found, the same choice dijkstra_path makes on ties
+            parents: Dict[str, str] = {node: nodes[0] for node, nodes in predecessors.items() if nodes}
+            tree = (parents, distances)
+            self.trees[source] = tree
+        return tree
+
+    def shortest_path_trees(self) -> Dict[str, Tuple[Dict[str, str], Dict[str, int]]]:
+        """ Shortest path trees for every source in the graph. """
+        return {source: self.shortest_path_tree(source) for source in self.graph.nodes()}
+
+    @staticmethod
+    def path_from_tree(parents: Dict[str, str], start: str, end: str) -> List[str]:
+        """ Walk the predecessor tree back from end to start. Empty when end is unreachable. """
+        if end != start and end not in parents:
+            return []
+        path: List[str] = [end]
+        while path[-1] != start:
+            path.append(parents[path[-1]])
+        path.reverse()
+        return path
+
     def shortest_path(self, start: str, end: str) -> list[str]:
         """Find the shortest path from start to end using Dijkstra's algorithm."""
         try:
-            return dijkstra_path(self.graph, start, end)
-        except NetworkXNoPath:
-            print(f"No path found from {start} to {end}.")
-            return []
-        except Exception as ex:
+            parents, _ = self.shortest_path_tree(start)
+        except NodeNotFound as ex:
             print(f"Error calculating path from {start} to {end}: {ex}")
             return []
 
+        path: List[str] = self.path_from_tree(parents, start, end)
+        if not path:
+            print(f"No path found from {start} to {end}.")
+        return path
+
     def node_to_datanode(self, node: str) -> DataNode:
-        """"  """
-        node_data = self.graph.nodes[node]
+        """ The directory entry of node, registering nodes only known from their edges. """
+        node_id = self.directory.id_of(node)
+        if node_id is not None and node_id in self.directory.nodes:
+            return self.directory.nodes[node_id]
 
-        return DataNode(
+        node_data = self.graph.nodes[node]
+        return self.directory.add(DataNode(
             name=node,
             ip=node_data.get("ip"),
             port=node_data.get("port"),
             public_key=node_data.get('public_key')
-        )
+        ))
 
-    def _generate_data_route(self, source: str, target: str, path: List[str]) -> DataRoute:
+    def _generate_data_route(self,
+                             source: str,
+                             target: str,
+                             path: List[str],
+                             data_nodes: Dict[str, DataNode] = None
+                             ) -> DataRoute:
         """"  """
-        paths_data = [self.node_to_datanode(node) for node in path]
-        source_data: DataNode = self.node_to_datanode(source)
-        destination_data: DataNode = self.node_to_datanode(target)
+        if data_nodes is None:
+            data_nodes = {node: self.node_to_datanode(node) for node in {source, target, *path}}
+        paths_data = [data_nodes[node] for node in path]
+        source_data: DataNode = data_nodes[source]
+        destination_data: DataNode = data_nodes[target]
 
         route_data: DataRoute = DataRoute(
             source=source_data,
@@ -72,27 +207,87 @@ class Network:
 
         return route_data
 
+    def _data_nodes(self) -> Dict[str, DataNode]:
+        """ One DataNode per graph node, shared by every route built from it. """
+        return {node: self.node_to_datanode(node) for node in self.graph.nodes()}
+
     def get_routes_all(self) -> List[NodeRoutes]:
         """ Calculate all possible routes between all pairs of nodes. """
+        data_nodes: Dict[str, DataNode] = self._data_nodes()
         all_routes = []
         for source in self.graph.nodes():
-            data: NodeRoutes = self.get_routes_for(source)
+            data: NodeRoutes = self.get_routes_for(source, data_nodes)
             all_routes.append(data)
 
         return all_routes
 
-    def get_routes_for(self, node: str) -> NodeRoutes:
+    def get_routes_for(self, node: str, data_nodes: Dict[str, DataNode] = None) -> NodeRoutes:
+        """ Build every route from node out of a single shortest path tree. """
+        if data_nodes is None:
+            data_nodes = self._data_nodes()
+
+        parents, _ = self.shortest_path_tree(node)
         all_routes = []
-        data_node: DataNode = self.node_to_datanode(node)
         for target in self.graph.nodes():
             if node != target:
-                path: List[str] = self.shortest_path(node, target)
-                route_data: DataRoute = self._generate_data_route(node, target, path)
+                path: List[str] = self.path_from_tree(parents, node, target)
+                route_data: DataRoute = self._generate_data_route(node, target, path, data_nodes)
 
                 all_routes.append(route_data)
 
         node_routes: NodeRoutes = NodeRoutes(
-            node=data_node,
+            node=data_nodes[node],
             routes=all_routes
         )
         return node_routes
+
+    def alternate_paths(self, source: str, target: str) -> List[Tuple[int, List[str]]]:
+        """
+        Up to max_paths (cost, path) pairs from source to target, the shortest first. Alternates leave
+        through another neighbor and follow its shortest path, skipping those that come back through
+        source, and cost at most max_stretch times the shortest path. Equal cost paths are kept.
+        """
+        parents, distances = self.shortest_path_tree(source)
+        if target not in distances:
+            return []
+        shortest: List[str] = self.path_from_tree(parents, source, target)
+        paths: List[Tuple[int, List[str]]] = [(distances[target], shortest)]
+        limit: float = distances[target] * self.max_stretch
+        for neighbor, data in self.graph.adj[source].items():
+            if neighbor == shortest[1]:
+                continue
+            neighbor_parents, neighbor_distances = self.shortest_path_tree(neighbor)
+            cost: Optional[int] = neighbor_distances.get(target)
+            if cost is None or cost + data["weight"] > limit:
+                continue
+            tail: List[str] = self.path_from_tree(neighbor_parents, neighbor, target)
+            if source not in tail:
+                paths.append((cost + data["weight"], [source, *tail]))
+        paths[1:] = sorted(paths[1:], key=lambda item: item[0])
+        return paths[:self.max_paths]
+
+    def route_table_for(self, node: str) -> RouteTable:
+        """ Every route from node as node ID arrays, built from its shortest path tree without route objects. """
+        ids: Dict[str, int] = {name: self.node_to_datanode(name).node_id for name in self.graph.nodes()}
+        if self.max_paths > 1:
+            return self._multipath_table_for(node, ids)
+        parents, _ = self.shortest_path_tree(node)
+        paths: Dict[int, List[int]] = {
+            ids[target]: [ids[hop] for hop in self.path_from_tree(parents, node, target)]
+            for target in self.graph.nodes() if target != node
+        }
+        return RouteTable.from_paths(paths)
+
+    def _multipath_table_for(self, node: str, ids: Dict[str, int]) -> RouteTable:
+        """ Weights are inversely proportional to path cost, so cheaper paths carry more traffic. """
+        paths: Dict[int, List[Tuple[List[int], float]]] = {}
+        for target in self.graph.nodes():
+            if target == node:
+                continue
+            alternates: List[Tuple[int, List[str]]] = self.alternate_paths(node, target)
+            if not alternates:
+                paths[ids[target]] = [([], 1.0)]
+                continue
+            shortest: int = alternates[0][0]
+            paths[ids[target]] = [([ids[hop] for hop in path], shortest / cost) for cost, path in alternates]
+        return RouteTable.from_multipaths(paths)
@@ -0,0 +1,312 @@
+"""
+Bounded send queues, one per next hop.
+
+Frames for a next hop wait in its queue until its writer takes a batch of them,
+encodes each for the connection and hands the whole batch to one sendmsg call.
+Control frames, small messages that are not file data, are taken before bulk
+frames, so they overtake the file chunks queued to the same hop; each class keeps
+its own order. A full queue blocks the thread queueing to it, so a reader stops
+reading its upstream connection until the next hop catches up, and frames are
+only dropped when the queue stays full for put_timeout seconds. While a next hop
+cannot be reached its frames stay queued, the writer waits out the pool's backoff.
+"""
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+from network.common.data import DataMessage, MessageFrame
+from network.common.framing import Frame
+from network.common.links import Address, LinkMonitor
+from network.common.metrics import Metrics
+from network.common.pool import BatchSendError, ConnectionPool, PooledConnection
+from network.common.utils import debug_exception, debug_trace, debug_warning
+
+# Frames and bytes a next hop queue holds before senders wait
+MAX_QUEUED_FRAMES = 1024
+MAX_QUEUED_BYTES = 32 * 1024 * 1024
+# Frames and bytes a writer takes per batch, a forwarded frame is two buffers of one sendmsg call
+MAX_BATCH_FRAMES = 64
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+# Seconds a sender waits for room in a full queue before dropping its frame
+PUT_TIMEOUT = 10.0
+# Messages up to this size that are not file data are control frames
+CONTROL_MAX_BYTES = 16 * 1024
+
+PRIORITY_CONTROL = 0
+PRIORITY_BULK = 1
+
+Encoder = Callable[[str], Frame]
+
+
+def message_size(message: Union[DataMessage, MessageFrame]) -> int:
+    if isinstance(message, MessageFrame):
+        return len(message)
+    return len(message.message) + len(message.binary) + len(message.key)
+
+
+def priority_of(message: Union[DataMessage, MessageFrame], size: int) -> int:
+    return PRIORITY_BULK if message.is_file or size > CONTROL_MAX_BYTES else PRIORITY_CONTROL
+
+
+class FrameQueue:
+    """ Frames waiting for one next hop, control frames first. Not thread safe, its owner serializes access. """
+
+    def __init__(self, max_frames: int = MAX_QUEUED_FRAMES, max_bytes: int = MAX_QUEUED_BYTES):
+        self.max_frames: int = max_frames
+        self.max_bytes: int = max_bytes
+        self.lanes: Tuple[Deque, Deque] = (deque(), deque())
+        self.bytes: int = 0
+
+        # Counters
+        self.queued: int = 0
+        self.sent: int = 0
+        self.batches: int = 0
+        self.dropped: int = 0
+        self.overtaken: int = 0
+        self.peak: int = 0
+
+    def __len__(self) -> int:
+        return len(self.lanes[PRIORITY_CONTROL]) + len(self.lanes[PRIORITY_BULK])
+
+    def full(self) -> bool:
+        return len(self) >= self.max_frames or self.bytes >= self.max_bytes
+
+    def push(self, item, size: int, priority: int) -> None:
+        if priority == PRIORITY_CONTROL and self.lanes[PRIORITY_BULK]:
+            self.overtaken += 1
+        self.lanes[priority].append((item, size))
+        self.bytes += size
+        self.queued += 1
+        self.peak = max(self.peak, len(self))
+
+    def pop_batch(self, max_frames: int = MAX_BATCH_FRAMES, max_bytes: int = MAX_BATCH_BYTES) -> List:
+        """ Up to max_frames items, stopping once max_bytes is reached; always at least one. """
+        batch: List = []
+        size: int = 0
+        for lane in self.lanes:
+            while lane and len(batch) < max_frames and (not batch or size + lane[0][1] <= max_bytes):
+                item, item_size = lane.popleft()
+                batch.append(item)
+                size += item_size
+        self.bytes -= size
+        self.sent += len(batch)
+        self.batches += 1
+        return batch
+
+    def clear(self) -> int:
+        count: int = len(self)
+        for lane in self.lanes:
+            lane.clear()
+        self.bytes = 0
+        self.dropped += count
+        return count
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "depth": len(self),
+            "bytes": self.bytes,
+            "peak": self.peak,
+            "queued": self.queued,
+            "sent": self.sent,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "overtaken": self.overtaken,
+            "coalescing": self.sent / self.batches if self.batches else 0.0,
+        }
+
+
+def merge_stats(queues: Dict[str, Dict[str, float]]) -> Dict:
+    """ Totals over every next hop queue along with each of them. """
+    total: Dict[str, float] = {}
+    for stats in queues.values():
+        for key, value in stats.items():
+            total[key] = max(total.get(key, 0), value) if key == "peak" else total.get(key, 0) + value
+    total["coalescing"] = total["sent"] / total["batches"] if total.get("batches") else 0.0
+    total["next_hops"] = queues
+    return total
+
+
+class NextHopQueue:
+    """ The queue of one next hop and the thread writing it. """
+
+    def __init__(self, address: Address, name: str, max_frames: int, max_bytes: int):
+        self.address: Address = address
+        self.name: str = name
+        self.frames: FrameQueue = FrameQueue(max_frames, max_bytes)
+        self.condition = threading.Condition()
+        # Set when the next hop is no longer used, the writer stops once the queue is empty
+        self.closing: bool = False
+        self.thread: Optional[threading.Thread] = None
+
+
+class OutboundQueues:
+    """ A bounded queue and a writer thread per next hop, sending over a ConnectionPool. """
+
+    NAME = "Outbound"
+
+    def __init__(self,
+                 pool: ConnectionPool,
+                 metrics: Optional[Metrics] = None,
+                 links: Optional[LinkMonitor] = None,
+                 max_frames: int = MAX_QUEUED_FRAMES,
+                 max_bytes: int = MAX_QUEUED_BYTES,
+                 put_timeout: float = PUT_TIMEOUT
+                 ) -> None:
+        self.pool: ConnectionPool = pool
+        # Batch send times, sizes and drops are recorded here and per link when given
+        self.metrics: Optional[Metrics] = metrics
+        self.links: Optional[LinkMonitor] = links
+        self.max_frames: int = max_frames
+        self.max_bytes: int = max_bytes
+        self.put_timeout: float = put_timeout
+
+        self.queues: Dict[Address, NextHopQueue] = {}
+        self.lock = threading.Lock()
+        self.running: bool = True
+
+    def queue_for(self, address: Address, name: str) -> NextHopQueue:
+        with self.lock:
+            queue: Optional[NextHopQueue] = self.queues.get(address)
+            if queue is None or queue.closing:
+                queue = self.queues[address] = NextHopQueue(address, name, self.max_frames, self.max_bytes)
+                queue.thread = threading.Thread(target=self.write, args=(queue,), name=f"send-{name}", daemon=True)
+                queue.thread.start()
+            return queue
+
+    def put(self, address: Address, name: str, encode: Encoder, size: int, priority: int) -> bool:
+        """ Queue a frame for address, waiting while its queue is full. False when it was dropped. """
+        deadline: Optional[float] = None
+        while self.running:
+            queue: NextHopQueue = self.queue_for(address, name)
+            with queue.condition:
+                if queue.frames.full() and not queue.closing:
+                    if deadline is None:
+                        self.count("queue_full_waits")
+                        deadline = time.monotonic() + self.put_timeout
+                    while queue.frames.full() and self.running and not queue.closing:
+                        remaining: float = deadline - time.monotonic()
+                        if remaining <= 0:
+                            queue.frames.dropped += 1
+                            self.count("messages_dropped", "dropped_queue_full")
+                            return False
+                        queue.condition.wait(remaining)
+                if queue.closing:
+                    # Retired by a route change, before or while waiting; its writer may be gone
+                    continue
+                if not self.running:
+                    break
+                queue.frames.push(encode, size, priority)
+                queue.condition.notify_all()
+            return True
+        return False
+
+    def write(self, queue: NextHopQueue) -> None:
+        while True:
+            with queue.condition:
+                while not queue.frames and self.running and not queue.closing:
+                    queue.condition.wait()
+                if not self.running or not queue.frames:
+                    return
+            # Connect before taking a batch, so frames stay queued while the next hop cannot be reached
+            try:
+                connection: PooledConnection = self.pool.acquire(queue.address)
+            except Exception as ex:
+                self.back_off(queue, ex)
+                continue
+            with queue.condition:
+                if not queue.frames:
+                    continue
+                batch: List[Encoder] = queue.frames.pop_batch()
+                # Wake the senders waiting for room
+                queue.condition.notify_all()
+            self.send(queue, batch, connection)
+
+    def back_off(self, queue: NextHopQueue, ex: Exception) -> None:
+        """
+        Wait until the pool connects to an unreachable next hop again, keeping its queue.
+        A full queue drops its oldest batch at each attempt, so senders are not blocked for good.
+        """
+        self.count("connect_failures")
+        with queue.condition:
+            lost: int = 0
+            if queue.closing:
+                # No longer used, nothing would retry
+                lost = queue.frames.clear()
+                self.count("dropped_unreachable", value=lost)
+            elif queue.frames.full():
+                lost = len(queue.frames.pop_batch())
+                queue.frames.dropped += lost
+                self.count("dropped_queue_full", value=lost)
+            if lost:
+                self.count("messages_dropped", value=lost)
+                queue.condition.notify_all()
+                debug_warning(self.NAME,
+                              "Dropped %d frames to %s, unreachable: %s", lost, queue.name, ex)
+            if queue.closing:
+                return
+            delay: float = max(self.pool.retry_delay(queue.address), self.pool.backoff_initial)
+            debug_trace(self.NAME,
+                        "Cannot reach %s, retrying in %.2f s: %s", queue.name, delay, ex)
+            deadline: float = time.monotonic() + delay
+            while self.running and not queue.closing:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                queue.condition.wait(remaining)
+
+    def send(self, queue: NextHopQueue, batch: List[Encoder], connection: Optional[PooledConnection] = None) -> None:
+        start: float = time.perf_counter()
+        try:
+            sent: int = self.pool.send_many(queue.address, batch, connection)
+        except Exception as ex:
+            # Frames written whole before the failure went out, only the rest is lost
+            lost: int = len(batch) - (ex.sent if isinstance(ex, BatchSendError) else 0)
+            with queue.condition:
+                queue.frames.dropped += lost
+            self.count("messages_dropped", "dropped_send_failed", value=lost)
+            debug_exception(self.NAME,
+                            "Failed to send %d of %d frames to %s: %s", lost, len(batch), queue.name, ex)
+            return
+        seconds: float = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.add("bytes_out", sent)
+            self.metrics.observe("send_seconds", seconds)
+            self.metrics.observe("send_batch_frames", len(batch))
+        if self.links is not None:
+            self.links.observe_send(queue.name, queue.address, sent, seconds)
+
+    def count(self, *names: str, value: int = 1) -> None:
+        if self.metrics is not None:
+            for name in names:
+                self.metrics.add(name, value)
+
+    def retain(self, addresses: Iterable[Address]) -> None:
+        """ Stop the writers of next hops no longer in use once they have sent what they hold. """
+        keep = set(addresses)
+        with self.lock:
+            dropped: List[NextHopQueue] = [self.queues.pop(address) for address in list(self.queues)
+                                           if address not in keep]
+        for queue in dropped:
+            with queue.condition:
+                queue.closing = True
+                queue.condition.notify_all()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            queues: List[NextHopQueue] = list(self.queues.values())
+        per_hop: Dict[str, Dict[str, float]] = {}
+        for queue in queues:
+            with queue.condition:
+                per_hop[queue.name] = queue.frames.stats()
+        return merge_stats(per_hop)
+
+    def close(self) -> None:
+        self.running = False
+        with self.lock:
+            queues: List[NextHopQueue] = list(self.queues.values())
+            self.queues.clear()
+        for queue in queues:
+            with queue.condition:
+                queue.frames.clear()
+                queue.condition.notify_all()
@@ -0,0 +1,288 @@
+import select
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from network.common.framing import WIRE_JSON, Frame, SendError, frame_size, recv_frame, send_buffers
+from network.common.links import tcp_rtt
+from network.common.metrics import Metrics
+
+Address = Tuple[str, int]
+
+# Seconds to connect to a next hop, then between attempts while it cannot be reached, doubling up to the max
+CONNECT_TIMEOUT = 5.0
+BACKOFF_INITIAL = 0.1
+BACKOFF_MAX = 5.0
+
+
+class BatchSendError(OSError):
+    """ A batch that failed after its first sent frames were written whole, the others were not sent. """
+
+    def __init__(self, message: str, sent: int):
+        super().__init__(message)
+        self.sent: int = sent
+
+
+class PooledConnection:
+    def __init__(self,
+                 address: Address,
+                 sock: socket.socket,
+                 wire_format: str = WIRE_JSON,
+                 handshake_seconds: Optional[float] = None
+                 ) -> None:
+        self.address: Address = address
+        self.sock: socket.socket = sock
+        # Encoding of DataMessage agreed with the peer
+        self.wire_format: str = wire_format
+        # Round trip of the hello frame, the RTT when the kernel does not expose its own
+        self.handshake_seconds: Optional[float] = handshake_seconds
+        self.last_used: float = time.monotonic()
+        # Serializes writers so frames from different threads never interleave
+        self.lock = threading.Lock()
+
+    def is_healthy(self) -> bool:
+        """ Peers only write their hello reply, read on connect, so a readable socket means it was closed. """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+            return self.sock.recv(1, socket.MSG_PEEK) != b""
+        except (OSError, ValueError):
+            return False
+
+    def rtt(self) -> Optional[float]:
+        rtt: Optional[float] = tcp_rtt(self.sock)
+        return self.handshake_seconds if rtt is None else rtt
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """ Long-lived connections to next hops keyed by (ip, port). """
+
+    def __init__(self,
+                 hello: bytes = b"",
+                 idle_timeout: float = 60.0,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 backoff_initial: float = BACKOFF_INITIAL,
+                 backoff_max: float = BACKOFF_MAX,
+                 metrics: Optional[Metrics] = None
+                 ) -> None:
+        # Frame sent first on every new connection, the peer answers with the wire format to use
+        self.hello: bytes = hello
+        self.idle_timeout: float = idle_timeout
+        self.connect_timeout: float = connect_timeout
+        self.backoff_initial: float = backoff_initial
+        self.backoff_max: float = backoff_max
+        # Time to connect and handshake with a next hop is recorded here when given
+        self.metrics: Optional[Metrics] = metrics
+
+        self.connections: Dict[Address, PooledConnection] = {}
+        # Address -> (time of the next connect attempt, current delay)
+        self.backoff: Dict[Address, Tuple[float, float]] = {}
+        self.last_sweep: float = time.monotonic()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.hits: int = 0
+        self.misses: int = 0
+        self.reconnects: int = 0
+        self.failures: int = 0
+        self.evictions: int = 0
+
+    def send(self, address: Address, encode: Callable[[str], Frame]) -> int:
+        """ Send the frame encode builds for the connection wire format to address, like send_many. """
+        return self.send_many(address, [encode])
+
+    def send_many(self,
+                  address: Address,
+                  encoders: List[Callable[[str], Frame]],
+                  connection: Optional[PooledConnection] = None
+                  ) -> int:
+        """
+        Send several frames to address in one gathered write, on connection when given. When the
+        connection turns out to be dead, the frames it did not take whole are sent once more on a new
+        connection; frames already written are never sent twice. Returns the bytes sent, raises
+        BatchSendError with the frames written whole when the retry fails too.
+        """
+        if connection is None:
+            connection = self.acquire(address)
+        sent: int = 0
+        sent_bytes: int = 0
+        retried: bool = False
+        while True:
+            frames: List[Frame] = [encode(connection.wire_format) for encode in encoders[sent:]]
+            try:
+                with connection.lock:
+                    send_buffers(connection.sock, [part for frame in frames for part in self.buffers(frame)])
+                break
+            except SendError as ex:
+                self.discard(address, connection)
+                whole, whole_bytes = self.whole_frames(frames, ex.written)
+                sent += whole
+                sent_bytes += whole_bytes
+                if retried:
+                    raise BatchSendError(f"Sent {sent} of {len(encoders)} frames to {address}: {ex}", sent) from ex
+                retried = True
+                with self.lock:
+                    self.reconnects += 1
+                try:
+                    connection = self.acquire(address)
+                except OSError as retry_error:
+                    raise BatchSendError(
+                        f"Sent {sent} of {len(encoders)} frames to {address}: {retry_error}", sent
+                    ) from retry_error
+        connection.last_used = time.monotonic()
+        return sent_bytes + sum(frame_size(frame) for frame in frames)
+
+    @staticmethod
+    def whole_frames(frames: List[Frame], written: int) -> Tuple[int, int]:
+        """ How many of frames, and how many of their bytes, fit whole in the first written bytes. """
+        count: int = 0
+        size: int = 0
+        for frame in frames:
+            length: int = frame_size(frame)
+            if size + length > written:
+                break
+            count += 1
+            size += length
+        return count, size
+
+    @staticmethod
+    def buffers(frame: Frame) -> List:
+        return [frame] if isinstance(frame, bytes) else frame
+
+    def acquire(self, address: Address) -> PooledConnection:
+        self.evict_idle()
+        with self.lock:
+            connection: Optional[PooledConnection] = self.connections.get(address)
+            if connection and connection.is_healthy():
+                self.hits += 1
+                return connection
+
+            if connection:
+                del self.connections[address]
+                connection.close()
+                self.reconnects += 1
+            else:
+                self.misses += 1
+
+            next_attempt, _ = self.backoff.get(address, (0.0, 0.0))
+            if time.monotonic() < next_attempt:
+                raise ConnectionError(f"Backing off reconnecting to {address}")
+
+        connection = self.connect(address)
+        with self.lock:
+            current: Optional[PooledConnection] = self.connections.get(address)
+            if current is not None:
+                # Another thread connected first, keep a single connection per next hop
+                connection.close()
+                return current
+            self.connections[address] = connection
+        return connection
+
+    def connect(self, address: Address) -> PooledConnection:
+        start: float = time.perf_counter()
+        try:
+            sock: socket.socket = socket.create_connection(address, timeout=self.connect_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            handshake_start: float = time.perf_counter()
+            wire_format: str = self.handshake(sock)
+            handshake_seconds: float = time.perf_counter() - handshake_start
+            sock.settimeout(None)
+        except OSError:
+            with self.lock:
+                self.failures += 1
+                _, delay = self.backoff.get(address, (0.0, 0.0))
+                delay = min(self.backoff_max, delay * 2 if delay else self.backoff_initial)
+                self.backoff[address] = (time.monotonic() + delay, delay)
+            raise
+
+        with self.lock:
+            self.backoff.pop(address, None)
+        if self.metrics is not None:
+            self.metrics.observe("connect_seconds", time.perf_counter() - start)
+        return PooledConnection(address, sock, wire_format, handshake_seconds if self.hello else None)
+
+    def handshake(self, sock: socket.socket) -> str:
+        """ Send the hello frame and read the wire format chosen by the peer, JSON if it does not answer. """
+        if not self.hello:
+            return WIRE_JSON
+        sock.sendall(self.hello)
+        try:
+            reply = recv_frame(sock)
+        except socket.timeout:
+            return WIRE_JSON
+        if not isinstance(reply, dict):
+            return WIRE_JSON
+        return reply.get("format", WIRE_JSON)
+
+    def retry_delay(self, address: Address) -> float:
+        """ Seconds until a connection to address is attempted again, 0 when it is not backing off. """
+        with self.lock:
+            next_attempt, _ = self.backoff.get(address, (0.0, 0.0))
+        return max(0.0, next_attempt - time.monotonic())
+
+    def rtt(self, address: Address) -> Optional[float]:
+        """ Round trip time of the pooled connection to address, None when there is none. """
+        with self.lock:
+            connection: Optional[PooledConnection] = self.connections.get(address)
+        return connection.rtt() if connection is not None else None
+
+    def discard(self, address: Address, connection: Optional[PooledConnection] = None) -> None:
+        with self.lock:
+            current: Optional[PooledConnection] = self.connections.get(address)
+            if current is not None and (connection is None or current is connection):
+                del self.connections[address]
+        if connection is not None:
+            connection.close()
+        elif current is not None:
+            current.close()
+
+    def retain(self, addresses: Iterable[Address]) -> None:
+        """ Close every connection to a next hop that is no longer in use. """
+        keep = set(addresses)
+        with self.lock:
+            dropped = [address for address in self.connections if address not in keep]
+            connections = [self.connections.pop(address) for address in dropped]
+            for address in dropped:
+                self.backoff.pop(address, None)
+            self.evictions += len(connections)
+        for connection in connections:
+            connection.close()
+
+    def evict_idle(self) -> None:
+        now: float = time.monotonic()
+        if now - self.last_sweep < self.idle_timeout / 2:
+            return
+        with self.lock:
+            self.last_sweep = now
+            idle = [address for address, connection in self.connections.items()
+                    if now - connection.last_used > self.idle_timeout]
+            connections = [self.connections.pop(address) for address in idle]
+            self.evictions += len(connections)
+        for connection in connections:
+            connection.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "connections": len(self.connections),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reconnects": self.reconnects,
+                "failures": self.failures,
+                "evictions": self.evictions,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,301 @@
+"""
+Binary, indexed route snapshots.
+
+A snapshot holds one router's table: a header, the offset of every node record,
+an open addressing hash index from destination name to route record, the node
+records and the route records (destination, then every path as its traffic
+weight and hops as node indices, the shortest path first). Lookups
+go through the memory-mapped index, so finding one route does not read the rest
+of the file. Files are replaced atomically, an open store keeps reading the
+snapshot it was opened on.
+
+    python -m network.common.route_store export <router name>
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from network.common.data import DataNode, DataRoute, NodeRoutes, ROOT_DIR
+from network.common.utils import debug_warning
+
+ROUTES_DIR: str = os.path.join(ROOT_DIR, "routes")
+NAME = "RouteStore"
+
+MAGIC = b"NRTS"
+FORMAT_VERSION = 2
+# magic, format version, flags, source node, nodes, routes, index slots, table version
+HEADER = struct.Struct("<4sHHIIIIQ")
+# hash of the destination name, offset of its route record (0 marks an empty slot)
+SLOT = struct.Struct("<II")
+OFFSET = struct.Struct("<I")
+# node id, port, name, ip and public key lengths
+NODE = struct.Struct("<IHHHH")
+# destination node, paths
+ROUTE = struct.Struct("<IH")
+# weight, hops
+PATH = struct.Struct("<dH")
+# node index of a hop
+HOP = struct.Struct("<I")
+NO_ID = 0xFFFFFFFF
+
+
+def _hash(name: bytes) -> int:
+    return zlib.crc32(name)
+
+
+def _slot_count(routes: int) -> int:
+    """ Power of two keeping the index at most half full. """
+    count: int = 1
+    while count < routes * 2:
+        count *= 2
+    return count
+
+
+def encode_route_store(routes: NodeRoutes) -> bytes:
+    nodes: List[DataNode] = []
+    indices: Dict[str, int] = {}
+
+    def index_of(node: DataNode) -> int:
+        index: Optional[int] = indices.get(node.name)
+        if index is None:
+            index = indices[node.name] = len(nodes)
+            nodes.append(node)
+        return index
+
+    source: int = index_of(routes.node)
+    records: List[Tuple[bytes, int, List[Tuple[float, List[int]]]]] = [
+        (
+            route.destination.name.encode('utf-8'),
+            index_of(route.destination),
+            [(weight, [index_of(hop) for hop in path])
+             for path, weight in zip(route.all_paths(), route.weights or [1.0])]
+        )
+        for route in routes.routes
+    ]
+
+    slot_count: int = _slot_count(len(records))
+    position: int = HEADER.size + OFFSET.size * len(nodes) + SLOT.size * slot_count
+
+    node_offsets: List[int] = []
+    node_parts: List[bytes] = []
+    for node in nodes:
+        name: bytes = node.name.encode('utf-8')
+        ip: bytes = (node.ip or "").encode('utf-8')
+        public_key: bytes = (node.public_key or "").encode('utf-8')
+        node_id: int = NO_ID if node.node_id is None else node.node_id
+        record: bytes = NODE.pack(node_id, node.port or 0, len(name), len(ip), len(public_key)) + name + ip + public_key
+        node_offsets.append(position)
+        node_parts.append(record)
+        position += len(record)
+
+    slots: List[Tuple[int, int]] = [(0, 0)] * slot_count
+    route_parts: List[bytes] = []
+    for name, destination, paths in records:
+        hashed: int = _hash(name)
+        slot: int = hashed & (slot_count - 1)
+        while slots[slot][1]:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = (hashed, position)
+        record = ROUTE.pack(destination, len(paths)) + b"".join(
+            PATH.pack(weight, len(hops)) + struct.pack(f"<{len(hops)}I", *hops) for weight, hops in paths
+        )
+        route_parts.append(record)
+        position += len(record)
+
+    return b"".join([
+        HEADER.pack(MAGIC, FORMAT_VERSION, 0, source, len(nodes), len(records), slot_count, routes.version),
+        struct.pack(f"<{len(nodes)}I", *node_offsets),
+        b"".join(SLOT.pack(hashed, offset) for hashed, offset in slots),
+        *node_parts,
+        *route_parts
+    ])
+
+
+def write_route_store(path: str, routes: NodeRoutes) -> None:
+    """ Write through a temporary file renamed over path, so readers see the old or the new snapshot whole. """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary: str = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(encode_route_store(routes))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class RouteStore:
+    """ Read-only view of a snapshot file. """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        with open(path, "rb") as f:
+            self.buffer: mmap.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.source, self.node_count, self.route_count, self.slot_count, self.version = \
+            HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.buffer.close()
+            raise ValueError(f"{path} is not a route store of version {FORMAT_VERSION}")
+        self.slots_offset: int = HEADER.size + OFFSET.size * self.node_count
+        # Node index -> DataNode, so routes read from this store share their nodes
+        self.nodes: Dict[int, DataNode] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.route_count
+
+    def close(self) -> None:
+        self.buffer.close()
+
+    def _node_record(self, index: int) -> Tuple[int, int, int, int, int, int]:
+        offset: int = OFFSET.unpack_from(self.buffer, HEADER.size + OFFSET.size * index)[0]
+        return (offset + NODE.size, *NODE.unpack_from(self.buffer, offset))
+
+    def _node_name(self, index: int) -> bytes:
+        position, _, _, name_length, _, _ = self._node_record(index)
+        return self.buffer[position:position + name_length]
+
+    def node(self, index: int) -> DataNode:
+        node: Optional[DataNode] = self.nodes.get(index)
+        if node is None:
+            position, node_id, port, name_length, ip_length, key_length = self._node_record(index)
+            name: str = self.buffer[position:position + name_length].decode('utf-8')
+            position += name_length
+            ip: str = self.buffer[position:position + ip_length].decode('utf-8')
+            position += ip_length
+            public_key: str = self.buffer[position:position + key_length].decode('utf-8')
+            node = DataNode(name, ip, port, public_key, None if node_id == NO_ID else node_id)
+            self.nodes[index] = node
+        return node
+
+    def _route(self, offset: int) -> DataRoute:
+        destination, path_count = ROUTE.unpack_from(self.buffer, offset)
+        offset += ROUTE.size
+        paths: List[List[DataNode]] = []
+        weights: List[float] = []
+        for _ in range(path_count):
+            weight, hop_count = PATH.unpack_from(self.buffer, offset)
+            hops = struct.unpack_from(f"<{hop_count}I", self.buffer, offset + PATH.size)
+            offset += PATH.size + HOP.size * hop_count
+            paths.append([self.node(hop) for hop in hops])
+            weights.append(weight)
+        # Single path routes carry no weights, as the controller sends them
+        return DataRoute(self.node(self.source), self.node(destination), paths[0], paths[1:],
+                         weights if path_count > 1 else None)
+
+    def _route_offsets(self) -> Iterator[int]:
+        for slot in range(self.slot_count):
+            _, offset = SLOT.unpack_from(self.buffer, self.slots_offset + SLOT.size * slot)
+            if offset:
+                yield offset
+
+    def get(self, destination: str) -> Optional[DataRoute]:
+        """ The route to destination, reading only its index slots and records. """
+        if not self.slot_count:
+            return None
+        name: bytes = destination.encode('utf-8')
+        hashed: int = _hash(name)
+        slot: int = hashed & (self.slot_count - 1)
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.buffer, self.slots_offset + SLOT.size * slot)
+            if not offset:
+                return None
+            if slot_hash == hashed and self._node_name(ROUTE.unpack_from(self.buffer, offset)[0]) == name:
+                return self._route(offset)
+            slot = (slot + 1) & (self.slot_count - 1)
+
+    def routes(self) -> NodeRoutes:
+        """ The whole table, routes in the order they were written. """
+        return NodeRoutes(
+            node=self.node(self.source),
+            routes=[self._route(offset) for offset in sorted(self._route_offsets())],
+            version=self.version
+        )
+
+
+def store_path(name: str) -> str:
+    return os.path.join(ROUTES_DIR, f"routes_{name}.bin")
+
+
+def json_path(name: str) -> str:
+    return os.path.join(ROUTES_DIR, f"routes_{name}.json")
+
+
+def store_route(name: str, routes: NodeRoutes):
+    write_route_store(store_path(name), routes)
+
+
+def import_json(source: str, destination: str) -> NodeRoutes:
+    """ Convert a JSON route file into a route store. """
+    with open(source, "r") as f:
+        routes: NodeRoutes = NodeRoutes.from_json(json.load(f))
+    write_route_store(destination, routes)
+    return routes
+
+
+def export_json(source: str, destination: str) -> NodeRoutes:
+    """ Write a route store as JSON, for debugging. """
+    with RouteStore(source) as store:
+        routes: NodeRoutes = store.routes()
+    with open(destination, "w") as f:
+        json.dump(routes.__dict__(), f, indent=4)
+    return routes
+
+
+def _open_store(name: str) -> Optional[RouteStore]:
+    """ The node's route store, imported from its JSON route file the first time. """
+    path: str = store_path(name)
+    if not os.path.exists(path):
+        if not os.path.exists(json_path(name)):
+            debug_warning(NAME,
+                          "Route file not found for %s", name)
+            return None
+        import_json(json_path(name), path)
+    try:
+        return RouteStore(path)
+    except ValueError as ex:
+        # Written by another format version, the controller sends the table again
+        debug_warning(NAME,
+                      "Route file of %s ignored: %s", name, ex)
+        return None
+
+
+def read_routes(name: str) -> Optional[NodeRoutes]:
+    store: Optional[RouteStore] = _open_store(name)
+    if store is None:
+        return None
+    with store:
+        return store.routes()
+
+
+def read_route_for(name: str, destination: str) -> Optional[DataRoute]:
+    store: Optional[RouteStore] = _open_store(name)
+    if store is None:
+        return None
+    with store:
+        return store.get(destination)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("name", help="router name")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        routes = export_json(store_path(args.name), json_path(args.name))
+        print(f"Exported {len(routes.routes)} routes to {json_path(args.name)}")
+    else:
+        routes = import_json(json_path(args.name), store_path(args.name))
+        print(f"Imported {len(routes.routes)} routes to {store_path(args.name)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,50 @@
 import base64
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple, Union
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+# Router key pairs: RSA-2048 wraps session keys with OAEP, X25519 with an ephemeral key agreement
+KEY_RSA = "rsa"
+KEY_X25519 = "x25519"
+KEY_TYPES = (KEY_RSA, KEY_X25519)
 
-def generate_symmetric_key() -> bytes:
-    return AESGCM.generate_key(bit_length=128)
-
+PrivateKey = Union[RSAPrivateKey, X25519PrivateKey]
+PublicKey = Union[RSAPublicKey, X25519PublicKey]
 
-def encrypt_message(message: str, key: bytes) -> str:
-    aesgcm = AESGCM(key)
-    nonce = os.urandom(12)
-    encrypted = aesgcm.encrypt(nonce, message.encode('utf-8'), None)
-    return base64.b64encode(nonce + encrypted).decode('utf-8')
+# Key generation runs here so routers can do other start up work meanwhile
+_keygen_pool: Optional[ThreadPoolExecutor] = None
+_keygen_lock = threading.Lock()
 
 
-def decrypt_message(encrypted_message: str, key: bytes) -> str:
-    encrypted_message = base64.b64decode(encrypted_message)
-    nonce = encrypted_message[:12]
-    ciphertext = encrypted_message[12:]
-    aesgcm = AESGCM(key)
-    decrypted = aesgcm.decrypt(nonce, ciphertext, None)
-    return decrypted.decode('utf-8')
+def generate_symmetric_key() -> bytes:
+    return AESGCM.generate_key(bit_length=128)
 
 
-def encrypt_file(file_data: bytes, key: bytes) -> str:
+def encrypt_bytes(data: bytes, key: bytes, associated_data: Optional[bytes] = None) -> bytes:
+    """ Raw nonce + ciphertext, for encodings that carry bytes without base64. Bound to associated_data if given. """
     aesgcm = AESGCM(key)
     nonce = os.urandom(12)
-    encrypted = aesgcm.encrypt(nonce, file_data, None)
-    return base64.b64encode(nonce + encrypted).decode('utf-8')
+    return nonce + aesgcm.encrypt(nonce, data, associated_data)
 
 
-def decrypt_file(encrypted_file: str, key: bytes) -> bytes:
-    encrypted_file = base64.b64decode(encrypted_file)
-    nonce = encrypted_file[:12]
-    ciphertext = encrypted_file[12:]
+def decrypt_bytes(encrypted: bytes, key: bytes, associated_data: Optional[bytes] = None) -> bytes:
+    """ Raises InvalidTag when the ciphertext or its associated data were altered. """
     aesgcm = AESGCM(key)
-    decrypted = aesgcm.decrypt(nonce, ciphertext, None)
-    return decrypted
+    return aesgcm.decrypt(encrypted[:12], encrypted[12:], associated_data)
 
 
 def generate_keys() -> (RSAPrivateKey, RSAPublicKey):
@@ -55,6 +57,68 @@ def generate_keys() -> (RSAPrivateKey, RSAPublicKey):
     return private_key, public_key
 
 
+def generate_key_pair(key_type: str = KEY_RSA) -> Tuple[PrivateKey, PublicKey]:
+    if key_type == KEY_X25519:
+        private_key: X25519PrivateKey = X25519PrivateKey.generate()
+        return private_key, private_key.public_key()
+    if key_type == KEY_RSA:
+        return generate_keys()
+    raise ValueError(f"Unknown key type {key_type}")
+
+
+def key_type_of(key: Union[PrivateKey, PublicKey]) -> str:
+    return KEY_X25519 if isinstance(key, (X25519PrivateKey, X25519PublicKey)) else KEY_RSA
+
+
+def save_key_private(path: str, key: PrivateKey) -> None:
+    """ Write the key readable only by its owner, through a temporary file so it is never seen half written. """
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    temporary: str = f"{path}.{os.getpid()}.tmp"
+    descriptor: int = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    os.replace(temporary, path)
+
+
+def load_key_private(path: str) -> Optional[PrivateKey]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+
+
+def load_or_generate_keys(path: Optional[str], key_type: str = KEY_RSA) -> Tuple[PrivateKey, PublicKey]:
+    """
+    The key pair persisted at path, or a new one saved there. No path means a new pair every time.
+    Raises ValueError if the key at path is of another type.
+    """
+    if path:
+        private_key: Optional[PrivateKey] = load_key_private(path)
+        if private_key is not None:
+            if key_type_of(private_key) != key_type:
+                # Replacing it would silently change the router's identity
+                raise ValueError(f"Key at {path} is {key_type_of(private_key)}, not {key_type}")
+            return private_key, private_key.public_key()
+
+    private_key, public_key = generate_key_pair(key_type)
+    if path:
+        save_key_private(path, private_key)
+    return private_key, public_key
+
+
+def load_or_generate_keys_async(path: Optional[str], key_type: str = KEY_RSA) -> Future:
+    """ load_or_generate_keys in the shared key generation pool. """
+    global _keygen_pool
+    with _keygen_lock:
+        if _keygen_pool is None:
+            _keygen_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="keygen")
+    return _keygen_pool.submit(load_or_generate_keys, path, key_type)
+
+
 def serialize_key_private(key: RSAPrivateKey) -> bytes:
     return key.private_bytes(
         encoding=serialization.Encoding.PEM,
@@ -63,7 +127,7 @@ def serialize_key_private(key: RSAPrivateKey) -> bytes:
     )
 
 
-def serialize_key_public(key: RSAPublicKey) -> str:
+def serialize_key_public(key: PublicKey) -> str:
     pem = key.public_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
@@ -71,12 +135,49 @@ def serialize_key_public(key: RSAPublicKey) -> str:
     return pem.decode('utf-8')
 
 
-def deserialize_key_public(key_str: str) -> RSAPublicKey:
+def deserialize_key_public(key_str: str) -> PublicKey:
     return serialization.load_pem_public_key(key_str.encode('utf-8'), backend=default_backend())
 
 
+@lru_cache(maxsize=1024)
+def load_key_public(key_str: str) -> PublicKey:
+    """ Parse a PEM public key once, routers keep seeing the same few keys. """
+    return deserialize_key_public(key_str)
+
+
+def _key_wrapping_key(shared_secret: bytes, ephemeral: bytes, recipient: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=16,
+        salt=None,
+        info=b"network session key" + ephemeral + recipient,
+        backend=default_backend()
+    ).derive(shared_secret)
+
+
+def _raw_key_public(key: X25519PublicKey) -> bytes:
+    return key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+
+def encrypt_symmetric_key_x25519(sym_key: bytes, public_key: X25519PublicKey) -> bytes:
+    """ Ephemeral X25519 agreement, HKDF and AES-GCM: ephemeral public key + nonce + wrapped key. """
+    ephemeral_key: X25519PrivateKey = X25519PrivateKey.generate()
+    ephemeral: bytes = _raw_key_public(ephemeral_key.public_key())
+    wrapping_key: bytes = _key_wrapping_key(ephemeral_key.exchange(public_key), ephemeral, _raw_key_public(public_key))
+    return ephemeral + encrypt_bytes(sym_key, wrapping_key)
+
+
+def decrypt_symmetric_key_x25519(enc_sym_key: bytes, private_key: X25519PrivateKey) -> bytes:
+    ephemeral: bytes = enc_sym_key[:32]
+    shared_secret: bytes = private_key.exchange(X25519PublicKey.from_public_bytes(ephemeral))
+    wrapping_key: bytes = _key_wrapping_key(shared_secret, ephemeral, _raw_key_public(private_key.public_key()))
+    return decrypt_bytes(enc_sym_key[32:], wrapping_key)
+
+
 def encrypt_symmetric_key(sym_key, public_key_str):
-    public_key = deserialize_key_public(public_key_str)
+    public_key = load_key_public(public_key_str)
+    if isinstance(public_key, X25519PublicKey):
+        return base64.b64encode(encrypt_symmetric_key_x25519(sym_key, public_key)).decode()
     encrypted_key = public_key.encrypt(
         sym_key,
         padding.OAEP(
@@ -90,6 +191,8 @@ def encrypt_symmetric_key(sym_key, public_key_str):
 
 def decrypt_symmetric_key(enc_sym_key, private_key):
     enc_sym_key = base64.b64decode(enc_sym_key.encode())
+    if isinstance(private_key, X25519PrivateKey):
+        return decrypt_symmetric_key_x25519(enc_sym_key, private_key)
     sym_key = private_key.decrypt(
         enc_sym_key,
         padding.OAEP(
@@ -99,3 +202,76 @@ def decrypt_symmetric_key(enc_sym_key, private_key):
         )
     )
     return sym_key
+
+
+class SessionKeyCache:
+    """
+    Sender side session keys: one AES key per destination, wrapped once for its public key (RSA-OAEP or X25519).
+    A key is replaced after ttl seconds, after max_messages uses or when the destination key changes.
+    """
+
+    def __init__(self, ttl: float = 600.0, max_messages: int = 100_000, max_entries: int = 1024):
+        self.ttl: float = ttl
+        self.max_messages: int = max_messages
+        self.max_entries: int = max_entries
+        # Destination -> [public key, symmetric key, wrapped key, created at, messages]
+        self.sessions: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, destination: str, public_key_str: str) -> Tuple[bytes, str]:
+        """ The symmetric key for destination and its wrapped form to send along. """
+        now: float = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(destination)
+            if session is not None and self.usable(session, public_key_str, now):
+                return self.use(destination, session)
+
+        # Wrapped outside the lock, an RSA encrypt would stall every other sender
+        sym_key: bytes = generate_symmetric_key()
+        fresh = [public_key_str, sym_key, encrypt_symmetric_key(sym_key, public_key_str), now, 0]
+        with self.lock:
+            session = self.sessions.get(destination)
+            # Another sender may have renewed it meanwhile, keep theirs so both share one session
+            if session is None or not self.usable(session, public_key_str, now):
+                session = fresh
+                self.sessions[destination] = session
+                while len(self.sessions) > self.max_entries:
+                    self.sessions.popitem(last=False)
+            return self.use(destination, session)
+
+    def usable(self, session: list, public_key_str: str, now: float) -> bool:
+        return (session[0] == public_key_str
+                and now - session[3] <= self.ttl
+                and session[4] < self.max_messages)
+
+    def use(self, destination: str, session: list) -> Tuple[bytes, str]:
+        self.sessions.move_to_end(destination)
+        session[4] += 1
+        return session[1], session[2]
+
+
+class UnwrappedKeyCache:
+    """ Receiver side: wrapped key -> symmetric key, so each session costs a single unwrap. """
+
+    def __init__(self, ttl: float = 600.0, max_entries: int = 4096):
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        # Wrapped key -> (symmetric key, first seen at)
+        self.keys: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, enc_sym_key: str, private_key: PrivateKey) -> bytes:
+        now: float = time.monotonic()
+        with self.lock:
+            entry = self.keys.get(enc_sym_key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self.keys.move_to_end(enc_sym_key)
+                return entry[0]
+
+        sym_key: bytes = decrypt_symmetric_key(enc_sym_key, private_key)
+        with self.lock:
+            self.keys[enc_sym_key] = (sym_key, now)
+            self.keys.move_to_end(enc_sym_key)
+            while len(self.keys) > self.max_entries:
+                self.keys.popitem(last=False)
+        return sym_key
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+# Plaintext bytes carried by each chunk of a streamed file
+CHUNK_SIZE = 256 * 1024
+
+
+def iter_chunks(file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, bytes, bool]]:
+    """ Yield (offset, chunk, final) reading one chunk ahead, so the last chunk is flagged as final. """
+    offset: int = 0
+    chunk: bytes = file.read(chunk_size)
+    while True:
+        next_chunk: bytes = file.read(chunk_size)
+        final: bool = not next_chunk
+        yield offset, chunk, final
+        if final:
+            return
+        offset += len(chunk)
+        chunk = next_chunk
+
+
+class IncomingFile:
+    def __init__(self, path: str):
+        self.path: str = path
+        # Opened on the first chunk, outside the receiver lock
+        self.file: Optional[BinaryIO] = None
+        # Sorted, disjoint [start, end) byte ranges written so far
+        self.ranges: List[List[int]] = []
+        # Known once the final chunk arrives
+        self.size: Optional[int] = None
+        self.last_activity: float = time.monotonic()
+        self.closed: bool = False
+        # Serializes the writes to this file, other transfers write meanwhile
+        self.lock = threading.Lock()
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def covers(self, start: int, end: int) -> bool:
+        index: int = bisect_right(self.ranges, [start, float("inf")]) - 1
+        return index >= 0 and self.ranges[index][1] >= end
+
+    def add_range(self, start: int, end: int) -> None:
+        """ Record [start, end) as written, merging it with the ranges it overlaps or touches. """
+        if start == end:
+            return
+        index: int = bisect_left(self.ranges, [start, start])
+        if index > 0 and self.ranges[index - 1][1] >= start:
+            index -= 1
+        merged: List[int] = [start, end]
+        while index < len(self.ranges) and self.ranges[index][0] <= merged[1]:
+            merged = [min(merged[0], self.ranges[index][0]), max(merged[1], self.ranges[index][1])]
+            del self.ranges[index]
+        self.ranges.insert(index, merged)
+
+    def is_complete(self) -> bool:
+        return self.size is not None and (self.size == 0 or self.ranges == [[0, self.size]])
+
+    def close(self) -> None:
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+
+
+class FileReceiver:
+    """
+    Writes streamed chunks straight to disk at their offset, so chunks may arrive in any order
+    and only the chunk being written is held in memory. Each transfer writes its own file,
+    named after its transfer id, and completes once every byte up to the final chunk is written.
+    """
+
+    def __init__(self, directory: str, idle_timeout: float = 300.0, max_completed: int = 1024):
+        self.directory: str = directory
+        self.idle_timeout: float = idle_timeout
+        self.transfers: Dict[str, IncomingFile] = {}
+        # Recently completed transfers, so a repeated chunk does not start their file over
+        self.completed: OrderedDict = OrderedDict()
+        self.max_completed: int = max_completed
+        self.lock = threading.Lock()
+
+    def path_for(self, transfer_id: str, name: str) -> str:
+        if not transfer_id.isalnum():
+            raise ValueError(f"Invalid transfer id {transfer_id!r}")
+        return os.path.join(self.directory, f"received_file_{transfer_id}_{os.path.basename(name)}")
+
+    def write(self, transfer_id: str, name: str, offset: int, data: bytes, final: bool) -> Optional[str]:
+        """
+        Store one chunk. Returns the file path once every byte of the transfer has been written.
+        Chunks already written are skipped; raises ValueError for a chunk past the end of the file.
+        """
+        self.expire()
+        with self.lock:
+            if transfer_id in self.completed:
+                return None
+            incoming: Optional[IncomingFile] = self.transfers.get(transfer_id)
+            if incoming is None:
+                incoming = IncomingFile(self.path_for(transfer_id, name))
+                self.transfers[transfer_id] = incoming
+
+        end: int = offset + len(data)
+        with incoming.lock:
+            if incoming.closed:
+                return None
+            size: Optional[int] = end if final else incoming.size
+            if offset < 0 or (final and incoming.size is not None and incoming.size != end) \
+                    or (size is not None and (end > size or (incoming.ranges and incoming.ranges[-1][1] > size))):
+                raise ValueError(f"Chunk [{offset}, {end}) does not fit transfer {transfer_id} of {size} bytes")
+
+            if not incoming.covers(offset, end):
+                if incoming.file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    incoming.file = open(incoming.path, "wb")
+                incoming.file.seek(offset)
+                incoming.file.write(data)
+                incoming.add_range(offset, end)
+            incoming.size = size
+            incoming.last_activity = time.monotonic()
+
+            if not incoming.is_complete():
+                return None
+            if incoming.file is None:
+                # An empty file
+                os.makedirs(self.directory, exist_ok=True)
+                incoming.file = open(incoming.path, "wb")
+            incoming.close()
+
+        with self.lock:
+            self.transfers.pop(transfer_id, None)
+            self.completed[transfer_id] = None
+            while len(self.completed) > self.max_completed:
+                self.completed.popitem(last=False)
+        return incoming.path
+
+    def expire(self) -> None:
+        """ Abandon transfers that stopped receiving chunks, keeping what was written. """
+        now: float = time.monotonic()
+        with self.lock:
+            stale: List[IncomingFile] = [self.transfers.pop(transfer_id) for transfer_id, incoming
+                                         in list(self.transfers.items())
+                                         if now - incoming.last_activity > self.idle_timeout]
+        for incoming in stale:
+            with incoming.lock:
+                incoming.close()
+
+    def close(self) -> None:
+        with self.lock:
+            transfers: List[IncomingFile] = list(self.transfers.values())
+            self.transfers.clear()
+        for incoming in transfers:
+            with incoming.lock:
+                incoming.close()
@@ -1,3 +1,32 @@
+"""
+Leveled logging for routers, the controller and their helpers.
+
+Records go through a queue to a background thread that formats and prints them,
+so a caller only pays for a level check when its level is disabled and for an
+enqueue when it is enabled. Pass the values of a message as arguments
+(``debug_trace(origin, "sent %d bytes", size)``) instead of formatting it, they
+are only formatted once the record is written.
+
+The level comes from the NETWORK_LOG_LEVEL environment variable (INFO by default)
+and can be changed with ``set_log_level``. The writing thread starts with the first
+enabled record, or earlier through ``setup_logging``. Per message traces of the forwarding
+and delivery paths are logged at DEBUG.
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Union
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+
 class BColors:
     HEADER = '\033[95m'
     OK_BLUE = '\033[94m'
@@ -10,13 +39,98 @@ class BColors:
     UNDERLINE = '\033[4m'
 
 
-def debug_exception(origin: str, message: str):
-    print(f"{BColors.FAIL} | {origin} | {message} {BColors.END_C}")
+class ColorFormatter(logging.Formatter):
+    COLORS = {
+        DEBUG: BColors.OK_CYAN,
+        INFO: BColors.OK_BLUE,
+        WARNING: f"{BColors.BOLD}{BColors.WARNING}",
+        ERROR: BColors.FAIL,
+    }
+
+    def format(self, record: logging.LogRecord) -> str:
+        color: str = self.COLORS.get(record.levelno, BColors.FAIL)
+        return f"{color} | {getattr(record, 'origin', record.name)} | {record.getMessage()} {BColors.END_C}"
+
+
+class StdoutHandler(logging.StreamHandler):
+    """ Writes to the current sys.stdout, so redirecting stdout also redirects the logs. """
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, _) -> None:
+        pass
+
+
+class LazyQueueHandler(QueueHandler):
+    """ Enqueue records unformatted, the listener thread formats them. """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+LOGGER = logging.getLogger("network")
+LOGGER.propagate = False
+LOG_QUEUE: queue.Queue = queue.Queue()
+
+LOGGER.addHandler(LazyQueueHandler(LOG_QUEUE))
+
+_listener: Optional[QueueListener] = None
+_listener_lock = threading.Lock()
+
+
+def setup_logging() -> None:
+    """ Start the thread that writes the queued records, once. Called on the first enabled record. """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        handler: StdoutHandler = StdoutHandler()
+        handler.setFormatter(ColorFormatter())
+        _listener = QueueListener(LOG_QUEUE, handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def set_log_level(level: Union[int, str]) -> None:
+    LOGGER.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def log_enabled(level: int) -> bool:
+    """ Guard for messages whose arguments are costly to compute. """
+    return LOGGER.isEnabledFor(level)
+
+
+def flush_logs() -> None:
+    """ Wait until every queued record has been written. """
+    if _listener is not None:
+        LOG_QUEUE.join()
+
+
+def _log(level: int, origin: str, message: str, args: tuple) -> None:
+    if LOGGER.isEnabledFor(level):
+        if _listener is None:
+            setup_logging()
+        # Built directly, looking up the caller's frame would cost more than the record
+        LOGGER.handle(LOGGER.makeRecord(LOGGER.name, level, origin, 0, message, args, None, extra={"origin": origin}))
+
+
+def debug_exception(origin: str, message: str, *args):
+    _log(ERROR, origin, message, args)
+
+
+def debug_warning(origin: str, message: str, *args):
+    _log(WARNING, origin, message, args)
+
+
+def debug_log(origin: str, message: str, *args):
+    _log(INFO, origin, message, args)
 
 
-def debug_warning(origin: str, message: str):
-    print(f"{BColors.BOLD}{BColors.WARNING} | {origin} | {message} {BColors.END_C}")
+def debug_trace(origin: str, message: str, *args):
+    _log(DEBUG, origin, message, args)
 
 
-def debug_log(origin: str, message: str):
-    print(f"{BColors.OK_BLUE} | {origin} | {message} {BColors.END_C}")
+set_log_level(os.environ.get("NETWORK_LOG_LEVEL", "INFO"))
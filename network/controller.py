@@ -1,14 +1,21 @@
-import json
 import socket
 import threading
 import time
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Set
 
-from network.common.data import DataNode, NodeRoutes
+from network.common.data import DataNode, RouteTable
+from network.common.framing import encode_frame, recv_frame, read_frames, Message
+from network.common.links import Edge, LinkWeights
+from network.common.liveness import HEARTBEAT_INTERVAL, MAX_HEARTBEAT_RATE, MISSED_HEARTBEATS, LivenessTracker
+from network.common.metrics import Metrics
 from network.common.network import Network
-from network.common.utils import debug_log, debug_exception, debug_warning
+from network.common.utils import debug_log, debug_trace, debug_exception, debug_warning
 
 BUFFER_SIZE = 1024 * 1024
+# Route tables sent but not yet acknowledged that are kept per router
+MAX_PENDING_ROUTES = 8
+# Largest frame a connection may send before it authenticates
+AUTH_MAX_FRAME_SIZE = 64 * 1024
 
 
 class Controller:
@@ -17,30 +24,57 @@ class Controller:
     def __init__(self,
                  host: str,
                  port: int,
-                 network: Network
+                 network: Network,
+                 incremental: bool = False,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 missed_heartbeats: int = MISSED_HEARTBEATS,
+                 max_heartbeat_rate: float = MAX_HEARTBEAT_RATE,
+                 link_weights: Optional[LinkWeights] = None
                  ) -> None:
         # Host and network configuration
         self.host: str = host
         self.port: int = port
         self.network: Network = network
 
+        # Push routes on every topology change, only to the routers whose routes changed
+        self.incremental: bool = incremental
+
         # Socket configuration & clients
         self.server_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.clients: Dict[DataNode, socket.socket] = {}
-        self.last_ping_times: Dict[str, float] = {}
+        # Serializes the frames sent to each router, taken before the controller lock and never while holding it
+        self.send_locks: Dict[str, threading.RLock] = {}
+
+        # Edge weights follow the link RTT and throughput routers report with their pings when set
+        self.link_weights: Optional[LinkWeights] = link_weights
+
+        # Any frame from a router keeps it alive, the interval grows with the number of routers
+        self.liveness: LivenessTracker = LivenessTracker(heartbeat_interval, missed_heartbeats, max_heartbeat_rate)
+
+        # Route versions: last sent per router, last acknowledged table and tables awaiting an ack
+        self.route_versions: Dict[str, int] = {}
+        self.acked_routes: Dict[str, RouteTable] = {}
+        self.pending_routes: Dict[str, Dict[int, RouteTable]] = {}
+        # Node directory version each router acknowledged, routes only carry node IDs
+        self.acked_directory: Dict[str, int] = {}
+
+        # Controller metrics and the last stats each router reported with its heartbeat
+        self.metrics: Metrics = Metrics()
+        self.router_stats: Dict[str, Dict] = {}
 
         # Threading Lock and Event
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
         self.running = threading.Event()
         self.running.set()
 
     def start_server(self) -> None:
         try:
-            # Start the binding and socket server.
+            # Start the binding and socket server, reusing the port of a server that just stopped.
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(5)
             debug_log(self.NAME,
-                      f"Controller started.")
+                      "Controller started.")
 
             accept_thread = threading.Thread(target=self.accept_connections)
             heartbeat_thread = threading.Thread(target=self.check_heartbeats)
@@ -51,26 +85,42 @@ class Controller:
         except Exception as ex:
             self.server_socket.close()
             debug_exception(self.NAME,
-                            f"Controller start error: {ex}")
+                            "Controller start error: %s", ex)
 
     def accept_connections(self) -> None:
         try:
             while self.running.is_set():
                 # Accept connections
                 client, address = self.server_socket.accept()
-                auth: bytes = client.recv(BUFFER_SIZE)
-                data_decoded: str = auth.decode("utf-8")
-                data_auth: Dict = json.loads(data_decoded)
-                node: DataNode = DataNode.from_json(data_auth)
+                try:
+                    data_auth: Optional[Message] = recv_frame(client, AUTH_MAX_FRAME_SIZE)
+                except Exception as ex:
+                    debug_warning(self.NAME,
+                                  "Authentication failed for %s: %s", address, ex)
+                    client.close()
+                    continue
+                if data_auth is None:
+                    client.close()
+                    continue
+                if isinstance(data_auth, dict) and data_auth.get("type") == "stats":
+                    self.answer_stats(client)
+                    continue
+                node: Optional[DataNode] = self.auth_node(data_auth)
+                if node is None:
+                    debug_warning(self.NAME,
+                                  "Invalid authentication from %s", address)
+                    client.close()
+                    continue
 
                 with self.lock:
                     self.clients[node] = client
-                    self.last_ping_times[node.name] = time.time()
+                    self.liveness.add(node.name)
 
                 self.add_node(node)
+                self.send_heartbeat_config(node)
 
                 debug_log(self.NAME,
-                          f"Connection established with {address}")
+                          "Connection established with %s", address)
 
                 client_thread = threading.Thread(target=self.handle_client, args=(client, node))
                 client_thread.start()
@@ -78,101 +128,315 @@ class Controller:
         except Exception as e:
             if self.running.is_set():
                 debug_exception(self.NAME,
-                                f"Error accepting connections: {e}")
+                                "Error accepting connections: %s", e)
+
+    @staticmethod
+    def auth_node(data_auth: Message) -> Optional[DataNode]:
+        """ The router a connection authenticates as, None when its first frame is not a DataNode. """
+        if not isinstance(data_auth, dict):
+            return None
+        try:
+            node: DataNode = DataNode.from_json(data_auth)
+        except (KeyError, TypeError):
+            return None
+        if not (isinstance(node.name, str) and node.name and isinstance(node.ip, str) and isinstance(node.port, int)
+                and isinstance(node.public_key, str)):
+            return None
+        return node
 
     def handle_client(self, client: socket.socket, node: DataNode) -> None:
         try:
-            buffer = ""
-            while self.running.is_set():
-                data: bytes = client.recv(BUFFER_SIZE)
-                if not data:
+            for message_json in read_frames(client, BUFFER_SIZE, self.metrics):
+                if not self.running.is_set():
                     break
-
-                buffer += data.decode('utf-8')
-
-                while True:
-                    try:
-                        # Try to parse the buffer as a JSON message
-                        message_json, end_index = json.JSONDecoder().raw_decode(buffer)
-                        buffer = buffer[end_index:].lstrip()
-                        self.process_message(message_json, node)
-                    except json.JSONDecodeError:
-                        # Not enough data to decode a full message
-                        break
+                self.heard_from(node, message_json)
+                self.process_message(message_json, node)
         except Exception as ex:
             if self.running.is_set():
                 debug_exception(self.NAME,
-                                f"Error handling client {node.name}: {ex}")
+                                "Error handling client %s: %s", node.name, ex)
         finally:
             self.close_client(client, node)
 
     def process_message(self, message_json: Dict, node: DataNode):
         message_type = message_json.get("type")
         if message_type == "ping":
+            # Recorded by heard_from like any other frame, only link reports need more
+            if "links" in message_json:
+                self.apply_link_report(node, message_json["links"])
+        elif message_type == "routes_ack":
+            self.ack_routes(node, message_json.get("version"), message_json.get("directory", 0))
+        elif message_type == "routes_resync":
+            debug_warning(self.NAME,
+                          "%s requested a full route table", node.name)
             with self.lock:
-                self.last_ping_times[node.name] = time.time()
+                self.acked_routes.pop(node.name, None)
+                self.acked_directory.pop(node.name, None)
+            self.send_routes(node)
         else:
-            debug_log(self.NAME,
-                      f"{node.name} sends: {message_json}")
+            debug_trace(self.NAME,
+                        "%s sends: %s", node.name, message_json)
+
+    def heard_from(self, node: DataNode, message_json: Dict) -> None:
+        """ Refresh the router deadline, pings also carry its stats. Safe without the controller lock. """
+        now: float = time.monotonic()
+        previous: Optional[float] = self.liveness.touch(node.name, now)
+        if message_json.get("type") == "ping":
+            if previous is not None:
+                self.metrics.observe("heartbeat_lag_seconds", now - previous)
+            if "stats" in message_json:
+                self.router_stats[node.name] = message_json["stats"]
+
+    def stats(self) -> Dict:
+        """ Controller metrics snapshot with the number of connected routers and known nodes. """
+        snapshot: Dict = self.metrics.snapshot()
+        with self.lock:
+            snapshot["routers"] = len(self.clients)
+        snapshot["heartbeat_interval"] = self.liveness.interval
+        snapshot["nodes"] = self.network.graph.number_of_nodes()
+        return snapshot
+
+    def stats_reply(self) -> Dict:
+        with self.lock:
+            routers: Dict[str, Dict] = dict(self.router_stats)
+        return {"type": "stats", "controller": self.stats(), "routers": routers}
+
+    def answer_stats(self, client: socket.socket) -> None:
+        """ Reply to a stats query made on a fresh connection instead of an auth, then close it. """
+        try:
+            client.sendall(encode_frame(self.stats_reply()))
+        except OSError as ex:
+            debug_warning(self.NAME,
+                          "Failed to answer stats query: %s", ex)
+        finally:
+            client.close()
 
     def check_heartbeats(self):
         while self.running.is_set():
-            current_time = time.time()
-            with self.lock:
-                for node, last_ping in list(self.last_ping_times.items()):
-                    if current_time - last_ping > 10:
-                        debug_warning(self.NAME,
-                                      f"Router {node} is considered disconnected.")
-                        self.remove_client_by_name(node)
-            time.sleep(5)
+            for node in self.liveness.expired():
+                debug_warning(self.NAME,
+                              "Router %s is considered disconnected.", node)
+                self.metrics.add("routers_timed_out")
+                self.remove_client_by_name(node)
+            time.sleep(self.heartbeat_wait())
+
+    def heartbeat_wait(self) -> float:
+        """ Seconds until the earliest deadline, never longer than an interval. """
+        deadline: Optional[float] = self.liveness.next_deadline()
+        if deadline is None:
+            return self.liveness.interval
+        return min(max(deadline - time.monotonic(), 0.05), self.liveness.interval)
+
+    def adapt_heartbeats(self) -> bool:
+        """ Announce the heartbeat interval to every router when the number of routers moved it. """
+        if not self.liveness.interval_changed():
+            return False
+        debug_log(self.NAME,
+                  "Heartbeat interval is now %.1f s for %s routers", self.liveness.interval, len(self.liveness))
+        self.broadcast(self.heartbeat_config())
+        return True
+
+    def heartbeat_config(self) -> Dict:
+        """ Heartbeat settings for the routers, asking for link reports when edge weights follow them. """
+        config: Dict = self.liveness.config()
+        config["links"] = self.link_weights is not None
+        return config
+
+    def send_heartbeat_config(self, node: DataNode) -> None:
+        """ Tell a new router the heartbeat interval, every router when it joining changed the interval. """
+        if not self.adapt_heartbeats():
+            try:
+                self.send_to(node, self.heartbeat_config())
+            except Exception as ex:
+                debug_exception(self.NAME,
+                                "Failed to send the heartbeat interval to %s: %s", node.name, ex)
+
+    def broadcast(self, message: Dict) -> None:
+        with self.lock:
+            nodes: List[DataNode] = list(self.clients.keys())
+        for node in nodes:
+            try:
+                self.send_to(node, message)
+            except Exception as ex:
+                debug_exception(self.NAME,
+                                "Failed to send to %s: %s", node.name, ex)
+
+    def apply_link_report(self, node: DataNode, links: Dict) -> None:
+        """ Re-weight the edges of a router from its link report, recomputing routes only for significant changes. """
+        if self.link_weights is None:
+            return
+        self.metrics.add("link_reports")
+        affected: Set[str] = set()
+        with self.lock:
+            changes: Dict[Edge, int] = self.link_weights.update(node.name, links, self.network.graph)
+            for (u, v), weight in changes.items():
+                debug_log(self.NAME,
+                          "Link %s - %s weight %d -> %d", u, v, self.network.graph.edges[u, v]["weight"], weight)
+                affected |= self.network.add_edge(u, v, weight)
+        if changes:
+            self.metrics.add("link_weight_changes", len(changes))
+        if affected:
+            self.update_routes(affected)
 
     def send_routes(self, node: DataNode) -> None:
+        """
+        Send the router its new table: only what changed since the version it acknowledged last,
+        or the full table when it has not acknowledged any. Routes refer to nodes by ID, the directory
+        entries the router does not have yet travel along with them.
+        """
         try:
-            routes: NodeRoutes = self.network.get_routes_for(node.name)
-            routes_json: str = json.dumps(routes.__dict__())
-            client: socket.socket = self.clients[node]
-            client.sendall(routes_json.encode('utf-8'))
+            # Tables to a router go out in version order, a slow router only holds up its own pushes
+            with self.send_lock(node):
+                message: Optional[Dict] = self.route_message(node)
+                if message is not None:
+                    self.send_to(node, message)
         except Exception as ex:
             debug_exception(self.NAME,
-                            f"Failed to send routes to {node.name}: {ex}")
+                            "Failed to send routes to %s: %s", node.name, ex)
+
+    def route_message(self, node: DataNode) -> Optional[Dict]:
+        """ The route frame for a router, recorded as pending. None when it has nothing new. """
+        with self.lock, self.metrics.timer("route_compute_seconds"):
+            table: RouteTable = self.network.route_table_for(node.name)
+            table.version = self.route_versions.get(node.name, 0) + 1
+            directory: Dict = self.network.directory.changes_since(self.acked_directory.get(node.name, 0))
+            directory_changed: bool = bool(directory["nodes"] or directory["removed"])
+
+            acked: Optional[RouteTable] = self.acked_routes.get(node.name)
+            if acked is None:
+                message: Dict = table.compact(self.network.directory.id_of(node.name))
+            else:
+                message = table.delta_since(acked)
+                unchanged: bool = not message["routes"] and not message["removed_ids"]
+                if unchanged and not directory_changed and not self.pending_routes.get(node.name):
+                    return None
+            if directory_changed or not directory["base_version"]:
+                message["directory"] = directory
+
+            self.route_versions[node.name] = table.version
+            pending = self.pending_routes.setdefault(node.name, {})
+            pending[table.version] = table
+            for version in sorted(pending)[:-MAX_PENDING_ROUTES]:
+                del pending[version]
+
+            self.metrics.add("route_updates_sent")
+            self.metrics.observe("route_update_routes", len(message["routes"]))
+            return message
+
+    def send_lock(self, node: DataNode) -> threading.RLock:
+        with self.lock:
+            return self.send_locks.setdefault(node.name, threading.RLock())
 
-    def update_routes(self):
-        for node in self.clients.keys():
-            self.send_routes(node)
+    def send_to(self, node: DataNode, message: Dict) -> None:
+        """ Write one frame to a router without the controller lock, so a stalled router blocks no one else. """
+        with self.lock:
+            client: socket.socket = self.clients[node]
+        frame: bytes = encode_frame(message)
+        with self.send_lock(node):
+            client.sendall(frame)
+        self.metrics.add("bytes_out", len(frame))
+
+    def ack_routes(self, node: DataNode, version: int, directory_version: int = 0) -> None:
+        with self.lock:
+            self.acked_directory[node.name] = max(directory_version, self.acked_directory.get(node.name, 0))
+            pending = self.pending_routes.get(node.name, {})
+            table: Optional[RouteTable] = pending.get(version)
+            if table is None:
+                return
+            self.acked_routes[node.name] = table
+            self.metrics.add("routes_acked")
+            for sent in [sent for sent in pending if sent <= version]:
+                del pending[sent]
+
+    def update_routes(self, names: Optional[Iterable[str]] = None):
+        """ Send routes to every connected router, or only to the named ones. """
+        names = None if names is None else set(names)
+        with self.lock:
+            nodes: List[DataNode] = list(self.clients.keys())
+        for node in nodes:
+            if names is None or node.name in names:
+                self.send_routes(node)
 
     def close_client(self, client: socket.socket, node: DataNode) -> None:
         with self.lock:
-            if client in self.clients.values():
-                client.close()
+            closed: bool = client in self.clients.values()
+            if closed:
+                self.close_connection(client)
                 del self.clients[node]
-                del self.last_ping_times[node.name]
-                self.close_node(node)
-            debug_warning(self.NAME,
-                          f"Connection closed with {node.name}")
+                self.send_locks.pop(node.name, None)
+                self.liveness.remove(node.name)
+                self.acked_routes.pop(node.name, None)
+                self.pending_routes.pop(node.name, None)
+                self.acked_directory.pop(node.name, None)
+                self.router_stats.pop(node.name, None)
+                self.metrics.add("routers_disconnected")
+        # Announcing the interval and the new routes writes to the other routers, outside the lock
+        if closed:
+            self.adapt_heartbeats()
+            self.close_node(node)
+        debug_warning(self.NAME,
+                      "Connection closed with %s", node.name)
+
+    @staticmethod
+    def close_connection(client: socket.socket) -> None:
+        client.close()
 
     def remove_client_by_name(self, node_name: str) -> None:
         with self.lock:
-            for node, client in list(self.clients.items()):
-                if node.name == node_name:
-                    self.close_client(client, node)
-                    break
+            found = next(((node, client) for node, client in self.clients.items() if node.name == node_name), None)
+        if found is not None:
+            self.close_client(found[1], found[0])
+
+    # Topology changes hold the lock, so route pushes never read the graph or its trees half updated
 
     def add_node(self, node: DataNode) -> None:
-        self.network.add_node(node)
+        with self.lock:
+            self.network.add_node(node)
 
     def close_node(self, node: DataNode) -> None:
-        self.network.remove_node(node)
+        with self.lock:
+            if self.link_weights is not None:
+                self.link_weights.forget_node(node.name)
+            # Only trees that routed through the node are recomputed, but every table loses it as a destination
+            self.network.remove_node(node)
         self.update_routes()
 
-    def add_edge(self, u, v, w):
-        self.network.add_edge(u, v, w)
-
-    def add_all_edges(self, edges):
-        for (u, v, w) in edges:
-            self.network.add_edge(u, v, w)
+    def add_edge(self, u, v, w) -> Set[str]:
+        with self.lock:
+            if self.link_weights is not None:
+                self.link_weights.configure(u, v, w)
+            affected: Set[str] = self.network.add_edge(u, v, w)
+        if self.incremental and affected:
+            self.update_routes(affected)
+        return affected
+
+    def remove_edge(self, u, v) -> Set[str]:
+        with self.lock:
+            if self.link_weights is not None:
+                self.link_weights.forget(u, v)
+            affected: Set[str] = self.network.remove_edge(u, v)
+        if self.incremental and affected:
+            self.update_routes(affected)
+        return affected
+
+    def add_all_edges(self, edges) -> Set[str]:
+        affected: Set[str] = set()
+        with self.lock:
+            for (u, v, w) in edges:
+                if self.link_weights is not None:
+                    self.link_weights.configure(u, v, w)
+                affected |= self.network.add_edge(u, v, w)
+        if self.incremental and affected:
+            self.update_routes(affected)
+        return affected
 
     def stop(self) -> None:
         self.running.clear()
+        # Closing alone does not wake a thread blocked in accept
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.server_socket.close()
         with self.lock:
             for client in self.clients.values():
@@ -181,7 +445,7 @@ class Controller:
                     client.close()
                 except Exception as ex:
                     debug_exception(self.NAME,
-                                    f"Error closing client socket: {ex}")
+                                    "Error closing client socket: %s", ex)
             self.clients.clear()
 
         debug_warning(self.NAME,
@@ -1,17 +1,35 @@
 import os
 import base64
-import json
 import socket
 import threading
 import time
-from typing import Dict, Tuple
-
-from network.common.data import DataNode, DataRoute, NodeRoutes, store_route, DataMessage, read_route_for, ROOT_DIR
-from network.common.security import generate_symmetric_key, encrypt_message, generate_keys, serialize_key_public, \
-    encrypt_symmetric_key, decrypt_symmetric_key, decrypt_message, encrypt_file, decrypt_file
-from network.common.utils import debug_log, debug_warning, debug_exception
+import uuid
+from concurrent.futures import Future
+from typing import Dict, List, Tuple, Optional, Set, Union
+
+from network.common.data import DataNode, DataRoute, NodeRoutes, RoutesDelta, DataMessage, MessageFrame, \
+    NodeDirectory, ROOT_DIR
+from network.common.framing import encode_frame, encode_forward, encode_message, read_frames, negotiate, \
+    Frame, FrameDecoder, Message, WIRE_BINARY, WIRE_FORMATS
+from network.common.delivery import Deliveries, RecipientIndex
+from network.common.links import Address, LinkMonitor, quick_ack
+from network.common.liveness import HEARTBEAT_INTERVAL
+from network.common.metrics import Metrics
+from network.common.outbound import OutboundQueues, message_size, priority_of, MAX_QUEUED_BYTES, MAX_QUEUED_FRAMES, \
+    PUT_TIMEOUT
+from network.common.pool import ConnectionPool
+from network.common.route_store import store_route, read_routes
+from network.common.security import generate_symmetric_key, encrypt_bytes, serialize_key_public, \
+    encrypt_symmetric_key, decrypt_bytes, SessionKeyCache, UnwrappedKeyCache, load_or_generate_keys_async, KEY_RSA, \
+    PrivateKey, PublicKey, InvalidTag
+from network.common.transfer import CHUNK_SIZE, FileReceiver, iter_chunks
+from network.common.utils import debug_log, debug_trace, debug_warning, debug_exception
 
 BUFFER_SIZE = 1024 * 1024
+# Route table versions kept as bases for the deltas sent by the controller
+ROUTE_HISTORY = 8
+# Router key pairs are persisted here, one file per router name, outside the source tree unless configured
+KEYS_DIR = os.environ.get("NETWORK_KEYS_DIR", os.path.join(os.path.expanduser("~"), ".network", "keys"))
 
 
 class Router:
@@ -20,7 +38,17 @@ class Router:
                  controller_port: int,
                  local_host: str,
                  local_port: int,
-                 name: str = "NONE"
+                 name: str = "NONE",
+                 session_keys: bool = True,
+                 session_ttl: float = 600.0,
+                 session_max_messages: int = 100_000,
+                 wire_formats: Tuple[str, ...] = WIRE_FORMATS,
+                 key_type: str = KEY_RSA,
+                 key_dir: Optional[str] = KEYS_DIR,
+                 report_stats: bool = True,
+                 max_queued_frames: int = MAX_QUEUED_FRAMES,
+                 max_queued_bytes: int = MAX_QUEUED_BYTES,
+                 put_timeout: float = PUT_TIMEOUT
                  ) -> None:
         # Name
         self.NAME = f"Router | {name}"
@@ -32,35 +60,91 @@ class Router:
         self.local_port: int = local_port
         self.name = name
 
-        # Socket client/server configuration and clients
-        self.controller_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Socket client/server configuration and clients, the sockets are opened on connect and start
+        self.controller_socket: Optional[socket.socket] = None
+        self.server_socket: Optional[socket.socket] = None
         self.clients: Dict[Tuple[str, int], socket.socket] = {}
+        # Inbound connections from other routers, kept apart from the clients that receive deliveries
+        self.peers: Dict[Tuple[str, int], socket.socket] = {}
+        # Serializes the frames written to each inbound connection
+        self.client_locks: Dict[Tuple[str, int], threading.Lock] = {}
+        # Recipients registered by each client, messages reaching this router are delivered to theirs only
+        self.recipients: RecipientIndex = RecipientIndex()
+
+        # Encodings of DataMessage this router accepts, in order of preference
+        self.wire_formats: Tuple[str, ...] = wire_formats
+
+        # Counters and latency histograms, answered to stats queries and sent along with heartbeats
+        self.metrics: Metrics = Metrics()
+        self.report_stats: bool = report_stats
+
+        # Pings are only sent after an interval without other frames to the controller, which can change it
+        self.heartbeat_interval: float = HEARTBEAT_INTERVAL
+        self.last_controller_send: float = 0.0
+        self.heartbeat_changed = threading.Event()
+
+        # RTT and throughput to each next hop, sent with the pings when the controller weighs edges by them
+        self.links: LinkMonitor = LinkMonitor()
+        self.report_links: bool = False
+
+        # Bounds of the queue of each next hop, readers wait while the queue of their next hop is full
+        self.max_queued_frames: int = max_queued_frames
+        self.max_queued_bytes: int = max_queued_bytes
+        self.put_timeout: float = put_timeout
+        self.setup_transport()
+
+        # Node IDs used by routes and messages, kept up to date by the controller
+        self.directory: NodeDirectory = NodeDirectory()
+
+        # Route table indexed by destination, warm started from the last persisted snapshot
+        self.routes_version: int = 0
+        self.routes: Dict[str, DataRoute] = self.load_routes()
+        self.routes_history: Dict[int, Dict[str, DataRoute]] = {self.routes_version: self.routes}
+
+        # Security Keys: loaded from key_dir or generated in the background, waited for only when first used
+        self.key_type: str = key_type
+        self.keys: Future = load_or_generate_keys_async(
+            os.path.join(key_dir, f"{name}.pem") if key_dir else None,
+            key_type
+        )
+        self._public_key_str: Optional[str] = None
+
+        # Session keys reuse one RSA wrapped AES key per destination instead of one per message
+        self.session_keys: Optional[SessionKeyCache] = (
+            SessionKeyCache(ttl=session_ttl, max_messages=session_max_messages) if session_keys else None
+        )
+        self.unwrapped_keys: UnwrappedKeyCache = UnwrappedKeyCache(ttl=session_ttl)
 
-        # Security Keys
-        self.private_key, self.public_key = generate_keys()
+        # Streamed files being received
+        self.file_receiver: FileReceiver = FileReceiver(os.path.join(ROOT_DIR, "received", self.name))
 
         # Threading Lock and Events
         self.lock = threading.Lock()
+        self.controller_lock = threading.Lock()
         self.running = threading.Event()
         self.running.set()
 
+    def setup_transport(self) -> None:
+        """ Connections and queues to next hops and clients, written by threads of their own. """
+        # Outbound connections to next hops, announced to the peer with a hello frame
+        self.pool: ConnectionPool = ConnectionPool(hello=encode_frame(self.hello()), metrics=self.metrics)
+        # Bounded queue and writer per next hop
+        self.outbound: OutboundQueues = OutboundQueues(
+            self.pool, self.metrics, self.links, self.max_queued_frames, self.max_queued_bytes, self.put_timeout
+        )
+        # Bounded queue and writer per client, so delivering never blocks the reader that decrypted the message
+        self.deliveries: Deliveries = Deliveries(self.write_client, self.metrics)
+
     def connect_to_controller(self) -> None:
         try:
+            self.controller_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.controller_socket.connect((self.controller_host, self.controller_port))
             debug_log(self.NAME,
-                      f"Connected to the controller {(self.controller_host, self.controller_port)}")
+                      "Connected to the controller %s", (self.controller_host, self.controller_port))
 
             # Auth the router
-            public_key = serialize_key_public(self.public_key)
-            message_auth = DataNode(
-                name=self.name,
-                ip=self.local_host,
-                port=self.local_port,
-                public_key=public_key
-            )
-            json_message = json.dumps(message_auth.__dict__())
-            self.controller_socket.sendall(json_message.encode('utf-8'))
+            message_auth: DataNode = self.data_node()
+            self.send_controller(message_auth.__dict__())
 
             routes_thread = threading.Thread(target=self.routes_checker)
             heartbeat_thread = threading.Thread(target=self.send_heartbeat)
@@ -70,86 +154,335 @@ class Router:
 
         except Exception as ex:
             debug_exception(self.NAME,
-                            f"Failed to connect to controller: {ex}")
+                            "Failed to connect to controller: %s", ex)
+
+    @property
+    def node_id(self) -> Optional[int]:
+        return self.directory.id_of(self.name)
+
+    @property
+    def private_key(self) -> PrivateKey:
+        return self.keys.result()[0]
+
+    @property
+    def public_key(self) -> PublicKey:
+        return self.keys.result()[1]
+
+    def data_node(self) -> DataNode:
+        if self._public_key_str is None:
+            self._public_key_str = serialize_key_public(self.public_key)
+        return DataNode(
+            name=self.name,
+            ip=self.local_host,
+            port=self.local_port,
+            public_key=self._public_key_str
+        )
+
+    def send_controller(self, message: Dict) -> None:
+        frame: bytes = encode_frame(message)
+        with self.controller_lock:
+            self.controller_socket.sendall(frame)
+            self.last_controller_send = time.monotonic()
+
+    def heartbeat(self) -> Dict:
+        heartbeat_message = {
+            "type": "ping",
+            "name": self.name
+        }
+        if self.report_stats:
+            heartbeat_message["stats"] = self.stats()
+        if self.report_links:
+            links: Dict = self.links.report(self.link_rtt)
+            if links:
+                heartbeat_message["links"] = links
+        return heartbeat_message
+
+    def link_rtt(self, address: Address) -> Optional[float]:
+        return self.pool.rtt(address)
+
+    def heartbeat_due(self) -> float:
+        """ Seconds until the next ping, 0 when one is due. Any frame sent to the controller defers it. """
+        return max(0.0, self.last_controller_send + self.heartbeat_interval - time.monotonic())
+
+    def apply_heartbeat_config(self, config: Dict) -> None:
+        self.heartbeat_interval = float(config["interval"])
+        self.report_links = bool(config.get("links", False))
+        # Wake the heartbeat loop, it may be waiting out a longer interval
+        self.heartbeat_changed.set()
+        debug_log(self.NAME,
+                  "Heartbeat interval set to %.1f s", self.heartbeat_interval)
 
     def send_heartbeat(self):
         while self.running.is_set():
-            try:
-                heartbeat_message = {
-                    "type": "ping",
-                    "name": self.name
-                }
-                heartbeat_json = json.dumps(heartbeat_message)
-                self.controller_socket.sendall(heartbeat_json.encode('utf-8'))
-            except Exception as ex:
-                debug_exception(self.NAME, f"Error sending heartbeat: {ex}")
-            time.sleep(5)  # Send a ping every 5 seconds
+            wait: float = self.heartbeat_due()
+            if not wait:
+                try:
+                    self.send_controller(self.heartbeat())
+                except Exception as ex:
+                    debug_exception(self.NAME, "Error sending heartbeat: %s", ex)
+                wait = self.heartbeat_interval
+            if self.heartbeat_changed.wait(wait):
+                self.heartbeat_changed.clear()
+
+    def load_routes(self) -> Dict[str, DataRoute]:
+        node_routes: Optional[NodeRoutes] = read_routes(self.name)
+        if node_routes is None:
+            return {}
+        self.routes_version = node_routes.version
+        # The snapshot keeps full nodes, seed the directory with them until the controller sends its own
+        nodes = {node.node_id: node for route in node_routes.routes for path in route.all_paths() for node in path
+                 if node.node_id}
+        self.directory.apply({
+            "base_version": 0,
+            "version": 0,
+            "nodes": [node.__dict__() for node in nodes.values()]
+        })
+        return node_routes.index()
+
+    def get_route(self, destination: str) -> Optional[DataRoute]:
+        return self.routes.get(destination)
+
+    def next_hops(self) -> Set[Tuple[str, int]]:
+        return {
+            (path[1].ip, path[1].port)
+            for route in self.routes.values() for path in route.all_paths() if len(path) > 1
+        }
+
+    def retain_next_hops(self, next_hops: Set[Tuple[str, int]]) -> None:
+        self.outbound.retain(next_hops)
+        self.pool.retain(next_hops)
+        self.links.retain(next_hops)
 
     def routes_checker(self):
-        while self.running.is_set():
-            try:
-                routes = self.controller_socket.recv(BUFFER_SIZE)
-                if routes:
-                    try:
-                        routes_decoded = routes.decode('utf-8')
-                        routes_json = json.loads(routes_decoded)
-                        store_route(self.name, NodeRoutes.from_json(routes_json))
-                    except Exception as ex:
-                        debug_warning(self.NAME,
-                                      f"Received empty route update.\nError: {ex}")
+        try:
+            for routes_json in read_frames(self.controller_socket, BUFFER_SIZE, self.metrics, "controller_"):
+                if not self.running.is_set():
+                    break
+                try:
+                    if routes_json.get("type") == "heartbeat":
+                        self.apply_heartbeat_config(routes_json)
+                    else:
+                        self.apply_routes(routes_json)
+                except Exception as ex:
+                    debug_warning(self.NAME,
+                                  "Received invalid route update.\nError: %s", ex)
+            else:
+                debug_warning(self.NAME,
+                              "Connection closed by the controller")
 
-            except Exception as ex:
+        except Exception as ex:
+            if self.running.is_set():
                 debug_exception(self.NAME,
-                                f"Error processing received routes: {ex}")
+                                "Error processing received routes: %s", ex)
+
+    def apply_routes(self, routes_json: Dict) -> None:
+        """ Apply a full table or a delta from the controller and acknowledge its version. """
+        self.metrics.add("route_updates")
+        self.metrics.observe("route_update_routes", len(routes_json.get("routes", ())))
+        with self.metrics.timer("route_apply_seconds"):
+            self._apply_routes(routes_json)
+
+    def _apply_routes(self, routes_json: Dict) -> None:
+        directory_json: Optional[Dict] = routes_json.get("directory")
+        if directory_json is not None:
+            changed = self.directory.apply(directory_json)
+            if changed is None:
+                debug_warning(self.NAME,
+                              "Directory version %s unknown, requesting it whole", directory_json['base_version'])
+                self.send_controller({"type": "routes_resync", "version": self.routes_version})
+                return
+            if changed:
+                # Routes kept as bases still hold the previous entries of the changed nodes
+                changed_ids: Set[int] = set(changed)
+                self.routes_history = {
+                    version: self.resolve_routes(routes, changed_ids) for version, routes in self.routes_history.items()
+                }
 
-    def send_message(self, destination: str, message: str, is_file: bool = False, filedata: bytes = None):
+        compact: bool = NodeRoutes.is_compact(routes_json)
+        source: DataNode = self.directory.get(self.node_id) if compact else None
+        if RoutesDelta.is_delta(routes_json):
+            base: Optional[Dict[str, DataRoute]] = self.routes_history.get(routes_json["base_version"])
+            if base is None:
+                debug_warning(self.NAME,
+                              "Route version %s unknown, requesting a full table", routes_json['base_version'])
+                self.send_controller({"type": "routes_resync", "version": self.routes_version})
+                return
+            delta: RoutesDelta = (
+                RoutesDelta.from_compact(routes_json, self.directory, source) if compact
+                else RoutesDelta.from_json(routes_json)
+            )
+            routes: Dict[str, DataRoute] = delta.apply(base)
+            version: int = delta.version
+        else:
+            node_routes: NodeRoutes = (
+                NodeRoutes.from_compact(routes_json, self.directory, source) if compact
+                else NodeRoutes.from_json(routes_json)
+            )
+            routes = node_routes.index()
+            version = node_routes.version
+            # A full table starts a new history, older versions may come from another controller session
+            self.routes_history = {}
+
+        # Swap the whole index at once so readers never see a partial table
+        self.routes = routes
+        self.routes_version = version
+        self.routes_history[version] = routes
+        for old_version in sorted(self.routes_history)[:-ROUTE_HISTORY]:
+            del self.routes_history[old_version]
+
+        # Drop connections to neighbors that are no longer a next hop
+        self.retain_next_hops(self.next_hops())
+
+        store_route(self.name, NodeRoutes(self.data_node(), list(routes.values()), version))
+        self.send_controller({"type": "routes_ack", "version": version, "directory": self.directory.version})
+
+    def resolve_routes(self, routes: Dict[str, DataRoute], changed: Set[int]) -> Dict[str, DataRoute]:
+        """ Rebuild the routes going through changed nodes from the directory, dropping those to removed ones. """
+        resolved: Dict[str, DataRoute] = {}
+        for name, route in routes.items():
+            all_paths: List[List[DataNode]] = route.all_paths()
+            if route.destination.node_id not in changed \
+                    and all(node.node_id not in changed for path in all_paths for node in path):
+                resolved[name] = route
+                continue
+            destination: Optional[DataNode] = self.directory.get(route.destination.node_id)
+            paths = [[self.directory.get(node.node_id) for node in path] for path in all_paths]
+            if destination is None or any(None in path for path in paths):
+                continue
+            resolved[name] = DataRoute(route.source, destination, paths[0], paths[1:], route.weights)
+        return resolved
+
+    def session_for(self, destination: str, flow: Optional[str] = None) -> Optional[Tuple[List[DataNode], bytes, str]]:
+        """
+        Path to destination, symmetric key and the key wrapped with the destination public key.
+        Messages of the same flow take the same path when the route has alternates.
+        """
         # Find route to destination
-        route: DataRoute = read_route_for(self.name, destination)
+        route: Optional[DataRoute] = self.get_route(destination)
         if not route:
             debug_warning(self.NAME,
-                          f"No route found to {destination}")
-            return
-
-        # Read and encode the file if it's a file
-        binary: bytes = bytes()
-        if is_file and filedata:
-            binary = base64.b64encode(filedata)
-
-        # Generate symmetric key and encrypt message
-        sym_key = generate_symmetric_key()
-        encrypted_message = encrypt_message(message, sym_key)
-
-        # Encrypt the binary data if it's a file
-        encrypted_binary = encrypt_file(binary, sym_key) if is_file else ""
+                          "No route found to %s", destination)
+            self.drop("no_route")
+            return None
+        path: List[DataNode] = route.choose(flow)
+        if len(path) < 2:
+            # The controller keeps unreachable destinations in the table with an empty path
+            debug_warning(self.NAME,
+                          "No path to %s", destination)
+            self.drop("no_route")
+            return None
 
-        # Get public key of last router and store next_node
-        next_node: DataNode = route.paths[1]
-        last_node: DataNode = route.paths[-1]
+        # Get public key of last router
+        last_node: DataNode = path[-1]
         last_router_public_key: str = last_node.public_key
 
         if not last_router_public_key:
             debug_warning(self.NAME,
-                          f"Last Router Public Key is empty for node {last_node.name}")
+                          "Last Router Public Key is empty for node %s", last_node.name)
 
-        encrypted_sym_key = encrypt_symmetric_key(sym_key, last_router_public_key)
+        # Get the symmetric key for the destination, wrapped with its public key
+        with self.metrics.timer("key_wrap_seconds"):
+            if self.session_keys is not None:
+                sym_key, encrypted_sym_key = self.session_keys.get(last_node.name, last_router_public_key)
+            else:
+                sym_key = generate_symmetric_key()
+                encrypted_sym_key = encrypt_symmetric_key(sym_key, last_router_public_key)
+        return path, sym_key, encrypted_sym_key
+
+    def send_message(self,
+                     destination: str,
+                     message: str,
+                     is_file: bool = False,
+                     filedata: bytes = None,
+                     flow: Optional[str] = None,
+                     recipient: str = "") -> bool:
+        """
+        Encrypt and queue a message to destination, for the clients registered there as recipient.
+        False when it has no route or was dropped.
+        """
+        session = self.session_for(destination, flow)
+        if session is None:
+            return False
+        path, sym_key, encrypted_sym_key = session
 
-        # Send encrypted message and encrypted symmetric key to next router
         data_message = DataMessage(
-            message=encrypted_message,
-            path=route.paths[1:],  # Remaining path
+            message=b"",
+            path=[node.node_id for node in path[1:]],  # Remaining path
             key=encrypted_sym_key,
             is_file=is_file,
-            binary=encrypted_binary
+            recipient=recipient
         )
-        self.send_message_client(data_message, next_node)
+
+        # Encrypt message and the binary data if it's a file, bound to the recipient
+        associated_data: bytes = data_message.associated_data()
+        with self.metrics.timer("aes_encrypt_seconds"):
+            data_message.message = encrypt_bytes(message.encode('utf-8'), sym_key, associated_data)
+            # Raw bytes, the encodings carry the ciphertext without base64
+            data_message.binary = encrypt_bytes(filedata or b"", sym_key, associated_data) if is_file else b""
+
+        # Send encrypted message and encrypted symmetric key to next router
+        return self.send_message_client(data_message, path[1])
+
+    def send_chunk(self,
+                   destination: str,
+                   name: str,
+                   chunk: bytes,
+                   transfer_id: str,
+                   offset: int,
+                   final: bool,
+                   recipient: str = "") -> bool:
+        """ Encrypt one chunk of a streamed file on its own and forward it right away, on the path of its file. """
+        session = self.session_for(destination, transfer_id)
+        if session is None:
+            return False
+        path, sym_key, encrypted_sym_key = session
+
+        data_message = DataMessage(
+            message=b"",
+            path=[node.node_id for node in path[1:]],  # Remaining path
+            key=encrypted_sym_key,
+            is_file=True,
+            transfer_id=transfer_id,
+            offset=offset,
+            final=final,
+            recipient=recipient
+        )
+        # The chunk and its name are bound to its recipient, transfer id, offset and final flag
+        associated_data: bytes = data_message.associated_data()
+        with self.metrics.timer("aes_encrypt_seconds"):
+            data_message.message = encrypt_bytes(name.encode('utf-8'), sym_key, associated_data)
+            data_message.binary = encrypt_bytes(chunk, sym_key, associated_data)
+        return self.send_message_client(data_message, path[1])
+
+    def send_file(self,
+                  destination: str,
+                  file_path: str,
+                  name: str = None,
+                  chunk_size: int = CHUNK_SIZE,
+                  recipient: str = "") -> Optional[str]:
+        """
+        Stream a file to destination chunk by chunk, without loading it whole. Returns the transfer id,
+        None when a chunk could not be queued, the transfer stops there.
+        """
+        transfer_id: str = uuid.uuid4().hex
+        name = name or os.path.basename(file_path)
+        with open(file_path, 'rb') as file:
+            for offset, chunk, final in iter_chunks(file, chunk_size):
+                if not self.send_chunk(destination, name, chunk, transfer_id, offset, final, recipient):
+                    debug_warning(self.NAME,
+                                  "Chunk at %d of %s to %s not sent, transfer stopped", offset, name, destination)
+                    return None
+        return transfer_id
 
     def start_server(self) -> None:
         try:
-            # Start the binding and socket server.
+            # Start the binding and socket server, reusing the port of a server that just stopped.
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.local_host, self.local_port))
             self.server_socket.listen(5)
             debug_log(self.NAME,
-                      f"Router Server started.")
+                      "Router Server started.")
 
             accept_thread = threading.Thread(target=self.accept_clients)
             accept_thread.start()
@@ -157,7 +490,7 @@ class Router:
         except Exception as ex:
             self.server_socket.close()
             debug_exception(self.NAME,
-                            f"Router Server start error: {ex}")
+                            "Router Server start error: %s", ex)
 
     def accept_clients(self):
         while self.running.is_set():
@@ -166,167 +499,394 @@ class Router:
                 with self.lock:
                     self.clients[address] = client_socket
                 debug_log(self.NAME,
-                          f"Accepted connection from {address}")
+                          "Accepted connection from %s", address)
                 client_thread = threading.Thread(target=self.read_messages, args=(client_socket, address))
                 client_thread.start()
 
             except Exception as ex:
                 if self.running.is_set():
                     debug_exception(self.NAME,
-                                    f"Error accepting clients: {ex}")
+                                    "Error accepting clients: %s", ex)
 
     def read_messages(self, client_socket: socket.socket, address: Tuple[str, int]):
+        decoder: FrameDecoder = FrameDecoder(metrics=self.metrics)
         try:
-            buffer = ""
             while self.running.is_set():
                 data: bytes = client_socket.recv(BUFFER_SIZE)
                 if not data:
                     debug_log(self.NAME,
-                              f"Connection closed by {address}")
+                              "Connection closed by %s", address)
                     break
-
-                buffer += data.decode('utf-8')
-
-                while True:
-                    try:
-                        # Try to parse the buffer as a JSON message
-                        message_json, end_index = json.JSONDecoder().raw_decode(buffer)
-                        buffer = buffer[end_index:].lstrip()
-                        self.process_message(message_json)
-                    except json.JSONDecodeError:
-                        # Not enough data to decode a full message
-                        break
+                messages: List[Message] = []
+                for message_json in decoder.feed(data):
+                    if isinstance(message_json, dict) and message_json.get("type") == "hello":
+                        self.register_peer(client_socket, address)
+                        self.write_client(client_socket, address, encode_frame(self.hello(message_json.get("formats"))))
+                        quick_ack(client_socket)
+                    elif isinstance(message_json, dict) and message_json.get("type") == "stats":
+                        self.write_client(client_socket, address,
+                                          encode_frame({"type": "stats", "name": self.name, "stats": self.stats()}))
+                    elif isinstance(message_json, dict) and message_json.get("type") in ("register", "unregister"):
+                        ack: Optional[Dict] = self.register_client(address, message_json)
+                        if ack is not None:
+                            self.write_client(client_socket, address, encode_frame(ack))
+                    else:
+                        messages.append(message_json)
+                # Client messages of one read are acknowledged together
+                ack: Optional[Dict] = self.process_messages(messages)
+                if ack is not None:
+                    self.write_client(client_socket, address, encode_frame(ack))
 
         except Exception as ex:
             if self.running.is_set():
                 debug_exception(self.NAME,
-                                f"Error Reading Messages: {ex}")
+                                "Error Reading Messages: %s", ex)
         finally:
             self.close_client(client_socket, address)
 
-    def process_message(self, message_json: Dict):
+    def process_messages(self, messages: List[Message]) -> Optional[Dict]:
+        """
+        Process messages in order. Returns the ack frame for the client messages that carried an id,
+        with the ids queued to their next hop and those that were not, None when there were none.
+        """
+        accepted: List = []
+        failed: List = []
+        for message_json in messages:
+            queued: Optional[bool] = self.process_message(message_json)
+            if isinstance(message_json, dict) and 'id' in message_json:
+                (accepted if queued else failed).append(message_json['id'])
+        if not accepted and not failed:
+            return None
+        return {"type": "ack", "ids": accepted, "failed": failed}
+
+    def register_client(self, address: Tuple[str, int], message_json: Dict) -> Optional[Dict]:
+        """ Add or remove recipients of a client connection. The ack frame for it when it carried an id. """
+        recipients: List[str] = [str(recipient) for recipient in message_json.get('recipients', ())]
+        with self.lock:
+            if message_json['type'] == "register":
+                registered = self.recipients.register(address, recipients)
+            else:
+                registered = self.recipients.unregister(address, recipients or None)
+        debug_log(self.NAME,
+                  "Client %s receives for %s", address, sorted(registered))
+        if 'id' not in message_json:
+            return None
+        return {"type": "ack", "ids": [message_json['id']], "failed": []}
+
+    def write_client(self, client: socket.socket, address: Tuple[str, int], frame: bytes) -> None:
+        """ Replies and deliveries to a connection come from different threads, written one whole frame at a time. """
+        with self.lock:
+            lock: threading.Lock = self.client_locks.setdefault(address, threading.Lock())
+        with lock:
+            client.sendall(frame)
 
-        if not DataMessage.is_message(message_json):
+    def hello(self, offered=None) -> Dict:
+        """ Hello frame offering our wire formats, or answering a peer offer with the format to use. """
+        if offered is None:
+            return {"type": "hello", "name": self.name, "formats": list(self.wire_formats)}
+        return {"type": "hello", "name": self.name, "format": negotiate(offered, self.wire_formats)}
+
+    def register_peer(self, client_socket: socket.socket, address: Tuple[str, int]) -> None:
+        with self.lock:
+            self.clients.pop(address, None)
+            self.peers[address] = client_socket
+
+    def stats(self) -> Dict:
+        """ Metrics snapshot with the transport counters and the current table size. """
+        snapshot: Dict = self.metrics.snapshot()
+        snapshot["routes"] = len(self.routes)
+        snapshot["routes_version"] = self.routes_version
+        with self.lock:
+            snapshot["recipients"] = len(self.recipients)
+        snapshot.update(self.transport_stats())
+        return snapshot
+
+    def transport_stats(self) -> Dict:
+        with self.lock:
+            clients: int = len(self.clients)
+            peers: int = len(self.peers)
+        return {
+            "clients": clients,
+            "peers": peers,
+            "pool": self.pool.stats(),
+            "queues": self.outbound.stats(),
+            "deliveries": self.deliveries.stats(),
+        }
+
+    def drop(self, reason: str) -> None:
+        self.metrics.add("messages_dropped")
+        self.metrics.add(f"dropped_{reason}")
+
+    def process_message(self, message_json: Message) -> Optional[bool]:
+        """ For a message from a client, returns whether it was queued to its next hop. """
+        self.metrics.add("messages_received")
+
+        # Binary messages are forwarded on their routing header, only the destination decodes the body
+        if isinstance(message_json, MessageFrame):
+            if not message_json.is_destine(self.node_id):
+                self.forward_frame(message_json)
+                return
+            message_json = message_json.to_message()
+
+        if not isinstance(message_json, DataMessage) and not DataMessage.is_message(message_json):
             client_destination = message_json.get('destination')
             if not client_destination:
-                return
+                return False
             client_message = message_json.get('message', "NONE")
             client_is_file = message_json.get('is_file', False)
             client_binary_encoded = message_json.get('binary', "")
 
+            # A chunk of a streamed file is forwarded as soon as it arrives
+            if message_json.get('transfer_id'):
+                return self.send_chunk(
+                    destination=client_destination,
+                    name=client_message,
+                    chunk=base64.b64decode(client_binary_encoded),
+                    transfer_id=message_json['transfer_id'],
+                    offset=message_json.get('offset', 0),
+                    final=message_json.get('final', False),
+                    recipient=message_json.get('recipient', "")
+                )
+
             if client_is_file:
                 try:
                     client_binary = base64.b64decode(client_binary_encoded)
                 except Exception as e:
-                    print(f"Failed to decode binary data: {e}")
-                    return
+                    debug_warning(self.NAME, "Failed to decode binary data: %s", e)
+                    return False
             else:
                 client_binary = bytes()
 
-            self.send_message(
+            return self.send_message(
                 destination=client_destination,
                 message=client_message,
                 is_file=client_is_file,
-                filedata=client_binary
+                filedata=client_binary,
+                flow=message_json.get('flow'),
+                recipient=message_json.get('recipient', "")
             )
-            return
 
-        data_message: DataMessage = DataMessage.from_json(message_json)
+        data_message: DataMessage = (
+            message_json if isinstance(message_json, DataMessage) else DataMessage.from_json(message_json)
+        )
 
         # If there's no exist a rute to destination return
         if len(data_message.path) < 1:
             debug_warning(self.NAME,
-                          f"No rute found! Forbidden Message {data_message.message}")
+                          "No rute found! Forbidden Message %r", data_message.message)
+            self.drop("no_path")
             return
 
         # Check if this router is the current node in the path
-        if not data_message.is_current_node(self.name):
+        node_id: Optional[int] = self.node_id
+        if not data_message.is_current_node(node_id):
             debug_warning(self.NAME,
-                          f"Forbidden Message {data_message.message}")
+                          "Forbidden Message %r", data_message.message)
+            self.drop("not_on_path")
             return
 
         # Check if this router is the final destination
-        if data_message.is_destine(self.name):
+        if data_message.is_destine(node_id):
+            self.metrics.add("messages_delivered")
             enc_message = data_message.message
             enc_sym_key = data_message.key
 
-            sym_key = decrypt_symmetric_key(enc_sym_key, self.private_key)
-            message = decrypt_message(enc_message, sym_key)
-            debug_log(self.NAME,
-                      f"Decrypted message: {message}")
+            associated_data: bytes = data_message.associated_data()
+
+            try:
+                with self.metrics.timer("key_unwrap_seconds"):
+                    sym_key = self.unwrapped_keys.get(enc_sym_key, self.private_key)
+            except (ValueError, InvalidTag):
+                # A corrupt key, or one wrapped for another router, fails this message only
+                debug_warning(self.NAME,
+                              "Message key cannot be unwrapped, dropped")
+                self.drop("invalid_key")
+                return
+            try:
+                with self.metrics.timer("aes_decrypt_seconds"):
+                    message = decrypt_bytes(enc_message, sym_key, associated_data).decode('utf-8')
+                    binary: bytes = (
+                        decrypt_bytes(data_message.binary, sym_key, associated_data) if data_message.is_file else b""
+                    )
+            except InvalidTag:
+                debug_warning(self.NAME,
+                              "Message altered on its way, dropped")
+                self.drop("invalid_tag")
+                return
+
+            # Write a chunk of a streamed file, deliver only once the whole file is there
+            if data_message.is_chunk():
+                try:
+                    file_path = self.file_receiver.write(
+                        data_message.transfer_id,
+                        message,
+                        data_message.offset,
+                        binary,
+                        data_message.final
+                    )
+                except ValueError as ex:
+                    debug_warning(self.NAME,
+                                  "Invalid chunk dropped: %s", ex)
+                    self.drop("invalid_chunk")
+                    return
+                if file_path:
+                    self.metrics.add("files_received")
+                    debug_log(self.NAME,
+                              "File saved as %s", file_path)
+                    self.deliver_local(message, data_message.recipient)
+                return
+
+            debug_trace(self.NAME,
+                        "Decrypted message: %s", message)
 
             # Handle file message if it is a file
             if data_message.is_file:
-                enc_binary = data_message.binary
-                binary = decrypt_file(enc_binary, sym_key)
-                decoded_message = base64.b64decode(binary)
                 file_path = os.path.join(ROOT_DIR, "received", self.name, f"received_file_{message}")
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
                 with open(file_path, 'wb') as file:
-                    file.write(decoded_message)
-                    debug_log(self.NAME,
-                              f"File saved as {file_path}")
+                    file.write(binary)
+                debug_log(self.NAME,
+                          "File saved as %s", file_path)
 
-            for client in self.clients.values():
-                message_to_client = {
-                    'message': message
-                }
-                message_json = json.dumps(message_to_client)
-                client.sendall(message_json.encode('utf-8'))
+            self.deliver_local(message, data_message.recipient)
 
         else:
             # Get the next node before popping the current node
-            next_node: DataNode = data_message.path[1] if len(data_message.path) > 1 else None
+            next_node: Optional[DataNode] = (
+                self.directory.get(data_message.path[1]) if len(data_message.path) > 1 else None
+            )
             # Pop the current node from the path
             data_message.path.pop(0)
 
             if not next_node:
                 debug_warning(self.NAME,
                               "No next node found in the path. Message cannot be forwarded.")
+                self.drop("no_next_node")
                 return
 
+            self.metrics.add("messages_forwarded")
             self.send_message_client(data_message, next_node)
 
+    def forward_frame(self, frame: MessageFrame) -> None:
+        if not frame.is_current_node(self.node_id):
+            debug_warning(self.NAME,
+                          "Forbidden Message at hop %d of %s", frame.hop, frame.path)
+            self.drop("not_on_path")
+            return
+
+        next_node: Optional[DataNode] = self.directory.get(frame.next_hop())
+        if not next_node:
+            debug_warning(self.NAME,
+                          "No next node found in the path. Message cannot be forwarded.")
+            self.drop("no_next_node")
+            return
+
+        self.metrics.add("messages_forwarded")
+        self.send_message_client(frame, next_node)
+
+    def is_transit(self, message_json: Message) -> bool:
+        """ Whether the message only passes through this router, so it needs no crypto here. """
+        if isinstance(message_json, MessageFrame):
+            return not message_json.is_destine(self.node_id)
+        if isinstance(message_json, DataMessage):
+            return bool(message_json.path) and not message_json.is_destine(self.node_id)
+        path = message_json.get('path')
+        return bool(path) and path[-1] != self.node_id
+
+    def deliver_local(self, message: str, recipient: str = "") -> None:
+        """ Queue a message that reached this router to the clients registered as its recipient. """
+        message_to_client = {
+            'message': message
+        }
+        if recipient:
+            message_to_client['recipient'] = recipient
+        with self.lock:
+            targets: List[Tuple[Tuple[str, int], socket.socket]] = [
+                (address, self.clients[address]) for address in self.recipients.targets(recipient, self.clients)
+                if address in self.clients
+            ]
+        if not targets:
+            debug_warning(self.NAME,
+                          "No client receives for %r, message dropped", recipient)
+            self.drop("unroutable_local")
+            return
+        frame: bytes = encode_frame(message_to_client)
+        for address, client in targets:
+            self.deliveries.put(address, client, frame)
+
     def close_client(self, client: socket.socket, address: Tuple[str, int]) -> None:
         with self.lock:
-            if client in self.clients.values():
-                client.close()
+            if self.clients.get(address) is client:
                 del self.clients[address]
+            if self.peers.get(address) is client:
+                del self.peers[address]
+            self.client_locks.pop(address, None)
+            self.recipients.unregister(address)
+            client.close()
+        self.deliveries.remove(address)
         debug_warning(self.NAME,
-                      f"Connection closed with {address}")
-
-    def send_message_client(self, data_message: DataMessage, next_node: DataNode) -> None:
-        json_message = json.dumps(data_message.__dict__())
-        try:
-            next_node_client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            next_node_client_socket.connect((next_node.ip, next_node.port))
-            next_node_client_socket.sendall(json_message.encode('utf-8'))
-            debug_log(self.NAME,
-                      f"Message SENT to {next_node.name}: {json_message[:15]}")
-            next_node_client_socket.close()
-        except Exception as ex:
-            debug_exception(self.NAME,
-                            f"Failed to send message to {next_node.name}: {ex}")
+                      "Connection closed with %s", address)
+
+    def encode(self, data_message: Union[DataMessage, MessageFrame], wire_format: str) -> Frame:
+        with self.metrics.timer("encode_seconds"):
+            if isinstance(data_message, MessageFrame):
+                if wire_format == WIRE_BINARY:
+                    return encode_forward(data_message)
+                # A JSON next hop needs the whole message, without the current node
+                data_message = data_message.to_message()
+                data_message.path.pop(0)
+            return encode_message(data_message, wire_format)
+
+    def send_message_client(self, data_message: Union[DataMessage, MessageFrame], next_node: DataNode) -> bool:
+        size: int = message_size(data_message)
+        queued: bool = self.outbound.put(
+            (next_node.ip, next_node.port),
+            next_node.name,
+            lambda wire_format: self.encode(data_message, wire_format),
+            size,
+            priority_of(data_message, size)
+        )
+        if queued:
+            debug_trace(self.NAME,
+                        "Message QUEUED to %s: %d bytes", next_node.name, size)
+        else:
+            debug_warning(self.NAME,
+                          "Send queue to %s is full, message dropped", next_node.name)
+        return queued
 
     def stop(self) -> None:
         self.running.clear()
-        self.server_socket.close()
-        try:
-            self.controller_socket.shutdown(socket.SHUT_RDWR)
-            self.controller_socket.close()
-        except Exception as ex:
-            debug_exception(self.NAME,
-                            f"Error closing controller socket: {ex}")
+        if self.server_socket is not None:
+            # Closing alone does not wake a thread blocked in accept
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        if self.controller_socket is not None:
+            try:
+                self.controller_socket.shutdown(socket.SHUT_RDWR)
+                self.controller_socket.close()
+            except Exception as ex:
+                debug_exception(self.NAME,
+                                "Error closing controller socket: %s", ex)
+
+        self.outbound.close()
+        self.deliveries.close()
+        self.pool.close()
+        self.file_receiver.close()
 
         with self.lock:
-            for client in self.clients.values():
+            for client in [*self.clients.values(), *self.peers.values()]:
                 try:
                     client.shutdown(socket.SHUT_RDWR)
                     client.close()
                 except Exception as ex:
                     debug_exception(self.NAME,
-                                    f"Error closing client socket: {ex}")
+                                    "Error closing client socket: %s", ex)
             self.clients.clear()
+            self.peers.clear()
+            self.client_locks.clear()
 
         debug_warning(self.NAME,
                       "Router Server Stopped.")
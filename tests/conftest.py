@@ -0,0 +1,12 @@
+import pytest
+
+import network.router
+from network.common import route_store
+
+
+@pytest.fixture(autouse=True)
+def runtime_dirs(tmp_path, monkeypatch):
+    """ Route snapshots and received files go to the test's own directory, never into the source tree. """
+    monkeypatch.setattr(route_store, "ROUTES_DIR", str(tmp_path / "routes"))
+    monkeypatch.setattr(network.router, "ROOT_DIR", str(tmp_path))
+    return tmp_path
@@ -0,0 +1,32 @@
+import asyncio
+
+from network.async_router import AsyncRouter
+from network.common.data import DataMessage
+from network.common.framing import WIRE_BINARY, encode_frame, encode_message
+
+
+def test_unexpected_controller_frames_do_not_stop_the_updates(tmp_path):
+    router = AsyncRouter("127.0.0.1", 0, "127.0.0.1", 0, name="A", key_dir=str(tmp_path))
+    try:
+        async def check() -> None:
+            reader = asyncio.StreamReader()
+            reader.feed_data(encode_message(DataMessage(message=b"x", path=[1]), WIRE_BINARY))
+            reader.feed_data(encode_frame({"type": "heartbeat", "interval": 2.5, "timeout": 5.0}))
+            reader.feed_eof()
+            await router._routes_checker(reader)
+
+        router.run(check()).result(5.0)
+        assert router.heartbeat_interval == 2.5
+    finally:
+        router.stop()
+
+
+def test_async_router_has_no_threaded_transport(tmp_path):
+    router = AsyncRouter("127.0.0.1", 0, "127.0.0.1", 0, name="A", key_dir=str(tmp_path))
+    try:
+        assert not hasattr(router, "pool")
+        assert not hasattr(router, "outbound")
+        assert not hasattr(router, "deliveries")
+        assert router.stats()["next_hops"] == 0
+    finally:
+        router.stop()
@@ -0,0 +1,19 @@
+import pytest
+
+from network.client import Client
+
+
+def test_messages_of_a_failed_write_do_not_stay_pending():
+    # Never connected, every write fails
+    client = Client("127.0.0.1", 9)
+    try:
+        assert client.send_message("B", "hello") is None
+        with pytest.raises(OSError):
+            client.register("bob")
+        with pytest.raises(OSError):
+            client.send_many([("B", "first"), ("B", "second")])
+
+        assert not client.pending
+        assert client.wait_acks(timeout=0)
+    finally:
+        client.stop()
@@ -0,0 +1,105 @@
+from network.common.data import DataMessage, DataNode, NodeDirectory, NodeRoutes, RoutesDelta, RouteTable
+
+
+def chunk(**fields) -> DataMessage:
+    values = dict(message=b"\x00name", path=[4, 5], key="wrapped", is_file=True, binary=b"\x01" * 64,
+                  transfer_id="abc123", offset=1024, final=True, recipient="bob")
+    values.update(fields)
+    return DataMessage(**values)
+
+
+def test_message_round_trips_through_bytes():
+    message: DataMessage = chunk()
+    decoded: DataMessage = DataMessage.from_bytes(message.to_bytes())
+
+    assert decoded.__dict__() == message.__dict__()
+
+
+def test_message_round_trips_through_json():
+    message: DataMessage = chunk(final=False, recipient="")
+    decoded: DataMessage = DataMessage.from_json(message.__dict__())
+
+    assert decoded.__dict__() == message.__dict__()
+    assert DataMessage.is_message(message.__dict__())
+
+
+def test_associated_data_covers_the_clear_header_fields():
+    message: DataMessage = chunk()
+
+    assert chunk().associated_data() == message.associated_data()
+    for changed in (chunk(recipient="eve"), chunk(offset=0), chunk(final=False), chunk(transfer_id="abc124")):
+        assert changed.associated_data() != message.associated_data()
+    # The path and the key are rewritten or checked on the way, they are not bound
+    assert chunk(path=[9]).associated_data() == message.associated_data()
+
+
+def test_node_directory_ships_only_the_changes():
+    controller = NodeDirectory()
+    router = NodeDirectory()
+    controller.add(DataNode("A", "127.0.0.1", 9000))
+    controller.add(DataNode("B", "127.0.0.1", 9001))
+
+    assert router.apply(controller.changes_since(0)) == []
+    version: int = controller.version
+
+    controller.add(DataNode("B", "127.0.0.1", 9101))
+    controller.remove("A")
+    controller.add(DataNode("C", "127.0.0.1", 9002))
+    changes = controller.changes_since(version)
+
+    assert changes["base_version"] == version
+    assert [node["name"] for node in changes["nodes"]] == ["B", "C"]
+    assert sorted(router.apply(changes)) == [1, 2]
+    assert {node.name: node.port for node in router.nodes.values()} == {"B": 9101, "C": 9002}
+    assert router.version == controller.version
+
+
+def test_node_directory_refuses_changes_over_a_missing_version():
+    controller = NodeDirectory()
+    controller.add(DataNode("A", "127.0.0.1", 9000))
+    controller.add(DataNode("B", "127.0.0.1", 9001))
+
+    assert NodeDirectory().apply(controller.changes_since(1)) is None
+
+
+def test_node_directory_keeps_ids_across_removals():
+    directory = NodeDirectory()
+    first: int = directory.add(DataNode("A", "127.0.0.1", 9000)).node_id
+    directory.remove("A")
+    directory.add(DataNode("B", "127.0.0.1", 9001))
+
+    assert directory.add(DataNode("A", "127.0.0.1", 9000)).node_id == first
+
+
+def test_route_table_delta_applies_over_its_base():
+    directory = NodeDirectory()
+    nodes = [directory.add(DataNode(name, "127.0.0.1", 9000 + index)) for index, name in enumerate("ABCDE")]
+    a, b, c, d, e = (node.node_id for node in nodes)
+
+    base = RouteTable.from_paths({b: [a, b], c: [a, b, c], d: [a, d]}, version=1)
+    current = RouteTable.from_paths({b: [a, b], c: [a, d, c], e: [a, d, e]}, version=2)
+
+    delta_json = current.delta_since(base)
+    assert delta_json["base_version"] == 1 and delta_json["version"] == 2
+    assert sorted(route["destination"] for route in delta_json["routes"]) == [c, e]
+    assert delta_json["removed_ids"] == [d]
+
+    source: DataNode = directory.get(a)
+    base_index = NodeRoutes.from_compact(base.compact(a), directory, source).index()
+    delta: RoutesDelta = RoutesDelta.from_compact(delta_json, directory, source)
+    routes = delta.apply(base_index)
+
+    assert {name: [node.name for node in route.paths] for name, route in routes.items()} == {
+        "B": ["A", "B"],
+        "C": ["A", "D", "C"],
+        "E": ["A", "D", "E"],
+    }
+    # The base index is left as it was
+    assert sorted(base_index) == ["B", "C", "D"]
+
+
+def test_unchanged_route_table_has_an_empty_delta():
+    table = RouteTable.from_multipaths({2: [([1, 2], 0.7), ([1, 3, 2], 0.3)]}, version=1)
+    delta_json = table.delta_since(table)
+
+    assert not delta_json["routes"] and not delta_json["removed_ids"]
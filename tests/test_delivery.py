@@ -0,0 +1,29 @@
+from network.common.delivery import RecipientIndex
+
+ALICE_CLIENT = ("127.0.0.1", 5001)
+BOB_CLIENT = ("127.0.0.1", 5002)
+ANONYMOUS_CLIENT = ("127.0.0.1", 5003)
+
+
+def test_messages_go_to_the_connections_of_their_recipient():
+    index = RecipientIndex()
+    index.register(ALICE_CLIENT, ["alice"])
+    index.register(BOB_CLIENT, ["bob", "alice"])
+    clients = [ALICE_CLIENT, BOB_CLIENT, ANONYMOUS_CLIENT]
+
+    assert sorted(index.targets("alice", clients)) == [ALICE_CLIENT, BOB_CLIENT]
+    assert index.targets("bob", clients) == [BOB_CLIENT]
+    assert index.targets("carol", clients) == []
+    # Messages without a recipient go to the clients that registered none
+    assert index.targets("", clients) == [ANONYMOUS_CLIENT]
+
+
+def test_unregistering_drops_empty_entries():
+    index = RecipientIndex()
+    index.register(BOB_CLIENT, ["bob", "alice"])
+
+    assert index.unregister(BOB_CLIENT, ["alice"]) == {"bob"}
+    assert index.targets("alice", [BOB_CLIENT]) == []
+    assert index.unregister(BOB_CLIENT) == set()
+    assert len(index) == 0
+    assert index.targets("", [BOB_CLIENT]) == [BOB_CLIENT]
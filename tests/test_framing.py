@@ -0,0 +1,55 @@
+import pytest
+
+from network.common.data import DataMessage, MessageFrame
+from network.common.framing import FrameDecoder, FrameError, HEADER, KIND_JSON, WIRE_BINARY, encode_frame, \
+    encode_forward, encode_message
+
+
+def test_decoder_waits_for_split_frames():
+    data: bytes = encode_frame({"type": "ping"}) + encode_frame({"type": "pong", "id": 1})
+    decoder = FrameDecoder()
+
+    messages = []
+    for index in range(len(data)):
+        messages += decoder.feed(data[index:index + 1])
+
+    assert messages == [{"type": "ping"}, {"type": "pong", "id": 1}]
+    assert not decoder.buffer
+
+
+def test_decoder_keeps_the_partial_frame_after_whole_ones():
+    first: bytes = encode_frame({"id": 1})
+    second: bytes = encode_frame({"id": 2})
+    decoder = FrameDecoder()
+
+    assert decoder.feed(first + second[:3]) == [{"id": 1}]
+    assert decoder.feed(second[3:]) == [{"id": 2}]
+
+
+def test_decoder_rejects_oversize_frames():
+    decoder = FrameDecoder(max_frame_size=16)
+    with pytest.raises(FrameError):
+        decoder.feed(HEADER.pack(17, KIND_JSON))
+
+
+def test_decoder_parses_binary_messages_up_to_the_routing_header():
+    message = DataMessage(message=b"secret", path=[1, 2, 3], key="key", recipient="alice")
+    frames = FrameDecoder().feed(encode_message(message, WIRE_BINARY))
+
+    assert len(frames) == 1
+    assert isinstance(frames[0], MessageFrame)
+    assert frames[0].path == (1, 2, 3)
+    assert frames[0].is_current_node(1)
+
+
+def test_forwarded_frame_moves_to_the_next_hop():
+    message = DataMessage(message=b"secret", path=[1, 2, 3], key="key")
+    frame: MessageFrame = FrameDecoder().feed(encode_message(message, WIRE_BINARY))[0]
+
+    forwarded = FrameDecoder().feed(b"".join(bytes(part) for part in encode_forward(frame)))[0]
+
+    assert forwarded.is_current_node(2)
+    assert forwarded.next_hop() == 3
+    decoded: DataMessage = forwarded.to_message()
+    assert decoded.path == [2, 3]
+    assert decoded.message == b"secret"
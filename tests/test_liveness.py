@@ -0,0 +1,38 @@
+from network.common.liveness import LivenessTracker
+
+
+def test_routers_expire_after_missed_heartbeats():
+    tracker = LivenessTracker(interval=1.0, missed=2)
+    tracker.add("A", now=0.0)
+    tracker.add("B", now=0.0)
+
+    assert tracker.next_deadline() == 2.0
+    tracker.touch("B", now=1.5)
+
+    assert tracker.expired(now=2.0) == ["A"]
+    assert "A" not in tracker and "B" in tracker
+    assert tracker.expired(now=3.0) == []
+    assert tracker.expired(now=3.5) == ["B"]
+    assert len(tracker) == 0
+
+
+def test_removed_routers_never_expire():
+    tracker = LivenessTracker(interval=1.0, missed=2)
+    tracker.add("A", now=0.0)
+    tracker.remove("A")
+
+    assert tracker.expired(now=10.0) == []
+    assert tracker.touch("A", now=10.0) is None
+
+
+def test_interval_grows_with_the_routers():
+    tracker = LivenessTracker(interval=1.0, max_rate=10.0)
+    for index in range(50):
+        tracker.add(f"R{index}", now=0.0)
+
+    assert tracker.interval_changed()
+    assert tracker.interval == 5.0
+    assert tracker.config() == {"type": "heartbeat", "interval": 5.0, "timeout": 10.0}
+    # Within the hysteresis nothing is announced again
+    tracker.add("R50", now=0.0)
+    assert not tracker.interval_changed()
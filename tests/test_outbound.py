@@ -0,0 +1,114 @@
+import socket
+import threading
+import time
+from typing import List
+
+from network.common.framing import FrameDecoder, encode_frame
+from network.common.metrics import Metrics
+from network.common.outbound import FrameQueue, OutboundQueues, PRIORITY_BULK, PRIORITY_CONTROL
+from network.common.pool import ConnectionPool, PooledConnection
+
+
+def test_control_frames_overtake_bulk_frames():
+    frames = FrameQueue()
+    frames.push("bulk-1", 100, PRIORITY_BULK)
+    frames.push("control-1", 10, PRIORITY_CONTROL)
+    frames.push("bulk-2", 100, PRIORITY_BULK)
+    frames.push("control-2", 10, PRIORITY_CONTROL)
+
+    assert frames.pop_batch() == ["control-1", "control-2", "bulk-1", "bulk-2"]
+    assert frames.overtaken == 2
+    assert frames.bytes == 0
+
+
+def test_batches_stop_at_their_limits():
+    frames = FrameQueue(max_frames=3)
+    for index in range(3):
+        frames.push(index, 100, PRIORITY_BULK)
+
+    assert frames.full()
+    assert frames.pop_batch(max_bytes=250) == [0, 1]
+    # A frame larger than the limit still goes out alone
+    assert frames.pop_batch(max_bytes=50) == [2]
+    assert not frames.full()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_frames_stay_queued_while_the_next_hop_is_unreachable():
+    address = ("127.0.0.1", free_port())
+    metrics = Metrics()
+    pool = ConnectionPool(connect_timeout=0.5, backoff_initial=0.05, backoff_max=0.1)
+    outbound = OutboundQueues(pool, metrics)
+    try:
+        for index in range(3):
+            assert outbound.put(address, "B", lambda _, index=index: encode_frame({"id": index}), 16, PRIORITY_CONTROL)
+        time.sleep(0.3)
+
+        assert outbound.stats()["depth"] == 3
+        assert metrics.counters["connect_failures"] >= 1
+        assert "messages_dropped" not in metrics.counters
+
+        received: List = []
+        with socket.create_server(address) as server:
+            def accept() -> None:
+                connection, _ = server.accept()
+                decoder = FrameDecoder()
+                with connection:
+                    while len(received) < 3:
+                        data: bytes = connection.recv(4096)
+                        if not data:
+                            return
+                        received.extend(decoder.feed(data))
+
+            reader = threading.Thread(target=accept, daemon=True)
+            reader.start()
+            reader.join(5.0)
+
+        assert received == [{"id": 0}, {"id": 1}, {"id": 2}]
+    finally:
+        outbound.close()
+        pool.close()
+
+
+class StalledPool(ConnectionPool):
+    """ Hangs every connection attempt until released, then refuses it. """
+
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+
+    def acquire(self, address) -> PooledConnection:
+        self.released.wait(5.0)
+        raise ConnectionRefusedError(111, "Connection refused")
+
+
+def test_a_sender_waiting_on_a_retired_queue_moves_to_a_new_one():
+    address = ("127.0.0.1", 9000)
+    pool = StalledPool()
+    outbound = OutboundQueues(pool, max_frames=1, put_timeout=5.0)
+    try:
+        assert outbound.put(address, "B", lambda _: b"first", 5, PRIORITY_BULK)
+        retired = outbound.queues[address]
+
+        results: List[bool] = []
+        sender = threading.Thread(
+            target=lambda: results.append(outbound.put(address, "B", lambda _: b"second", 6, PRIORITY_BULK))
+        )
+        sender.start()
+        time.sleep(0.1)
+        assert not results
+
+        outbound.retain([])
+        sender.join(5.0)
+
+        assert results == [True]
+        assert outbound.queues[address] is not retired
+        assert outbound.queues[address].frames.queued == 1
+    finally:
+        pool.released.set()
+        outbound.close()
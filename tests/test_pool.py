@@ -0,0 +1,64 @@
+from typing import List
+
+import pytest
+
+from network.common.framing import WIRE_JSON
+from network.common.pool import BatchSendError, ConnectionPool, PooledConnection
+
+ADDRESS = ("127.0.0.1", 9000)
+
+
+class FakeSocket:
+    """ Takes the first limit bytes sent to it, then fails like a connection reset by the peer. """
+
+    def __init__(self, limit: int = -1):
+        self.limit: int = limit
+        self.data: bytearray = bytearray()
+
+    def sendmsg(self, buffers: List[memoryview]) -> int:
+        data: bytes = b"".join(bytes(buffer) for buffer in buffers)
+        if 0 <= self.limit <= len(self.data):
+            raise ConnectionResetError(104, "Connection reset by peer")
+        if self.limit >= 0:
+            data = data[:self.limit - len(self.data)]
+        self.data += data
+        return len(data)
+
+    def close(self) -> None:
+        pass
+
+
+class FakePool(ConnectionPool):
+    def __init__(self, sockets: List[FakeSocket]):
+        super().__init__()
+        self.sockets: List[FakeSocket] = sockets
+
+    def connect(self, address) -> PooledConnection:
+        if not self.sockets:
+            raise ConnectionRefusedError(111, "Connection refused")
+        return PooledConnection(address, self.sockets.pop(0), WIRE_JSON)
+
+
+def frame(index: int):
+    return lambda _: bytes([index]) * 10
+
+
+def test_only_the_frames_not_written_whole_are_resent():
+    broken, fresh = FakeSocket(limit=25), FakeSocket()
+    pool = FakePool([broken, fresh])
+
+    sent: int = pool.send_many(ADDRESS, [frame(index) for index in range(4)])
+
+    assert broken.data == bytes([0]) * 10 + bytes([1]) * 10 + bytes([2]) * 5
+    # The cut frame is sent again whole, the frames before it are not
+    assert fresh.data == bytes([2]) * 10 + bytes([3]) * 10
+    assert sent == 40
+
+
+def test_failed_retry_reports_the_frames_sent():
+    pool = FakePool([FakeSocket(limit=15)])
+
+    with pytest.raises(BatchSendError) as error:
+        pool.send_many(ADDRESS, [frame(index) for index in range(3)])
+
+    assert error.value.sent == 1
@@ -0,0 +1,53 @@
+import os
+
+from network.common import route_store
+from network.common.data import DataNode, DataRoute, NodeRoutes
+from network.common.route_store import HEADER, RouteStore, read_routes, store_route, write_route_store
+
+
+def node_routes() -> NodeRoutes:
+    a = DataNode("A", "127.0.0.1", 9000, "key-a", 1)
+    b = DataNode("B", "127.0.0.1", 9001, "key-b", 2)
+    c = DataNode("C", "127.0.0.1", 9002, "key-c", 3)
+    d = DataNode("D", "127.0.0.1", 9003, "key-d", 4)
+    return NodeRoutes(a, [
+        DataRoute(a, b, [a, b]),
+        DataRoute(a, c, [a, b, c], [[a, d, c]], [1.0, 0.6]),
+        DataRoute(a, d, []),
+    ], version=7)
+
+
+def test_snapshot_round_trips(tmp_path):
+    path: str = os.path.join(str(tmp_path), "A.bin")
+    routes: NodeRoutes = node_routes()
+    write_route_store(path, routes)
+
+    with RouteStore(path) as store:
+        assert len(store) == 3
+        assert store.routes().__dict__() == routes.__dict__()
+
+
+def test_snapshot_keeps_alternates_and_weights(tmp_path):
+    path: str = os.path.join(str(tmp_path), "A.bin")
+    write_route_store(path, node_routes())
+
+    with RouteStore(path) as store:
+        route: DataRoute = store.get("C")
+        assert [[node.name for node in path] for path in route.all_paths()] == [["A", "B", "C"], ["A", "D", "C"]]
+        assert route.weights == [1.0, 0.6]
+        assert store.get("B").weights == []
+        assert store.get("D").paths == []
+        assert store.get("E") is None
+
+
+def test_snapshots_of_another_format_are_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(route_store, "ROUTES_DIR", str(tmp_path))
+    store_route("A", node_routes())
+    with open(route_store.store_path("A"), "r+b") as f:
+        data = bytearray(f.read(HEADER.size))
+        data[4:6] = (1).to_bytes(2, "little")
+        f.seek(0)
+        f.write(data)
+
+    assert read_routes("A") is None
+    assert read_routes("B") is None
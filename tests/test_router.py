@@ -0,0 +1,117 @@
+import copy
+import os
+from typing import List, Tuple
+
+from network.common.data import DataMessage, DataNode, DataRoute, NodeRoutes
+import network.router
+from network.router import Router
+
+
+def router_at(tmp_path, name: str) -> Router:
+    """ A router whose keys stay in the test's directory. """
+    return Router("127.0.0.1", 0, "127.0.0.1", 0, name=name, key_dir=str(tmp_path / "keys"))
+
+
+def linked_routers(tmp_path) -> Tuple[Router, Router, List[DataMessage], List[str]]:
+    """ Two routers sharing a directory, the messages sent by the first and those delivered by the second. """
+    source: Router = router_at(tmp_path, "TestRouterSource")
+    destination: Router = router_at(tmp_path, "TestRouterDestination")
+    nodes = [dict(source.data_node().__dict__(), id=1), dict(destination.data_node().__dict__(), id=2)]
+    for router in (source, destination):
+        router.directory.apply({"base_version": 0, "version": 1, "nodes": nodes})
+    source.routes = {
+        destination.name: DataRoute(source.directory.get(1), source.directory.get(2),
+                                    [source.directory.get(1), source.directory.get(2)])
+    }
+
+    sent: List[DataMessage] = []
+    delivered: List[str] = []
+    source.send_message_client = lambda message, node: sent.append(message) or True
+    destination.deliver_local = lambda message, recipient="": delivered.append(message)
+    return source, destination, sent, delivered
+
+
+def test_routes_are_served_from_memory_and_reloaded_on_start(tmp_path):
+    router: Router = router_at(tmp_path, "TestRouterIndex")
+    try:
+        source = DataNode("TestRouterIndex", "127.0.0.1", 9000, "", 1)
+        hop = DataNode("B", "127.0.0.1", 9001, "", 2)
+        destination = DataNode("C", "127.0.0.1", 9002, "", 3)
+        routes = NodeRoutes(source, [DataRoute(source, destination, [source, hop, destination])], version=4)
+        sent = []
+        router.send_controller = sent.append
+        router.apply_routes(routes.__dict__())
+
+        assert sent[-1]["type"] == "routes_ack" and sent[-1]["version"] == 4
+
+        route: DataRoute = router.get_route("C")
+        assert [node.name for node in route.paths] == ["TestRouterIndex", "B", "C"]
+        assert router.get_route("D") is None
+    finally:
+        router.stop()
+
+    restarted: Router = router_at(tmp_path, "TestRouterIndex")
+    try:
+        assert restarted.routes_version == 4
+        assert [node.name for node in restarted.get_route("C").paths] == ["TestRouterIndex", "B", "C"]
+    finally:
+        restarted.stop()
+
+
+def test_a_key_that_cannot_be_unwrapped_drops_only_its_message(tmp_path):
+    source, destination, sent, delivered = linked_routers(tmp_path)
+    try:
+        assert source.send_message(destination.name, "hello")
+        message: DataMessage = sent[0]
+
+        for key in ("AAAA", message.key[:-8]):
+            corrupt: DataMessage = copy.copy(message)
+            corrupt.key = key
+            destination.process_message(corrupt)
+
+        assert destination.metrics.counters["dropped_invalid_key"] == 2
+        assert delivered == []
+
+        destination.process_message(message)
+        assert delivered == ["hello"]
+    finally:
+        source.stop()
+        destination.stop()
+
+
+def test_a_whole_file_is_encrypted_raw_and_written_as_sent(tmp_path):
+    source, destination, sent, delivered = linked_routers(tmp_path)
+    try:
+        data: bytes = bytes(range(256)) * 4
+        assert source.send_message(destination.name, "data.bin", is_file=True, filedata=data)
+
+        # Nonce and tag only, no base64 inflation
+        assert len(sent[0].binary) == 12 + len(data) + 16
+
+        destination.process_message(sent[0])
+        path = os.path.join(network.router.ROOT_DIR, "received", destination.name, "received_file_data.bin")
+        with open(path, "rb") as f:
+            assert f.read() == data
+        assert delivered == ["data.bin"]
+    finally:
+        source.stop()
+        destination.stop()
+
+
+def test_messages_without_a_path_fail_instead_of_raising(tmp_path):
+    router: Router = router_at(tmp_path, "TestRouterUnreachable")
+    try:
+        source = DataNode("TestRouterUnreachable", "127.0.0.1", 0, "", 1)
+        destination = DataNode("B", "127.0.0.1", 9001, "", 2)
+        # The controller keeps unreachable destinations in the table with an empty path
+        router.routes = {"B": DataRoute(source, destination, [])}
+
+        ack = router.process_messages([
+            {"destination": "B", "message": "hello", "id": 1},
+            {"destination": "C", "message": "hello", "id": 2},
+        ])
+
+        assert ack == {"type": "ack", "ids": [], "failed": [1, 2]}
+        assert router.metrics.counters["dropped_no_route"] == 2
+    finally:
+        router.stop()
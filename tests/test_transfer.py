@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from network.common.transfer import FileReceiver
+
+
+def test_chunks_in_any_order_complete_the_file(tmp_path):
+    receiver = FileReceiver(str(tmp_path))
+
+    assert receiver.write("t1", "data.bin", 4, b"efgh", False) is None
+    assert receiver.write("t1", "data.bin", 8, b"ij", True) is None
+    path = receiver.write("t1", "data.bin", 0, b"abcd", False)
+
+    assert path == os.path.join(str(tmp_path), "received_file_t1_data.bin")
+    with open(path, "rb") as f:
+        assert f.read() == b"abcdefghij"
+
+
+def test_duplicate_chunks_do_not_complete_a_file_with_holes(tmp_path):
+    receiver = FileReceiver(str(tmp_path))
+
+    assert receiver.write("t1", "data.bin", 0, b"abcd", False) is None
+    assert receiver.write("t1", "data.bin", 0, b"abcd", False) is None
+    assert receiver.write("t1", "data.bin", 8, b"ij", True) is None
+    assert receiver.write("t1", "data.bin", 8, b"ij", True) is None
+    assert receiver.transfers["t1"].ranges == [[0, 4], [8, 10]]
+
+    assert receiver.write("t1", "data.bin", 4, b"efgh", False) is not None
+    # A chunk repeated after completion does not start the file over
+    assert receiver.write("t1", "data.bin", 0, b"abcd", False) is None
+    assert "t1" not in receiver.transfers
+
+
+def test_transfers_of_the_same_name_write_their_own_files(tmp_path):
+    receiver = FileReceiver(str(tmp_path))
+
+    first = receiver.write("t1", "data.bin", 0, b"first", True)
+    second = receiver.write("t2", "data.bin", 0, b"second", True)
+
+    assert first != second
+    with open(first, "rb") as f:
+        assert f.read() == b"first"
+
+
+def test_empty_file_completes(tmp_path):
+    path = FileReceiver(str(tmp_path)).write("t1", "empty.bin", 0, b"", True)
+
+    assert os.path.getsize(path) == 0
+
+
+def test_chunks_past_the_end_are_rejected(tmp_path):
+    receiver = FileReceiver(str(tmp_path))
+    receiver.write("t1", "data.bin", 4, b"ef", True)
+
+    with pytest.raises(ValueError):
+        receiver.write("t1", "data.bin", 4, b"efgh", False)
+
+
+def test_received_files_stay_in_the_directory(tmp_path):
+    receiver = FileReceiver(str(tmp_path))
+
+    with pytest.raises(ValueError):
+        receiver.write("../t1", "data.bin", 0, b"x", True)
+    path = receiver.write("t1", "../../data.bin", 0, b"x", True)
+    assert os.path.dirname(path) == str(tmp_path)